@@ -1,11 +1,13 @@
 import os
 import glob
-import re
 import argparse
 import numpy as np
 import pandas as pd
-import functools
-import pingouin as pg
+from permutation_fun import prepare_covariates, pcorr_shuffle, iter_pcorr_tiles, adaptive_pcorr_shuffle, analytic_pvalue, pcorr_max_stat, pcorr_nbs
+from connectivity_fun import load_edge_matrix, align_subjects, corr_cube_path, cube_sub_ids, read_edge_cube
+from shuffle_index_fun import ShuffleGenerator, feature_ids, stack_index, index_subjects, index_store_path, open_index_store, load_index_store, csv_index_files
+from cache_fun import array_key
+from null_store_fun import null_store_path, create_null_store, resume_null_store, append_null_tile, export_null_csv
 
 # set input parameters
 parser = argparse.ArgumentParser(description='boostrap correlation')
@@ -26,126 +28,324 @@ parser.add_argument(
     help='roi or edge')
 parser.add_argument(
     '--idx_min',
-    required=True,
     action='store',
-    help='the lower bound of the index range')
+    help='the lower bound of the index range, all edges are analyzed when no range is given')
 parser.add_argument(
     '--idx_max',
-    required=True,
     action='store',
-    help='the upper bound of the index range')
+    help='the upper bound of the index range, all edges are analyzed when no range is given')
+parser.add_argument(
+    '--shared_index',
+    action='store_true',
+    help='use the shuffles of edge 0 for every edge')
+parser.add_argument(
+    '--seed',
+    action='store',
+    type=int,
+    help='generate the shuffles on the fly from this seed instead of importing the shuffle index')
+parser.add_argument(
+    '--shuffle_time',
+    action='store',
+    type=int,
+    default=1000,
+    help='the number of shuffles')
+parser.add_argument(
+    '--adaptive',
+    action='store',
+    type=int,
+    help='stop the shuffles of each edge once this many shuffled |r| reach the observed |r| (Besag-Clifford), '
+         'and save the p-values instead of the shuffled coefficients')
+parser.add_argument(
+    '--max_stat',
+    action='store_true',
+    help='save the uncorrected, FDR & FWE (maximum statistic) p-values of each edge and the maximum |r| of each shuffle, '
+         'computed in one pass instead of saving the shuffled coefficients (needs --shared_index)')
+parser.add_argument(
+    '--nbs',
+    action='store',
+    type=float,
+    help='run the network-based statistic with this primary |r| threshold on all edges (needs --shared_index), '
+         'and save the components & their p-values instead of the shuffled coefficients')
+parser.add_argument(
+    '--nbs_tail',
+    action='store',
+    choices=['both', 'pos', 'neg'],
+    default='both',
+    help='threshold |r|, the positive or the negative correlations of the network-based statistic')
+parser.add_argument(
+    '--output_format',
+    action='store',
+    choices=['csv', 'binary', 'both'],
+    default='csv',
+    help='save the shuffled coefficients as csv, as a float32 null store (.null) written tile by tile, or both')
+parser.add_argument(
+    '--force',
+    action='store_true',
+    help='recompute every tile, even if the null store of a killed run with the same arguments holds completed tiles')
+parser.add_argument(
+    '--workers',
+    action='store',
+    type=int,
+    default=1,
+    help='the number of processes that share the shuffles')
 args = parser.parse_args()
 
 # set study parameter
 base_dir = '/home/kcheung3/sanlab/DEV_RS'
 output_dir = os.path.join(base_dir, 'baseline_analysis', 'edge_dv_shuffle_schaefer')
-shuffle_time = 1000
+shuffle_time = args.shuffle_time
+seed = args.seed
+workers = args.workers
+adaptive = args.adaptive
+max_stat = args.max_stat
+nbs = args.nbs
+nbs_tail = args.nbs_tail
+output_format = args.output_format
+force = args.force
+if sum([adaptive is not None, max_stat, nbs is not None]) > 1:
+    parser.error('--adaptive, --max_stat and --nbs are exclusive')
+if max_stat and not args.shared_index:
+    parser.error('--max_stat needs --shared_index, the maximum statistic is taken over one shuffle of all edges')
+if nbs is not None and (not args.shared_index or args.idx_min is not None):
+    parser.error('--nbs needs --shared_index and the whole edge set (no index range)')
+if output_format != 'csv' and (adaptive is not None or max_stat or nbs is not None):
+    parser.error('--output_format binary/both only applies to the shuffled coefficients')
 idx_min = args.idx_min
 idx_max = args.idx_max
 acq_id = args.acq
 dv_name = args.dv
 idx_type = args.idx_type
+shared_index = args.shared_index
 
-def load_index(index_type, idx_min, idx_max):
+def load_index(index_type, idx_min, idx_max, keys=None):
     '''
-    (str) -> dict, list
-    This function imports the index for each shuffle for each ROI/edges
+    (str, str, str, list) -> dict, list
+    This function imports the index for each shuffle for each ROI/edges. All files are listed when idx_min & idx_max are None,
+    and only the index of the ROI/edges in keys is imported when keys is given.
+    The range refers to the sorted edge IDs. The binary shuffle index is memory-mapped when it exists, otherwise the csv files are imported
     '''
+    # use the binary shuffle index if it has been converted (shuffle_index_Schaefer.py --mode convert)
+    store_file = index_store_path(os.path.join(base_dir, 'baseline_analysis', 'shuffle_index'), index_type)
+    if os.path.exists(store_file):
+        _, edge_list = open_index_store(store_file)
+        if idx_min is not None and idx_max is not None:
+            edge_list = edge_list[int(idx_min):int(idx_max)]
+        idx_dict = load_index_store(store_file, edge_list if keys is None else keys)
+        return idx_dict, edge_list
+
     # set the file directory parameters
     idx_dir = os.path.join(base_dir, 'baseline_analysis', 'shuffle_index', f'{index_type}_shuffle_schaefer')
-    idx_fileNames = glob.glob(os.path.join(idx_dir, '*.csv'))
+    # sort the edges by their numeric ID, so a range selects the same edges on every file system (and as the binary index)
+    idx_files = csv_index_files(idx_dir)
+    edge_list = sorted(idx_files, key=int)
 
     # initiate a dictionary
     idx_dict = {}
-    edge_list = []
 
-    for file in idx_fileNames[int(idx_min):int(idx_max)]:
-        inx_df = pd.read_csv(file, sep=',', header=None)
-        shuffle_key = re.split('[/_.]', file)[len(re.split('[/_.]', file))-2]
-        edge_list.append(shuffle_key)
+    if idx_min is not None and idx_max is not None:
+        edge_list = edge_list[int(idx_min):int(idx_max)]
+
+    for shuffle_key in edge_list:
+        if keys is not None and shuffle_key not in keys:
+            continue
+        inx_df = pd.read_csv(idx_files[shuffle_key], sep=',', header=None)
         idx_dict[shuffle_key] = inx_df
     
     return idx_dict, edge_list
 
 def extract_corr_edge(acq_id, include_sid):
     '''
-    (str, str) -> DataFrame
-    This function imports the correlation matrix of each subject and extract the upper triangle value, then merge all subject data into one dataframe.
-    Each row represents an edge between two nodes (labeled with column node_1 & node_2), and each column represents a subject
+    (str, list) -> array, list, DataFrame
+    This function imports the correlation matrix of each subject and extracts the upper triangle values into a subjects x edges array.
+    Each column represents an edge between two nodes (labeled with column node_1 & node_2 of the edge lookup), and each row represents a subject.
+    The matrices are read from the connectome cube when it holds this acquisition, otherwise from the csv file of each subject.
+    Either way the rows are in the order of include_sid, and subjects without a matrix are left out.
+    Returns the array, the subject IDs of its rows and the edge lookup
     '''
-    # set file directory parameters
-    corr_dir = os.path.join(base_dir, 'baseline_analysis', 'subject_correlation', 'baseline_acq_schaefer')
-    corr_fileNames = glob.glob(os.path.join(corr_dir, f'*_{acq_id}_corr.csv'))
-    # initiate a list for the dataframes across all subjects
-    edge_corr_dfList = []
-
-    for file in corr_fileNames: 
-        sub_df = pd.read_csv(file, sep=',', header=None) # load the correlation matrix df of a given subject
-        sub_id= re.split('/|_', file)[len(re.split('/|_', file))-3] # extract subject id
-        if sub_id not in include_sid: 
-            continue
-        mask = np.triu(np.ones(sub_df.shape), k = 1).astype(bool).reshape(sub_df.size) # create a mask for the upper triangle
-        sub_df_stack = sub_df.stack()[mask].reset_index() # transform the upper triangle into a long-format dataset
-        sub_df_stack.columns = ['node_1','node_2',sub_id] # rename the dataframe
-        edge_corr_dfList.append(sub_df_stack) # store in the lits
-
-    # merge all individual dataframe
-    edge_corr_df = functools.reduce(lambda x, y: pd.merge(x, y, on=["node_1", "node_2"]), edge_corr_dfList)
-
-    return edge_corr_df
-
-def conn_corr_shuffle(dv_df, dv_name, conn_df, idx_dic, edge_list, shuffle_time):
-    # initiate parameters
-    edge_dv_shuffle_l = []
-    # loop through each edge and calculate correlations
-    for edge in edge_list:
-        # extract shuffle index
-        idx_df = idx_dic[edge]
-        # initiate a list
-        corr_list = []
-        # extract the centrality
-        conn_list = conn_df.iloc[int(edge), 2:]
-        for i in range(shuffle_time): 
-            # re-order the dv & cov: 
-            dv_shuffle = dv_df[dv_name][idx_df.iloc[i]].values
-            age_shuffle = dv_df['age'][idx_df.iloc[i]].values
-            gender_shuffle = dv_df['gender'][idx_df.iloc[i]].values
-            # generate a dataframe with all shuffled data
-            pcorr_df = pd.DataFrame(
-                {"conn_list" : conn_list,
-                "age_shuffle": age_shuffle,
-                "gender_shuffle": gender_shuffle, 
-                "dv_shuffle": dv_shuffle}
-            )
-            # dummy code the gender variable
-            pcorr_df_recode = pd.get_dummies(pcorr_df)
-            # calculate the partial correlation between edge weights and the dv controlling for age
-            pcorr= pg.partial_corr(data= pcorr_df_recode, x='conn_list', y='dv_shuffle', covar=['age_shuffle', 'gender_shuffle_Female'], method='spearman').iloc[0,1]
-            # append the partial coefficient to the output list 
-            corr_list.append(pcorr)
-        corr_df = pd.DataFrame(corr_list, columns = [edge])
-        edge_dv_shuffle_l.append(corr_df)
-    
-    edge_dv_shuffle_df = pd.concat(edge_dv_shuffle_l, axis = 1)
+    # use the connectome cube if the subject correlations were written to it
+    corr_root = os.path.join(base_dir, 'baseline_analysis', 'subject_correlation')
+    cube_file = corr_cube_path(corr_root)
+    cube_sid = cube_sub_ids(cube_file, acq_id)
+    if cube_sid:
+        edge_mat, sub_ids, edge_lookup = read_edge_cube(cube_file, acq_id, [sid for sid in include_sid if sid in cube_sid])
+    else:
+        # set file directory parameters
+        corr_dir = os.path.join(corr_root, 'baseline_acq_schaefer')
+        corr_fileNames = glob.glob(os.path.join(corr_dir, f'*_{acq_id}_corr.csv'))
+        # keep the coefficients in double precision so the ranks of the edge weights are not changed by rounding
+        edge_mat, sub_ids, edge_lookup = load_edge_matrix(corr_fileNames, include_sid, dtype=np.float64)
+
+    # put the rows in the order of include_sid, the glob order depends on the file system
+    order, sub_ids = align_subjects(sub_ids, include_sid)
+
+    return edge_mat[order], sub_ids, edge_lookup
+
+def conn_corr_shuffle(dv_df, dv_name, edge_mat, idx_dic, edge_list, shuffle_time, workers=1):
+    '''
+    (DataFrame, str, array, dict, list, int, int) -> DataFrame
+    This function calculates the partial correlation between the weights of all edges in edge_list and the shuffled dv for each shuffle.
+    idx_dic either contains the shuffle index of each edge, or a single shuffle index under the key 'shared' that is used for every edge.
+    The shuffles are distributed over the given number of worker processes.
+    Each row of the output represents a shuffle and each column represents an edge
+    '''
+    # convert the dv & covariates into arrays, gender is dummy coded as gender_shuffle_Female
+    dv, age, gender = prepare_covariates(dv_df, dv_name, 'Female')
+    # select the edge weights of the edges in edge_list
+    conn_mat = edge_mat[:, [int(edge) for edge in edge_list]]
+    # stack the shuffle index into a (edges x) shuffles x subjects array, the generated shuffles are passed to the engine block by block
+    idx = stack_index(idx_dic, edge_list, shuffle_time)
+    # calculate the partial correlation between all edge weights and the shuffled dv controlling for the shuffled age & gender
+    edge_dv_shuffle = pcorr_shuffle(conn_mat, dv, age, gender, idx, workers=workers)
+    edge_dv_shuffle_df = pd.DataFrame(edge_dv_shuffle, columns = edge_list)
 
     return edge_dv_shuffle_df
 
+def conn_corr_shuffle_store(dv_df, dv_name, edge_mat, idx_dic, edge_list, shuffle_time, null_file, params=None, workers=1, force=False):
+    '''
+    (DataFrame, str, array, dict, list, int, str, dict, int, bool) -> None
+    This function calculates the same shuffled partial correlations as conn_corr_shuffle, but appends each tile of edges x shuffles
+    to a null store (null_file) as soon as it is computed, so the null matrix is never held in memory. A relaunch with the same
+    arguments only computes the tiles that the killed run had not completed, unless force is set
+    '''
+    # convert the dv & covariates into arrays, gender is dummy coded as gender_shuffle_Female
+    dv, age, gender = prepare_covariates(dv_df, dv_name, 'Female')
+    # select the edge weights of the edges in edge_list
+    conn_mat = edge_mat[:, [int(edge) for edge in edge_list]]
+    idx = stack_index(idx_dic, edge_list, shuffle_time)
+    # a killed run is only resumed when it used the same connectivity, dv & covariates and the same shuffles,
+    # the generated shuffles are defined by their seed and the stored ones are hashed
+    index = {'seed': idx.seed, 'features': idx.features, 'shape': list(idx.shape)} if hasattr(idx, 'block') else array_key(idx, None)
+    params = dict(params or {}, data=array_key(np.column_stack([conn_mat, dv, age, gender]), None), index=index)
+
+    # resume from the tiles completed by a killed run with the same arguments, the index may hold fewer shuffles than shuffle_time
+    if force:
+        create_null_store(null_file, edge_list, idx.shape[-2], params)
+        done = set()
+    else:
+        done = resume_null_store(null_file, edge_list, idx.shape[-2], params)
+        if done:
+            print('resume', null_file, 'with', len(done), 'completed tiles', flush=True)
+    with open(null_file, 'ab') as f:
+        for features, shuffles, r in iter_pcorr_tiles(conn_mat, dv, age, gender, idx, workers=workers, skip=done):
+            append_null_tile(f, features, shuffles, r, np.float32)
+
+def conn_corr_adaptive(dv_df, dv_name, edge_mat, idx_dic, edge_list, shuffle_time, n_exceed):
+    '''
+    (DataFrame, str, array, dict, list, int, int) -> DataFrame
+    This function tests the partial correlation between the weights of all edges in edge_list and the dv with adaptive shuffles:
+    the shuffles of an edge stop once n_exceed shuffled |r| reach its observed |r| (see adaptive_pcorr_shuffle).
+    Each row of the output represents an edge, with the observed coefficient, the permutation p-value, the number of shuffles used
+    and the parametric p-value
+    '''
+    # convert the dv & covariates into arrays, gender is dummy coded as gender_shuffle_Female
+    dv, age, gender = prepare_covariates(dv_df, dv_name, 'Female')
+    # select the edge weights of the edges in edge_list
+    conn_mat = edge_mat[:, [int(edge) for edge in edge_list]]
+    idx = stack_index(idx_dic, edge_list, shuffle_time)
+    r, p_value, n_shuffle, _ = adaptive_pcorr_shuffle(conn_mat, dv, age, gender, idx, n_exceed)
+
+    return pd.DataFrame({'edge': edge_list, 'r': r, 'p_value': p_value, 'n_shuffle': n_shuffle, 'p_analytic': analytic_pvalue(r, len(dv))})
+
+def conn_corr_max_stat(dv_df, dv_name, edge_mat, idx_dic, edge_list, shuffle_time, workers=1):
+    '''
+    (DataFrame, str, array, dict, list, int, int) -> DataFrame, DataFrame
+    This function tests the partial correlation between the weights of all edges in edge_list and the dv against the shuffled dv,
+    keeping only the exceedance count of each edge and the maximum |r| of each shuffle (see pcorr_max_stat).
+    Returns the p-values (one row per edge: the observed coefficient, the uncorrected, FDR & FWE p-values) and the maximum |r| of each shuffle
+    '''
+    # convert the dv & covariates into arrays, gender is dummy coded as gender_shuffle_Female
+    dv, age, gender = prepare_covariates(dv_df, dv_name, 'Female')
+    # select the edge weights of the edges in edge_list
+    conn_mat = edge_mat[:, [int(edge) for edge in edge_list]]
+    idx = stack_index(idx_dic, edge_list, shuffle_time)
+    r, p_value, p_fdr, p_fwe, max_null = pcorr_max_stat(conn_mat, dv, age, gender, idx, workers=workers)
+
+    return pd.DataFrame({'edge': edge_list, 'r': r, 'p_value': p_value, 'p_fdr': p_fdr, 'p_fwe': p_fwe}), pd.DataFrame({'max_r': max_null})
+
+def conn_corr_nbs(dv_df, dv_name, edge_mat, edge_lookup, idx_dic, shuffle_time, threshold, tail='both'):
+    '''
+    (DataFrame, str, array, DataFrame, dict, int, float, str) -> DataFrame, DataFrame
+    This function runs the network-based statistic on the partial correlation between the weights of all edges and the dv, with the
+    shared shuffles of idx_dic (see pcorr_nbs). Returns one row per edge (the nodes, the observed coefficient, its component and the size
+    & p-value of the component, empty below threshold) and the maximum component size of each shuffle
+    '''
+    # convert the dv & covariates into arrays, gender is dummy coded as gender_shuffle_Female
+    dv, age, gender = prepare_covariates(dv_df, dv_name, 'Female')
+    n_roi = int(edge_lookup['node_2'].max()) + 1
+    r, component, component_size, p_value, max_size = pcorr_nbs(edge_mat, dv, age, gender, stack_index(idx_dic, [], shuffle_time),
+                                                                n_roi, threshold, tail)
+
+    nbs_df = edge_lookup.copy()
+    nbs_df.insert(0, 'edge', edge_lookup.index.astype(str))
+    nbs_df['r'] = r
+    nbs_df['component'] = np.where(component >= 0, component, np.nan)
+    nbs_df['component_size'] = np.where(component >= 0, component_size[component], np.nan)
+    nbs_df['p_value'] = np.where(component >= 0, p_value[component], np.nan)
+
+    return nbs_df, pd.DataFrame({'max_size': max_size})
+
 # load the physio data set
 base_dv = pd.read_csv(os.path.join(base_dir, 'dv_data', 'outputs', 'sub_data_baseline_w_clean.csv'))
 
 # extract the included subject list 
 include_sid = list(base_dv['SID'])
 
-# extract the physio dv as a lsit
-dv_df = base_dv[[dv_name, 'age', 'gender']]
+edge_mat, conn_sid, edge_lookup = extract_corr_edge(acq_id, include_sid)
 
-# extract the index
-idx_dic, edge_list = load_index(idx_type, idx_min, idx_max)
+# extract the physio dv of the subjects with connectivity, in the row order of edge_mat
+dv_df = base_dv.set_index('SID').loc[conn_sid, [dv_name, 'age', 'gender']]
+if len(dv_df) != len(edge_mat):
+    raise ValueError(f'{len(dv_df)} dv rows for the {len(edge_mat)} subjects with connectivity')
 
-conn_df = extract_corr_edge(acq_id, include_sid)
+# extract the index, or generate the shuffles of each edge from the seed
+if seed is not None:
+    edge_list = feature_ids(idx_type)
+    if idx_min is not None and idx_max is not None:
+        edge_list = edge_list[int(idx_min):int(idx_max)]
+    idx_dic = ShuffleGenerator(seed, edge_list, shuffle_time, len(dv_df))
+    if shared_index:
+        idx_dic = {'shared': idx_dic['0']}
+elif shared_index:
+    # every edge uses the shuffles of edge 0, so each block of shuffles is one matrix multiply for the whole edge set
+    _, edge_list = load_index(idx_type, idx_min, idx_max, keys=[])
+    idx_dic = {'shared': load_index(idx_type, None, None, keys=['0'])[0]['0']}
+else:
+    idx_dic, edge_list = load_index(idx_type, idx_min, idx_max)
+# the shuffles permute the rows of the subjects with connectivity
+if index_subjects(idx_dic) != len(dv_df):
+    raise ValueError(f'the shuffle index permutes {index_subjects(idx_dic)} subjects, {len(dv_df)} subjects have connectivity')
 
-# boostrap the correlation between the brain data and the physio data 
-brain_physio_boost = conn_corr_shuffle(dv_df, dv_name, conn_df, idx_dic, edge_list, shuffle_time)
+# the whole edge set is saved without the index range
+range_suffix = '' if idx_min is None or idx_max is None else f'_{idx_min}_{idx_max}'
 
-brain_physio_boost.to_csv(os.path.join(output_dir, f'{dv_name}_acq{acq_id}_{idx_type}_boost_{idx_min}_{idx_max}.csv'),index=False, header=True)
+# test each edge with adaptive shuffles, against the maximum statistic or with the network-based statistic, or boostrap the correlation between the brain data and the physio data
+if adaptive is not None:
+    brain_physio_boost = conn_corr_adaptive(dv_df, dv_name, edge_mat, idx_dic, edge_list, shuffle_time, adaptive)
+    output_type = 'adaptive'
+elif max_stat:
+    brain_physio_boost, max_null_df = conn_corr_max_stat(dv_df, dv_name, edge_mat, idx_dic, edge_list, shuffle_time, workers)
+    output_type = 'pvalue'
+elif nbs is not None:
+    brain_physio_boost, max_null_df = conn_corr_nbs(dv_df, dv_name, edge_mat, edge_lookup, idx_dic, shuffle_time, nbs, nbs_tail)
+    output_type = 'nbs'
+elif output_format != 'csv':
+    # write the shuffled coefficients to the null store tile by tile, and export the csv from it when both are requested
+    brain_physio_boost = None
+    output_type = 'boost'
+    output_file = os.path.join(output_dir, f'{dv_name}_acq{acq_id}_{idx_type}_{output_type}{range_suffix}.csv')
+    params = {'dv': dv_name, 'acq': acq_id, 'idx_type': idx_type, 'idx_min': idx_min, 'idx_max': idx_max, 'shuffle_time': shuffle_time,
+              'seed': seed, 'shared_index': shared_index}
+    conn_corr_shuffle_store(dv_df, dv_name, edge_mat, idx_dic, edge_list, shuffle_time, null_store_path(output_file), params, workers, force)
+    if output_format == 'both':
+        export_null_csv(null_store_path(output_file), output_file)
+else:
+    brain_physio_boost = conn_corr_shuffle(dv_df, dv_name, edge_mat, idx_dic, edge_list, shuffle_time, workers)
+    output_type = 'boost'
 
+output_file = os.path.join(output_dir, f'{dv_name}_acq{acq_id}_{idx_type}_{output_type}{range_suffix}.csv')
+if brain_physio_boost is not None:
+    brain_physio_boost.to_csv(output_file, index=False, header=True)
+if max_stat:
+    max_null_df.to_csv(os.path.join(output_dir, f'{dv_name}_acq{acq_id}_{idx_type}_maxnull{range_suffix}.csv'), index=False, header=True)
+elif nbs is not None:
+    max_null_df.to_csv(os.path.join(output_dir, f'{dv_name}_acq{acq_id}_{idx_type}_nbs_maxnull.csv'), index=False, header=True)
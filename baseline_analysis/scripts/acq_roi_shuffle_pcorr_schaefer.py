@@ -5,7 +5,11 @@ import argparse
 import numpy as np
 import pandas as pd
 import functools
-import pingouin as pg
+from permutation_fun import prepare_covariates, pcorr_shuffle, iter_pcorr_tiles, adaptive_pcorr_shuffle, analytic_pvalue, pcorr_max_stat
+from shuffle_index_fun import ShuffleGenerator, feature_ids, stack_index, index_subjects, index_store_path, load_index_store
+from connectivity_fun import align_subjects, conn_file_sub_id
+from cache_fun import array_key
+from null_store_fun import null_store_path, create_null_store, resume_null_store, append_null_tile, export_null_csv
 
 # set input parameters
 parser = argparse.ArgumentParser(description='boostrap correlation')
@@ -24,22 +28,83 @@ parser.add_argument(
     required=True,
     action='store',
     help='roi or edge')
+parser.add_argument(
+    '--shared_index',
+    action='store_true',
+    help='use the shuffles of ROI 0 for every ROI')
+parser.add_argument(
+    '--seed',
+    action='store',
+    type=int,
+    help='generate the shuffles on the fly from this seed instead of importing the shuffle index')
+parser.add_argument(
+    '--shuffle_time',
+    action='store',
+    type=int,
+    default=1000,
+    help='the number of shuffles')
+parser.add_argument(
+    '--adaptive',
+    action='store',
+    type=int,
+    help='stop the shuffles of each ROI once this many shuffled |r| reach the observed |r| (Besag-Clifford), '
+         'and save the p-values instead of the shuffled coefficients')
+parser.add_argument(
+    '--max_stat',
+    action='store_true',
+    help='save the uncorrected, FDR & FWE (maximum statistic) p-values of each ROI and the maximum |r| of each shuffle, '
+         'computed in one pass instead of saving the shuffled coefficients (needs --shared_index)')
+parser.add_argument(
+    '--output_format',
+    action='store',
+    choices=['csv', 'binary', 'both'],
+    default='csv',
+    help='save the shuffled coefficients as csv, as a float32 null store (.null) written tile by tile, or both')
+parser.add_argument(
+    '--force',
+    action='store_true',
+    help='recompute every tile, even if the null store of a killed run with the same arguments holds completed tiles')
+parser.add_argument(
+    '--workers',
+    action='store',
+    type=int,
+    default=1,
+    help='the number of processes that share the shuffles')
 args = parser.parse_args()
 
 
 # set study parameter
 base_dir = '/home/kcheung3/sanlab/DEV_RS'
 output_dir = os.path.join(base_dir, 'baseline_analysis', 'edge_dv_shuffle_schaefer')
-shuffle_time = 1000
+shuffle_time = args.shuffle_time
+seed = args.seed
+workers = args.workers
+adaptive = args.adaptive
+max_stat = args.max_stat
+if adaptive is not None and max_stat:
+    parser.error('--adaptive and --max_stat are exclusive')
+if max_stat and not args.shared_index:
+    parser.error('--max_stat needs --shared_index, the maximum statistic is taken over one shuffle of all ROIs')
+output_format = args.output_format
+force = args.force
+if output_format != 'csv' and (adaptive is not None or max_stat):
+    parser.error('--output_format binary/both only applies to the shuffled coefficients')
 acq_id = args.acq
 dv_name = args.dv
 idx_type = args.idx_type
+shared_index = args.shared_index
 
 def load_index(index_type):
     '''
-    (str) -> dict, list
-    This function imports the index for each shuffle for each ROI/edges
+    (str) -> dict
+    This function imports the index for each shuffle for each ROI/edges. The binary shuffle index is memory-mapped when it exists,
+    otherwise the csv files are imported
     '''
+    # use the binary shuffle index if it has been converted (shuffle_index_Schaefer.py --mode convert)
+    store_file = index_store_path(os.path.join(base_dir, 'baseline_analysis', 'shuffle_index'), index_type)
+    if os.path.exists(store_file):
+        return load_index_store(store_file)
+
     # set the file directory parameters
     idx_dir = os.path.join(base_dir, 'baseline_analysis', 'shuffle_index', f'{index_type}_shuffle_schaefer')
     idx_fileNames = glob.glob(os.path.join(idx_dir, '*.csv'))
@@ -57,7 +122,7 @@ def extract_connectivity(conn_type, acq_id):
     '''
     (str) -> Dataframe
     This function extract the subject connectivity and concatenate them into a dataframe where each column represents a subject and each row represents 
-    a ROI
+    a ROI. The columns are in the order of include_sid, subjects without connectivity are left out
     '''
     conn_dir = os.path.join(base_dir, 'baseline_analysis', 'subject_connectivity_acq_Schaefer')
     conn_fileNames = glob.glob(os.path.join(conn_dir, f'*_{acq_id}_{conn_type}_full.csv'))
@@ -65,69 +130,156 @@ def extract_connectivity(conn_type, acq_id):
 
     for file in conn_fileNames:
         sub_conn = pd.read_csv(file, sep=',').to_numpy()
-        sub_id= re.split('/|_', file)[len(re.split('/|_', file))-4]
+        sub_id = conn_file_sub_id(file)
         if sub_id not in include_sid: 
             continue
         sub_conn_df = pd.DataFrame(sub_conn, columns = [sub_id])
         conn_list.append(sub_conn_df)
 
     conn_df = pd.concat(conn_list, axis=1)
+    # put the subjects in the order of include_sid, the glob order depends on the file system
+    order, _ = align_subjects(list(conn_df.columns), include_sid)
+    conn_df = conn_df.iloc[:, order]
     return conn_df
 
-def conn_corr_shuffle(dv_df, dv_name, conn_df, idx_dic, shuffle_time):
+def conn_corr_shuffle(dv_df, dv_name, conn_df, idx_dic, shuffle_time, workers=1):
+    '''
+    (DataFrame, str, DataFrame, dict, int, int) -> DataFrame
+    This function calculates the partial correlation between the roi weights of all ROIs and the shuffled dv for each shuffle.
+    idx_dic either contains the shuffle index of each ROI, or a single shuffle index under the key 'shared' that is used for every ROI.
+    The shuffles are distributed over the given number of worker processes.
+    Each row of the output represents a shuffle and each column represents a ROI
+    '''
     # initiate parameters
     roi_list = [str(x) for x in range(0, 100)]
-    roi_dv_shuffle_l = []
-    # loop through each ROI and calculate correlations
-    for roi in roi_list:
-        # extract shuffle index
-        idx_df = idx_dic[roi]
-        # initiate a list
-        corr_list = []
-        # extract the centrality
-        conn_list = conn_df.iloc[int(roi)]
-        for i in range(shuffle_time): 
-            # re-order the dv & cov: 
-            dv_shuffle = dv_df[dv_name][idx_df.iloc[i]].values
-            age_shuffle = dv_df['age'][idx_df.iloc[i]].values
-            gender_shuffle = dv_df['gender'][idx_df.iloc[i]].values
-            # generate a dataframe with all shuffled data
-            pcorr_df = pd.DataFrame(
-                {"conn_list" : conn_list,
-                "age_shuffle": age_shuffle,
-                "gender_shuffle": gender_shuffle, 
-                "dv_shuffle": dv_shuffle}
-            )
-            # dummy code the gender variable
-            pcorr_df_recode = pd.get_dummies(pcorr_df)
-            # calculate the partial correlation between roi weights and the dv controlling for age
-            pcorr= pg.partial_corr(data= pcorr_df_recode, x='conn_list', y='dv_shuffle', covar=['age_shuffle', 'gender_shuffle_Female'], method='spearman').iloc[0,1]
-            # append the partial coefficient to the output list 
-            corr_list.append(pcorr)
-        corr_df = pd.DataFrame(corr_list, columns = [roi])
-        roi_dv_shuffle_l.append(corr_df)
-    
-    roi_dv_shuffle_df = pd.concat(roi_dv_shuffle_l, axis = 1)
+    # convert the dv & covariates into arrays, gender is dummy coded as gender_shuffle_Female
+    dv, age, gender = prepare_covariates(dv_df, dv_name, 'Female')
+    # stack the roi weights into a subjects x ROIs matrix
+    conn_mat = conn_df.iloc[[int(roi) for roi in roi_list]].to_numpy(dtype=float).T
+    # stack the shuffle index into a (ROIs x) shuffles x subjects array, the generated shuffles are passed to the engine block by block
+    idx = stack_index(idx_dic, roi_list, shuffle_time)
+    # calculate the partial correlation between the roi weights of all ROIs and the shuffled dv controlling for the shuffled age & gender
+    roi_dv_shuffle = pcorr_shuffle(conn_mat, dv, age, gender, idx, workers=workers)
+    roi_dv_shuffle_df = pd.DataFrame(roi_dv_shuffle, columns = roi_list)
 
     return roi_dv_shuffle_df
 
+def conn_corr_shuffle_store(dv_df, dv_name, conn_df, idx_dic, shuffle_time, null_file, params=None, workers=1, force=False):
+    '''
+    (DataFrame, str, DataFrame, dict, int, str, dict, int, bool) -> None
+    This function calculates the same shuffled partial correlations as conn_corr_shuffle, but appends each tile of ROIs x shuffles
+    to a null store (null_file) as soon as it is computed. A relaunch with the same arguments only computes the tiles that
+    the killed run had not completed, unless force is set
+    '''
+    # initiate parameters
+    roi_list = [str(x) for x in range(0, 100)]
+    # convert the dv & covariates into arrays, gender is dummy coded as gender_shuffle_Female
+    dv, age, gender = prepare_covariates(dv_df, dv_name, 'Female')
+    # stack the roi weights into a subjects x ROIs matrix
+    conn_mat = conn_df.iloc[[int(roi) for roi in roi_list]].to_numpy(dtype=float).T
+    idx = stack_index(idx_dic, roi_list, shuffle_time)
+    # a killed run is only resumed when it used the same connectivity, dv & covariates and the same shuffles,
+    # the generated shuffles are defined by their seed and the stored ones are hashed
+    index = {'seed': idx.seed, 'features': idx.features, 'shape': list(idx.shape)} if hasattr(idx, 'block') else array_key(idx, None)
+    params = dict(params or {}, data=array_key(np.column_stack([conn_mat, dv, age, gender]), None), index=index)
+
+    # resume from the tiles completed by a killed run with the same arguments, the index may hold fewer shuffles than shuffle_time
+    if force:
+        create_null_store(null_file, roi_list, idx.shape[-2], params)
+        done = set()
+    else:
+        done = resume_null_store(null_file, roi_list, idx.shape[-2], params)
+        if done:
+            print('resume', null_file, 'with', len(done), 'completed tiles', flush=True)
+    with open(null_file, 'ab') as f:
+        for features, shuffles, r in iter_pcorr_tiles(conn_mat, dv, age, gender, idx, workers=workers, skip=done):
+            append_null_tile(f, features, shuffles, r, np.float32)
+
+def conn_corr_adaptive(dv_df, dv_name, conn_df, idx_dic, shuffle_time, n_exceed):
+    '''
+    (DataFrame, str, DataFrame, dict, int, int) -> DataFrame
+    This function tests the partial correlation between the roi weights of all ROIs and the dv with adaptive shuffles:
+    the shuffles of a ROI stop once n_exceed shuffled |r| reach its observed |r| (see adaptive_pcorr_shuffle).
+    Each row of the output represents a ROI, with the observed coefficient, the permutation p-value, the number of shuffles used
+    and the parametric p-value
+    '''
+    # initiate parameters
+    roi_list = [str(x) for x in range(0, 100)]
+    # convert the dv & covariates into arrays, gender is dummy coded as gender_shuffle_Female
+    dv, age, gender = prepare_covariates(dv_df, dv_name, 'Female')
+    # stack the roi weights into a subjects x ROIs matrix
+    conn_mat = conn_df.iloc[[int(roi) for roi in roi_list]].to_numpy(dtype=float).T
+    idx = stack_index(idx_dic, roi_list, shuffle_time)
+    r, p_value, n_shuffle, _ = adaptive_pcorr_shuffle(conn_mat, dv, age, gender, idx, n_exceed)
+
+    return pd.DataFrame({'roi': roi_list, 'r': r, 'p_value': p_value, 'n_shuffle': n_shuffle, 'p_analytic': analytic_pvalue(r, len(dv))})
+
+def conn_corr_max_stat(dv_df, dv_name, conn_df, idx_dic, shuffle_time, workers=1):
+    '''
+    (DataFrame, str, DataFrame, dict, int, int) -> DataFrame, DataFrame
+    This function tests the partial correlation between the roi weights of all ROIs and the dv against the shuffled dv,
+    keeping only the exceedance count of each ROI and the maximum |r| of each shuffle (see pcorr_max_stat).
+    Returns the p-values (one row per ROI: the observed coefficient, the uncorrected, FDR & FWE p-values) and the maximum |r| of each shuffle
+    '''
+    # initiate parameters
+    roi_list = [str(x) for x in range(0, 100)]
+    # convert the dv & covariates into arrays, gender is dummy coded as gender_shuffle_Female
+    dv, age, gender = prepare_covariates(dv_df, dv_name, 'Female')
+    # stack the roi weights into a subjects x ROIs matrix
+    conn_mat = conn_df.iloc[[int(roi) for roi in roi_list]].to_numpy(dtype=float).T
+    idx = stack_index(idx_dic, roi_list, shuffle_time)
+    r, p_value, p_fdr, p_fwe, max_null = pcorr_max_stat(conn_mat, dv, age, gender, idx, workers=workers)
+
+    return pd.DataFrame({'roi': roi_list, 'r': r, 'p_value': p_value, 'p_fdr': p_fdr, 'p_fwe': p_fwe}), pd.DataFrame({'max_r': max_null})
+
 # load the physio data set
 base_dv = pd.read_csv(os.path.join(base_dir, 'dv_data', 'outputs', 'sub_data_baseline_w_clean.csv'))
 
 # extract the included subject list 
 include_sid = list(base_dv['SID'])
 
-# extract the physio dv as a lsit
-dv_df = base_dv[[dv_name, 'age', 'gender']]
+conn_df = extract_connectivity('normstrength', acq_id)
 
-# extract the index
-idx_dic = load_index(idx_type)
+# extract the physio dv of the subjects with connectivity, in the column order of conn_df
+dv_df = base_dv.set_index('SID').loc[list(conn_df.columns), [dv_name, 'age', 'gender']]
+if len(dv_df) != conn_df.shape[1]:
+    raise ValueError(f'{len(dv_df)} dv rows for the {conn_df.shape[1]} subjects with connectivity')
 
-conn_df = extract_connectivity('normstrength', acq_id)
+# extract the index, or generate the shuffles of each ROI from the seed
+if seed is not None:
+    idx_dic = ShuffleGenerator(seed, feature_ids(idx_type), shuffle_time, len(dv_df))
+else:
+    idx_dic = load_index(idx_type)
+if shared_index:
+    # every ROI uses the shuffles of ROI 0, so each block of shuffles is one matrix multiply for all ROIs
+    idx_dic = {'shared': idx_dic['0']}
+# the shuffles permute the rows of the subjects with connectivity
+if index_subjects(idx_dic) != len(dv_df):
+    raise ValueError(f'the shuffle index permutes {index_subjects(idx_dic)} subjects, {len(dv_df)} subjects have connectivity')
 
-# boostrap the correlation between the brain data and the physio data 
-brain_physio_boost = conn_corr_shuffle(dv_df, dv_name, conn_df, idx_dic, shuffle_time)
+# test each ROI with adaptive shuffles or against the maximum statistic, or boostrap the correlation between the brain data and the physio data
+if adaptive is not None:
+    brain_physio_boost = conn_corr_adaptive(dv_df, dv_name, conn_df, idx_dic, shuffle_time, adaptive)
+    output_file = os.path.join(output_dir, f'{dv_name}_acq{acq_id}_{idx_type}_adaptive.csv')
+elif max_stat:
+    brain_physio_boost, max_null_df = conn_corr_max_stat(dv_df, dv_name, conn_df, idx_dic, shuffle_time, workers)
+    output_file = os.path.join(output_dir, f'{dv_name}_acq{acq_id}_{idx_type}_pvalue.csv')
+    max_null_df.to_csv(os.path.join(output_dir, f'{dv_name}_acq{acq_id}_{idx_type}_maxnull.csv'), index=False, header=True)
+elif output_format != 'csv':
+    # write the shuffled coefficients to the null store tile by tile, and export the csv from it when both are requested
+    brain_physio_boost = None
+    output_file = os.path.join(output_dir, f'{dv_name}_acq{acq_id}_{idx_type}_boost.csv')
+    params = {'dv': dv_name, 'acq': acq_id, 'idx_type': idx_type, 'shuffle_time': shuffle_time, 'seed': seed, 'shared_index': shared_index}
+    conn_corr_shuffle_store(dv_df, dv_name, conn_df, idx_dic, shuffle_time, null_store_path(output_file), params, workers, force)
+    if output_format == 'both':
+        export_null_csv(null_store_path(output_file), output_file)
+    else:
+        output_file = null_store_path(output_file)
+else:
+    brain_physio_boost = conn_corr_shuffle(dv_df, dv_name, conn_df, idx_dic, shuffle_time, workers)
+    output_file = os.path.join(output_dir, f'{dv_name}_acq{acq_id}_{idx_type}_boost.csv')
 
-brain_physio_boost.to_csv(os.path.join(output_dir, f'{dv_name}_acq{acq_id}_{idx_type}_boost.csv'),index=False, header=True)
+if brain_physio_boost is not None:
+    brain_physio_boost.to_csv(output_file, index=False, header=True)
 
-print('analysis completed. The result is saved to', os.path.join(output_dir, f'{dv_name}_acq{acq_id}_{idx_type}_boost.csv'))
+print('analysis completed. The result is saved to', output_file)
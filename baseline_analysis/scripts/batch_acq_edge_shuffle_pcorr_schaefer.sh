@@ -1,7 +1,7 @@
 #!/bin/bash
 #
-# This batch file calls on the subject list (which contains subjectID, waveID and acquisitionID)
-# and run the job_ppc_post.sh for each acq. 
+# This batch file splits the edges into balanced shards of the sorted edge IDs (plan_edge_shards_schaefer.py)
+# and runs job_acq_edge_shuffle_pcorr_schaefer.sh for each shard as a task of a SLURM array.
 # It saves the output and error files in specified directories.
 
 # Set the environment
@@ -10,29 +10,39 @@ conda activate dev_rs_env
 
 # Set the directories
 output_dir=/home/kcheung3/sanlab/DEV_RS/baseline_analysis/outputs/
-
-# Set index list
-idx_list=`cat /home/kcheung3/sanlab/DEV_RS/baseline_analysis/idx_list_schaefer.txt`
+script_dir=/home/kcheung3/sanlab/DEV_RS/baseline_analysis/scripts
+shard_dir=/home/kcheung3/sanlab/DEV_RS/baseline_analysis/edge_shards_schaefer
 
 # Set analysis parameter
 acq_id=2
 dv=Body_fat_s1
+shuffle_time=1000
+
+# Set the seconds per edge per shuffle of one process, measured on a compute node with plan_edge_shards_schaefer.py
+# (it prints the measured cost when --unit_cost is not given). A fixed cost keeps the plan the same on every submission
+unit_cost=0.00002
+
+# Set the GB of memory of each job, the planner splits the edges so the shuffle index of a shard fits in it
+mem_gb=2
+
+# Plan the shards once per analysis, a resubmission keeps the shard list so every range and its null store stay the same.
+# At this cost the shards take minutes, the number of shards is set by the memory of the jobs (the planner prints the
+# hours & GB of a shard), and the 20 hours target stays below the 23 hours limit
+mkdir -p "${shard_dir}"
+shard_file="${shard_dir}"/"${dv}"_acq"${acq_id}"_"${shuffle_time}"_shards.txt
+python "${script_dir}"/plan_edge_shards_schaefer.py --shard_file "${shard_file}" --shuffle_time ${shuffle_time} --unit_cost ${unit_cost} --target_time 20 --workers 2 --mem ${mem_gb} || exit 1
+n_shard=`grep -c , "${shard_file}"`
 
-# Loop through subjects
-for idx in $idx_list; do
-    idx_min=`echo $idx | awk -F ',' '{print $1}'`
-	idx_max=`echo $idx | awk -F ',' '{print $2}'`
-    
-    echo $idx_min, $idx_max
-    
-    sbatch --export ALL,idx_min=${idx_min},idx_max=${idx_max},acq_id=${acq_id},dv=${dv} \
-           --job-name edge_boostrap \
-		   --partition=ctn \
-		   --cpus-per-task=2 \
-		   --mem=2G \
-		   --time=23:00:00 \
-		   -o "${output_dir}"/"${dv}"_acq"${acq_id}"_"${idx_min}"_"${idx_max}"_schaefer.txt \
-		   -e "${output_dir}"/"${dv}"_acq"${acq_id}"_"${idx_min}"_"${idx_max}"_schaefer..txt \
-		   --account=sanlab \
-		   /home/kcheung3/sanlab/DEV_RS/baseline_analysis/scripts/job_acq_edge_shuffle_pcorr_schaefer.sh
-done
\ No newline at end of file
+# Run each shard as a task of the array, the same shards run locally with plan_edge_shards_schaefer.py --run_local
+sbatch --export ALL,shard_file=${shard_file},acq_id=${acq_id},dv=${dv},shuffle_time=${shuffle_time} \
+       --array=0-$((n_shard - 1)) \
+       --job-name edge_boostrap \
+	   --partition=ctn \
+	   --cpus-per-task=2 \
+	   --mem=${mem_gb}G \
+	   --time=23:00:00 \
+	   --requeue \
+	   -o "${output_dir}"/"${dv}"_acq"${acq_id}"_shard%a_schaefer.txt \
+	   -e "${output_dir}"/"${dv}"_acq"${acq_id}"_shard%a_schaefer_error.txt \
+	   --account=sanlab \
+	   "${script_dir}"/job_acq_edge_shuffle_pcorr_schaefer.sh
@@ -0,0 +1,97 @@
+import os
+import json
+import hashlib
+import numpy as np
+
+def file_hash(file, memo=None, chunk_size=1 << 20):
+    '''
+    (str, dict, int) -> str
+    This function returns the sha256 of a file, read in chunks so a 4D NIfTI is never held in memory.
+    With memo (a dictionary of earlier hashes keyed by path), the file is only read again when its size or modification time changed
+    '''
+    stat = os.stat(file)
+    if memo is not None:
+        entry = memo.get(file)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime'] == stat.st_mtime_ns:
+            return entry['sha256']
+
+    sha = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    if memo is not None:
+        memo[file] = {'size': stat.st_size, 'mtime': stat.st_mtime_ns, 'sha256': sha.hexdigest()}
+
+    return sha.hexdigest()
+
+def cache_key(files, params, memo=None):
+    '''
+    (list, dict, dict) -> str
+    This function combines the hashes of the input files (in the given order) and the processing parameters into one key
+    '''
+    key = {
+        'files': [file_hash(file, memo) for file in files],
+        'params': params
+    }
+
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def array_hash(array, chunk_size=1 << 24):
+    '''
+    (array, int) -> str
+    This function returns the sha256 of the values of an array in C order (the same as hashing array.tobytes()), without copying it.
+    A contiguous array is hashed in place, another array (e.g. a slice of a memmap) chunk_size bytes of its first axis at a time
+    '''
+    array = np.asarray(array)
+    sha = hashlib.sha256()
+    if array.flags.c_contiguous:
+        sha.update(array.reshape(-1).view(np.uint8))
+    else:
+        step = max(1, chunk_size // max(array[:1].nbytes, 1))
+        for start in range(0, len(array), step):
+            sha.update(np.ascontiguousarray(array[start:start + step]).reshape(-1).view(np.uint8))
+
+    return sha.hexdigest()
+
+def array_key(array, params):
+    '''
+    (array, dict) -> str
+    This function combines the hash of an array (its values, dtype & shape) and the processing parameters into one key,
+    as cache_key does for input files
+    '''
+    array = np.asarray(array)
+    key = {
+        'array': array_hash(array),
+        'dtype': str(array.dtype),
+        'shape': list(array.shape),
+        'params': params
+    }
+
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+def load_cache(cache_file):
+    '''
+    (str) -> dict
+    This function loads the cache manifest, which holds the key of each processed subject ('subjects') and the memo of file hashes ('files').
+    A missing or unreadable manifest gives an empty cache, so every subject is processed
+    '''
+    try:
+        with open(cache_file, 'r') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+    cache.setdefault('subjects', {})
+    cache.setdefault('files', {})
+
+    return cache
+
+def save_cache(cache_file, cache):
+    '''
+    (str, dict) -> None
+    This function writes the cache manifest to a temporary file first and then replaces the old manifest,
+    so an interrupted run never leaves a partial manifest behind
+    '''
+    tmp_file = cache_file + '.tmp'
+    with open(tmp_file, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+    os.replace(tmp_file, cache_file)
@@ -3,7 +3,8 @@ import glob
 import re
 import argparse
 import pandas as pd
-import pingouin as pg
+from permutation_fun import prepare_covariates, pcorr_shuffle
+from shuffle_index_fun import ShuffleGenerator, feature_ids, stack_index, index_store_path, load_index_store
 
 # set input parameters
 parser = argparse.ArgumentParser(description='boostrap correlation')
@@ -17,21 +18,46 @@ parser.add_argument(
     required=True,
     action='store',
     help='graph metric name')
+parser.add_argument(
+    '--seed',
+    action='store',
+    type=int,
+    help='generate the shuffles on the fly from this seed instead of importing the shuffle index')
+parser.add_argument(
+    '--shuffle_time',
+    action='store',
+    type=int,
+    default=1000,
+    help='the number of shuffles')
+parser.add_argument(
+    '--workers',
+    action='store',
+    type=int,
+    default=1,
+    help='the number of processes that share the shuffles')
 args = parser.parse_args()
 
 # set study parameter
 base_dir = '/home/kcheung3/sanlab/DEV_RS'
 output_dir = os.path.join(base_dir, 'baseline_analysis', 'graph_shuffle_outputs')
-shuffle_time = 1000
+shuffle_time = args.shuffle_time
+seed = args.seed
+workers = args.workers
 idx_type = 'roi'
 dv_name = args.dv
 metric_name = args.metric_name
 
 def load_index(index_type):
     '''
-    (str) -> dict, list
-    This function imports the index for each shuffle for each ROI/edges
+    (str) -> dict
+    This function imports the index for each shuffle for each ROI/edges. The binary shuffle index is memory-mapped when it exists,
+    otherwise the csv files are imported
     '''
+    # use the binary shuffle index if it has been converted (shuffle_index_Schaefer.py --mode convert)
+    store_file = index_store_path(os.path.join(base_dir, 'baseline_analysis', 'shuffle_index'), index_type)
+    if os.path.exists(store_file):
+        return load_index_store(store_file)
+
     # set the file directory parameters
     idx_dir = os.path.join(base_dir, 'baseline_analysis', 'shuffle_index', f'{index_type}_shuffle_schaefer')
     idx_fileNames = glob.glob(os.path.join(idx_dir, '*.csv'))
@@ -45,40 +71,24 @@ def load_index(index_type):
     
     return idx_dict
 
-def conn_corr_shuffle(dv_df, dv_name, conn_df, idx_dic, shuffle_time):
+def conn_corr_shuffle(dv_df, dv_name, conn_df, idx_dic, shuffle_time, workers=1):
+    '''
+    (DataFrame, str, DataFrame, dict, int, int) -> DataFrame
+    This function calculates the partial correlation between the graph metric of all ROIs and the shuffled dv for each shuffle.
+    The shuffles are distributed over the given number of worker processes.
+    Each row of the output represents a shuffle and each column represents a ROI
+    '''
     # initiate parameters
     roi_list = [str(x) for x in range(0, 100)]
-    roi_dv_shuffle_l = []
-    # loop through each ROI and calculate correlations
-    for roi in roi_list:
-        # extract shuffle index
-        idx_df = idx_dic[roi]
-        # initiate a list
-        corr_list = []
-        # extract the centrality
-        conn_list = conn_df.iloc[int(roi)]
-        for i in range(shuffle_time): 
-            # re-order the dv & cov: 
-            dv_shuffle = dv_df[dv_name][idx_df.iloc[i]].values
-            age_shuffle = dv_df['age'][idx_df.iloc[i]].values
-            gender_shuffle = dv_df['gender'][idx_df.iloc[i]].values
-            # generate a dataframe with all shuffled data
-            pcorr_df = pd.DataFrame(
-                {"conn_list" : conn_list,
-                "age_shuffle": age_shuffle,
-                "gender_shuffle": gender_shuffle, 
-                "dv_shuffle": dv_shuffle}
-            )
-            # dummy code the gender variable
-            pcorr_df_recode = pd.get_dummies(pcorr_df)
-            # calculate the partial correlation between roi weights and the dv controlling for age
-            pcorr= pg.partial_corr(data= pcorr_df_recode, x='conn_list', y='dv_shuffle', covar=['age_shuffle', 'gender_shuffle_Male'], method='spearman').iloc[0,1]
-            # append the partial coefficient to the output list 
-            corr_list.append(pcorr)
-        corr_df = pd.DataFrame(corr_list, columns = [roi])
-        roi_dv_shuffle_l.append(corr_df)
-    
-    roi_dv_shuffle_df = pd.concat(roi_dv_shuffle_l, axis = 1)
+    # convert the dv & covariates into arrays, gender is dummy coded as gender_shuffle_Male
+    dv, age, gender = prepare_covariates(dv_df, dv_name, 'Male')
+    # stack the graph metric into a subjects x ROIs matrix
+    conn_mat = conn_df.iloc[[int(roi) for roi in roi_list]].to_numpy(dtype=float).T
+    # stack the shuffle index into a (ROIs x) shuffles x subjects array, the generated shuffles are passed to the engine block by block
+    idx = stack_index(idx_dic, roi_list, shuffle_time)
+    # calculate the partial correlation between the graph metric of all ROIs and the shuffled dv controlling for the shuffled age & gender
+    roi_dv_shuffle = pcorr_shuffle(conn_mat, dv, age, gender, idx, workers=workers)
+    roi_dv_shuffle_df = pd.DataFrame(roi_dv_shuffle, columns = roi_list)
 
     return roi_dv_shuffle_df
 
@@ -91,15 +101,18 @@ include_sid = list(base_dv['SID'])
 # extract the physio dv as a lsit
 dv_df = base_dv[[dv_name, 'age', 'gender']]
 
-# extract the index
-idx_dic = load_index(idx_type)
+# extract the index, or generate the shuffles of each ROI from the seed
+if seed is not None:
+    idx_dic = ShuffleGenerator(seed, feature_ids(idx_type), shuffle_time, len(dv_df))
+else:
+    idx_dic = load_index(idx_type)
 
 # extract graph metric dataframe
 metric_dir = os.path.join(base_dir, 'baseline_analysis', 'graph_outputs')
 metric_df = pd.read_csv(os.path.join(metric_dir, f'{metric_name}_df_concat.csv'), sep = ',')
 
 # boostrap the correlation between the brain data and the physio data 
-brain_physio_boost = conn_corr_shuffle(dv_df, dv_name, metric_df, idx_dic, shuffle_time)
+brain_physio_boost = conn_corr_shuffle(dv_df, dv_name, metric_df, idx_dic, shuffle_time, workers)
 
 brain_physio_boost.to_csv(os.path.join(output_dir, f'{metric_name}_{dv_name}_concat_boost.csv'),index=False, header=True)
 
@@ -5,7 +5,8 @@ import argparse
 import numpy as np
 import pandas as pd
 import functools
-import pingouin as pg
+from permutation_fun import prepare_covariates, pcorr_shuffle
+from shuffle_index_fun import ShuffleGenerator, feature_ids, index_store_path, load_index_store
 
 # set input parameters
 parser = argparse.ArgumentParser(description='boostrap correlation')
@@ -15,20 +16,45 @@ parser.add_argument(
     action='store',
     help='dv name')
 
+parser.add_argument(
+    '--seed',
+    action='store',
+    type=int,
+    help='generate the shuffles on the fly from this seed instead of importing the shuffle index')
+parser.add_argument(
+    '--shuffle_time',
+    action='store',
+    type=int,
+    default=1000,
+    help='the number of shuffles')
+parser.add_argument(
+    '--workers',
+    action='store',
+    type=int,
+    default=1,
+    help='the number of processes that share the shuffles')
 args = parser.parse_args()
 
 # set study parameter
 base_dir = '/home/kcheung3/sanlab/DEV_RS'
 output_dir = os.path.join(base_dir, 'baseline_analysis', 'graph_shuffle_outputs')
-shuffle_time = 1000
+shuffle_time = args.shuffle_time
+seed = args.seed
+workers = args.workers
 idx_type = 'roi'
 dv_name = args.dv
 
 def load_index(index_type):
     '''
-    (str) -> dict, list
-    This function imports the index for each shuffle for each ROI/edges
+    (str) -> dict
+    This function imports the index for each shuffle for each ROI/edges. The binary shuffle index is memory-mapped when it exists,
+    otherwise the csv files are imported
     '''
+    # use the binary shuffle index if it has been converted (shuffle_index_Schaefer.py --mode convert)
+    store_file = index_store_path(os.path.join(base_dir, 'baseline_analysis', 'shuffle_index'), index_type)
+    if os.path.exists(store_file):
+        return load_index_store(store_file)
+
     # set the file directory parameters
     idx_dir = os.path.join(base_dir, 'baseline_analysis', 'shuffle_index', f'{index_type}_shuffle_schaefer')
     idx_fileNames = glob.glob(os.path.join(idx_dir, '*.csv'))
@@ -42,37 +68,20 @@ def load_index(index_type):
     
     return idx_dict
 
-def other_metric_shuffle(dv_df, dv_name, metric_df, idx_df, shuffle_time):
-    # initiate parameters
-    metric_dv_shuffle_l = []
-    # loop through each ROI and calculate correlations
-    for (columnName, columnData) in metric_df.iloc[:,1:4].iteritems():
-        # initiate a list
-        corr_list = []
-        # extract the graph metric
-        conn_list = columnData.values
-        for i in range(shuffle_time): 
-            # re-order the dv & cov: 
-            dv_shuffle = dv_df[dv_name][idx_df.iloc[i]].values
-            age_shuffle = dv_df['age'][idx_df.iloc[i]].values
-            gender_shuffle = dv_df['gender'][idx_df.iloc[i]].values
-            # generate a dataframe with all shuffled data
-            pcorr_df = pd.DataFrame(
-                {"conn_list" : conn_list,
-                "age_shuffle": age_shuffle,
-                "gender_shuffle": gender_shuffle, 
-                "dv_shuffle": dv_shuffle}
-            )
-            # dummy code the gender variable
-            pcorr_df_recode = pd.get_dummies(pcorr_df)
-            # calculate the partial correlation between roi weights and the dv controlling for age
-            pcorr= pg.partial_corr(data= pcorr_df_recode, x='conn_list', y='dv_shuffle', covar=['age_shuffle', 'gender_shuffle_Female'], method='spearman').iloc[0,1]
-            # append the partial coefficient to the output list 
-            corr_list.append(pcorr)
-        corr_df = pd.DataFrame(corr_list, columns = [columnName])
-        metric_dv_shuffle_l.append(corr_df)
-    
-    metric_dv_shuffle_df = pd.concat(metric_dv_shuffle_l, axis = 1)
+def other_metric_shuffle(dv_df, dv_name, metric_df, idx_df, shuffle_time, workers=1):
+    '''
+    (DataFrame, str, DataFrame, DataFrame, int, int) -> DataFrame
+    This function calculates the partial correlation between each global graph metric and the shuffled dv for each shuffle.
+    All metrics share the same shuffle index (idx_df), and the shuffles are distributed over the given number of worker processes.
+    Each row of the output represents a shuffle and each column represents a metric
+    '''
+    # convert the dv & covariates into arrays, gender is dummy coded as gender_shuffle_Female
+    dv, age, gender = prepare_covariates(dv_df, dv_name, 'Female')
+    # extract the graph metrics as a subjects x metrics matrix
+    metric_mat = metric_df.iloc[:,1:4].to_numpy(dtype=float)
+    # calculate the partial correlation between the graph metrics and the shuffled dv controlling for the shuffled age & gender
+    metric_dv_shuffle = pcorr_shuffle(metric_mat, dv, age, gender, np.asarray(idx_df[:shuffle_time]), workers=workers)
+    metric_dv_shuffle_df = pd.DataFrame(metric_dv_shuffle, columns = metric_df.columns[1:4])
 
     return metric_dv_shuffle_df
 
@@ -85,8 +94,11 @@ include_sid = list(base_dv['SID'])
 # extract the physio dv as a lsit
 dv_df = base_dv[[dv_name, 'age', 'gender']]
 
-# extract the index
-idx_dic = load_index(idx_type)
+# extract the index, or generate the shuffles of each ROI from the seed
+if seed is not None:
+    idx_dic = ShuffleGenerator(seed, feature_ids(idx_type), shuffle_time, len(dv_df))
+else:
+    idx_dic = load_index(idx_type)
 
 # use the shuffle index fot ROI 0
 idx_df = idx_dic['0']
@@ -96,7 +108,7 @@ metric_dir = os.path.join(base_dir, 'baseline_analysis', 'graph_outputs')
 metric_df = pd.read_csv(os.path.join(metric_dir, f'other_metric_df_concat.csv'), sep = ',')
 
 # shuffle the partial correlation between each graph metric and the dv
-metric_dv_shuffle_df = other_metric_shuffle(dv_df, dv_name, metric_df, idx_df, shuffle_time)
+metric_dv_shuffle_df = other_metric_shuffle(dv_df, dv_name, metric_df, idx_df, shuffle_time, workers)
 
 metric_dv_shuffle_df.to_csv(os.path.join(output_dir, f'other_metric_{dv_name}_concat_boost.csv'),index=False, header=True)
 
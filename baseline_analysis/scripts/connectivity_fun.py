@@ -0,0 +1,172 @@
+import os
+import re
+import glob
+import warnings
+import numpy as np
+import pandas as pd
+import tables
+
+def edge_index(n_roi):
+    '''
+    (int) -> DataFrame
+    This function returns the edge lookup of the upper triangle of a n_roi x n_roi matrix. Each row represents an edge (in the order of
+    np.triu_indices, which is also the row order of df.stack()[mask]) and the columns node_1 & node_2 are the two nodes of the edge
+    '''
+    node_1, node_2 = np.triu_indices(n_roi, k=1)
+
+    return pd.DataFrame({'node_1': node_1, 'node_2': node_2})
+
+def corr_file_sub_id(file):
+    '''
+    (str) -> str
+    This function extracts the subject ID from a correlation matrix file name ({sub_id}_{acq_id}_corr.csv)
+    '''
+    return re.split('/|_', file)[len(re.split('/|_', file))-3]
+
+def conn_file_sub_id(file):
+    '''
+    (str) -> str
+    This function extracts the subject ID from a connectivity file name ({sub_id}_{acq_id}_{conn_type}_full.csv)
+    '''
+    return re.split('/|_', file)[len(re.split('/|_', file))-4]
+
+def load_edge_matrix(corr_fileNames, include_sid, dtype=np.float32):
+    '''
+    (list, list, dtype) -> array, list, DataFrame
+    This function imports the correlation matrix of each included subject once and writes its upper triangle directly into a preallocated
+    subjects x edges array. Subjects keep the order of corr_fileNames.
+    Returns the array, the subject IDs of its rows and the edge lookup (node_1, node_2) of its columns
+    '''
+    # select the included subjects before allocating the output
+    sub_files = [(corr_file_sub_id(file), file) for file in corr_fileNames]
+    sub_files = [(sub_id, file) for sub_id, file in sub_files if sub_id in include_sid]
+
+    if not sub_files:
+        raise ValueError('no correlation matrix of the included subjects was found')
+
+    edge_mat = None
+    for i, (sub_id, file) in enumerate(sub_files):
+        sub_corr = pd.read_csv(file, sep=',', header=None).to_numpy()
+        if edge_mat is None:
+            n_roi = sub_corr.shape[0]
+            triu = np.triu_indices(n_roi, k=1)
+            edge_mat = np.empty((len(sub_files), len(triu[0])), dtype=dtype)
+        edge_mat[i] = sub_corr[triu]
+
+    return edge_mat, [sub_id for sub_id, _ in sub_files], edge_index(n_roi)
+
+def align_subjects(sub_ids, include_sid):
+    '''
+    (list, list) -> list, list
+    This function matches the subjects of the connectivity rows (sub_ids) with the included subjects (include_sid, the row order of the dv).
+    Returns the positions that put the rows in the order of include_sid and the included subjects that have connectivity.
+    Raises an error when a row has no included subject, or a subject appears twice
+    '''
+    row = {sub_id: i for i, sub_id in enumerate(sub_ids)}
+    keep_sid = [sub_id for sub_id in include_sid if sub_id in row]
+    if len(row) != len(sub_ids) or len(keep_sid) != len(sub_ids):
+        raise ValueError(f'the {len(sub_ids)} connectivity rows do not match the {len(keep_sid)} included subjects that have connectivity')
+
+    return [row[sub_id] for sub_id in keep_sid], keep_sid
+
+def corr_cube_path(corr_root):
+    '''
+    (str) -> str
+    This function returns the path of the connectome cube, the HDF5 file that holds the correlation matrix of every subject
+    '''
+    return os.path.join(corr_root, 'baseline_acq_schaefer_corr.h5')
+
+def write_corr_cube(cube_file, acq_id, sub_id, sub_corr):
+    '''
+    (str, str, str, array) -> None
+    This function appends the correlation matrix of a subject to the cube of an acquisition (acq_id, e.g. 'concat').
+    The matrices are stored in a chunked, compressed array with one chunk per subject, keyed by the subject ID.
+    A subject that is already in the cube is overwritten
+    '''
+    with tables.open_file(cube_file, mode='a') as h5:
+        if f'/{acq_id}' not in h5:
+            # the acq IDs '1' & '2' are valid group names, they just cannot be used as python attributes
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', tables.NaturalNameWarning)
+                group = h5.create_group('/', acq_id)
+            h5.create_earray(group, 'corr', atom=tables.Float64Atom(), shape=(0,) + sub_corr.shape, chunkshape=(1,) + sub_corr.shape,
+                             filters=tables.Filters(complevel=5, complib='zlib', shuffle=True))
+            h5.create_earray(group, 'sub_id', atom=tables.StringAtom(itemsize=32), shape=(0,))
+        group = h5.get_node(f'/{acq_id}')
+        cube_sid = [sid.decode() for sid in group.sub_id.read()]
+
+        if sub_id in cube_sid:
+            group.corr[cube_sid.index(sub_id)] = sub_corr
+        else:
+            group.corr.append(sub_corr[np.newaxis])
+            group.sub_id.append(np.array([sub_id], dtype='S32'))
+
+def cube_sub_ids(cube_file, acq_id):
+    '''
+    (str, str) -> list
+    This function returns the subject IDs stored in the cube of an acquisition, an empty list when there is no such cube
+    '''
+    if not os.path.exists(cube_file):
+        return []
+    with tables.open_file(cube_file, mode='r') as h5:
+        if f'/{acq_id}' not in h5:
+            return []
+        return [sid.decode() for sid in h5.get_node(f'/{acq_id}/sub_id').read()]
+
+def acq_sub_ids(base_dir, idx_type, acq_id, conn_type='normstrength'):
+    '''
+    (str, str, str, str) -> list
+    This function returns the IDs of the subjects with connectivity of an acquisition, as read by the pcorr shuffle scripts: the subjects
+    of the connectome cube (or of the correlation csv files when the cube does not hold the acquisition) for edges, and of the
+    conn_type files for ROIs
+    '''
+    if idx_type == 'edge':
+        corr_root = os.path.join(base_dir, 'baseline_analysis', 'subject_correlation')
+        cube_sid = cube_sub_ids(corr_cube_path(corr_root), acq_id)
+        if cube_sid:
+            return cube_sid
+        return [corr_file_sub_id(file) for file in glob.glob(os.path.join(corr_root, 'baseline_acq_schaefer', f'*_{acq_id}_corr.csv'))]
+
+    conn_dir = os.path.join(base_dir, 'baseline_analysis', 'subject_connectivity_acq_Schaefer')
+    return [conn_file_sub_id(file) for file in glob.glob(os.path.join(conn_dir, f'*_{acq_id}_{conn_type}_full.csv'))]
+
+def read_corr_cube(cube_file, acq_id, sub_ids=None, edges=None, dtype=np.float64):
+    '''
+    (str, str, list, list, dtype) -> array, list
+    This function reads the correlation matrices of the subjects in sub_ids (all subjects when None, in the order of sub_ids) from the cube
+    of an acquisition. Only the chunks of the requested subjects are decompressed. With edges (upper-triangle edge IDs, see edge_index)
+    the output is a subjects x edges array, otherwise a subjects x ROIs x ROIs array.
+    Returns the array and the subject IDs of its rows
+    '''
+    with tables.open_file(cube_file, mode='r') as h5:
+        group = h5.get_node(f'/{acq_id}')
+        cube_sid = [sid.decode() for sid in group.sub_id.read()]
+        if sub_ids is None:
+            sub_ids = cube_sid
+        row = {sid: i for i, sid in enumerate(cube_sid)}
+        n_roi = group.corr.shape[1]
+
+        if edges is None:
+            out = np.empty((len(sub_ids), n_roi, n_roi), dtype=dtype)
+        else:
+            triu = np.triu_indices(n_roi, k=1)
+            edge_row, edge_col = triu[0][edges], triu[1][edges]
+            out = np.empty((len(sub_ids), len(edge_row)), dtype=dtype)
+        for i, sub_id in enumerate(sub_ids):
+            sub_corr = group.corr[row[sub_id]]
+            out[i] = sub_corr if edges is None else sub_corr[edge_row, edge_col]
+
+    return out, list(sub_ids)
+
+def read_edge_cube(cube_file, acq_id, sub_ids=None, dtype=np.float64):
+    '''
+    (str, str, list, dtype) -> array, list, DataFrame
+    This function reads the upper triangle of the correlation matrices of the subjects in sub_ids from the cube of an acquisition.
+    Returns the subjects x edges array, the subject IDs of its rows and the edge lookup of its columns, as load_edge_matrix
+    '''
+    with tables.open_file(cube_file, mode='r') as h5:
+        n_roi = h5.get_node(f'/{acq_id}/corr').shape[1]
+    edge_lookup = edge_index(n_roi)
+    edge_mat, sub_ids = read_corr_cube(cube_file, acq_id, sub_ids, edges=edge_lookup.index, dtype=dtype)
+
+    return edge_mat, sub_ids, edge_lookup
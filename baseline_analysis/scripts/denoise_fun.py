@@ -0,0 +1,137 @@
+import numpy as np
+
+def regress_residual(dm, data):
+    '''
+    (array, array) -> array
+    This function regresses the design matrix (time x regressors) out of the data (time x voxels/ROIs) and returns the residuals.
+    The betas are estimated with the pseudo-inverse of the design matrix, as Brain_Data.regress
+    '''
+    X = np.asarray(dm, dtype=float)
+    beta = np.linalg.pinv(X) @ data
+
+    return data - X @ beta
+
+def parcel_residual(roi_data, dm):
+    '''
+    (array, array) -> array
+    This function denoises the ROI time series (ROIs x time, as returned by extract_roi) instead of every voxel.
+    The GLM is linear, so the residual of the ROI mean equals the ROI mean of the voxel residuals.
+    Returns the denoised ROI time series (ROIs x time)
+    '''
+    return regress_residual(dm, np.asarray(roi_data, dtype=float).T).T
+
+def compare_corr(corr_a, corr_b, tol=1e-8):
+    '''
+    (array, array, float) -> float, bool
+    This function returns the largest absolute difference between two correlation matrices and whether it is within tol
+    '''
+    max_diff = float(np.max(np.abs(np.asarray(corr_a) - np.asarray(corr_b))))
+
+    return max_diff, max_diff <= tol
+
+# the confound columns of the fmriprep tsv used in the design matrix
+motion_columns = ['X', 'Y', 'Z', 'RotX', 'RotY', 'RotZ']
+tissue_columns = ['CSF', 'WhiteMatter']
+
+def zscore_columns(x):
+    '''
+    (array) -> array
+    This function z-scores each column (time x columns) with the sample standard deviation, as pandas' std()
+    '''
+    return (x - x.mean(axis=0)) / x.std(axis=0, ddof=1)
+
+def motion_24(motion):
+    '''
+    (array) -> array
+    This function expands the 6 motion parameters (time x 6) into the 24-parameter model: the z-scored parameters, their squares,
+    their first differences and the squared differences (the first difference is 0 at the first volume)
+    '''
+    z_mc = zscore_columns(motion)
+    diff = np.zeros_like(z_mc)
+    diff[1:] = np.diff(z_mc, axis=0)
+
+    return np.hstack([z_mc, z_mc ** 2, diff, diff ** 2])
+
+def signal_series(data, block_size=64):
+    '''
+    (array, int) -> array, array
+    This function computes the global signal (mean over voxels of each volume) and the frame difference (mean absolute difference between
+    consecutive volumes, a DVARS-like series of length time - 1) of the data (time x voxels), block_size volumes at a time so that
+    no copy of the data is made. Both are computed once and reused for every design matrix of the subject
+    '''
+    n_vol = data.shape[0]
+    global_signal = np.empty(n_vol)
+    frame_diff = np.empty(max(n_vol - 1, 0))
+    for t in range(0, n_vol, block_size):
+        stop = min(t + block_size, n_vol)
+        global_signal[t:stop] = data[t:stop].mean(axis=1, dtype=np.float64)
+        # include the last volume of the previous block in the difference
+        block = data[max(t - 1, 0):stop].astype(np.float64)
+        frame_diff[max(t - 1, 0):stop - 1] = np.abs(np.diff(block, axis=0)).mean(axis=1)
+
+    return global_signal, frame_diff
+
+def acq_series(global_signal, frame_diff, volumes):
+    '''
+    (array, array, slice) -> array, array
+    This function returns the global signal & frame difference of the volumes of one acq from the series of the concatenated acqs.
+    The frame difference across the boundary between the acqs is left out
+    '''
+    return global_signal[volumes], frame_diff[volumes.start:volumes.stop - 1]
+
+def outlier_volumes(series, cutoff):
+    '''
+    (array, float) -> array
+    This function returns the volumes above and then below mean +/- cutoff standard deviations of a series, as nltools' find_spikes
+    '''
+    upper = np.flatnonzero(series > np.mean(series) + np.std(series) * cutoff)
+    lower = np.flatnonzero(series < np.mean(series) - np.std(series) * cutoff)
+
+    return np.append(upper, lower)
+
+def spike_regressors(global_signal, frame_diff, global_cutoff=3, diff_cutoff=3):
+    '''
+    (array, array, float, float) -> array, list
+    This function builds one indicator regressor per outlier volume of the global signal and of the frame difference, in the order of
+    Brain_Data.find_spikes. As in find_spikes, a frame difference outlier i marks volume i (the first volume of the pair).
+    Returns the (time x spikes) array and the column names
+    '''
+    global_spikes = outlier_volumes(global_signal, global_cutoff) if global_cutoff else np.array([], dtype=int)
+    diff_spikes = outlier_volumes(frame_diff, diff_cutoff) if diff_cutoff else np.array([], dtype=int)
+
+    spikes = np.zeros((len(global_signal), len(global_spikes) + len(diff_spikes)))
+    spikes[np.append(global_spikes, diff_spikes).astype(int), np.arange(spikes.shape[1])] = 1
+    names = [f'global_spike{i + 1}' for i in range(len(global_spikes))] + [f'diff_spike{i + 1}' for i in range(len(diff_spikes))]
+
+    return spikes, names
+
+def poly_regressors(n_vol, order=2):
+    '''
+    (int, int) -> array
+    This function returns the Legendre polynomials up to order over the volumes (time x order + 1), as Design_Matrix.add_poly
+    with include_lower
+    '''
+    return np.polynomial.legendre.legvander(np.linspace(-1, 1, n_vol), order)
+
+def nuisance_design(confounds, global_signal, frame_diff, wm=True, spike_cutoff=3, poly_order=2):
+    '''
+    (DataFrame, array, array, bool, float, int) -> array, list
+    This function builds the nuisance design matrix of one acq or of the concatenated acqs in one preallocated array: the z-scored
+    CSF (and white matter) signals, the 24-parameter motion model, the spike regressors and the polynomial drifts, in the column
+    order of make_design_matrix. The global signal & frame difference are the cached series of the same volumes (see signal_series).
+    Returns the (time x regressors) array and the column names
+    '''
+    tissue = tissue_columns if wm else tissue_columns[:1]
+    spikes, spike_names = spike_regressors(global_signal, frame_diff, spike_cutoff, spike_cutoff)
+    n_vol = len(confounds)
+    columns = (tissue + motion_columns + [f'{col}^2' for col in motion_columns] + [f'{col}_diff' for col in motion_columns]
+               + [f'{col}_diff^2' for col in motion_columns] + spike_names + [f'poly_{i}' for i in range(poly_order + 1)])
+
+    dm = np.empty((n_vol, len(columns)))
+    col = 0
+    for block in [zscore_columns(confounds[tissue].to_numpy(dtype=float)), motion_24(confounds[motion_columns].to_numpy(dtype=float)),
+                  spikes, poly_regressors(n_vol, poly_order)]:
+        dm[:, col:col + block.shape[1]] = block
+        col += block.shape[1]
+
+    return dm, columns
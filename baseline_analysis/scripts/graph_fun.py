@@ -0,0 +1,498 @@
+import os
+import warnings
+import numpy as np
+import pandas as pd
+import tables
+import networkx as nx
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.integrate import trapezoid
+
+# the metrics of each node & of the whole graph, in the order of graph_metrics
+node_metrics = ['degree_centrality', 'betweenness_centrality', 'closeness_centrality', 'cluster_coefficients']
+graph_level_metrics = ['global_efficiency', 'local_efficiency', 'average_coefficients']
+weighted_node_metrics = ['strength', 'normalized_strength', 'weighted_clustering', 'nodal_efficiency']
+weighted_graph_metrics = ['weighted_efficiency', 'average_weighted_clustering']
+
+def edge_thresholds(edge_mat, percentiles):
+    '''
+    (array, list) -> array
+    This function computes every percentile of the edge weights of every subject (subjects x edges) in one np.percentile call.
+    Returns an array of subjects x percentiles
+    '''
+    return np.percentile(edge_mat, percentiles, axis=-1).T
+
+def threshold_table(edge_mat, percentiles, sub_ids):
+    '''
+    (array, list, list) -> DataFrame
+    This function returns the edge coefficient of each percentile of each subject, one row per subject & percentile
+    (columns edge_coefficient, percentile & sub_id)
+    '''
+    thresholds = edge_thresholds(edge_mat, percentiles)
+
+    return pd.DataFrame(
+        {
+            'edge_coefficient': thresholds.ravel(),
+            'percentile': np.tile(percentiles, len(sub_ids)),
+            'sub_id': np.repeat(sub_ids, len(percentiles))
+        }
+    )
+
+def percentile_adjacency(edge_mat, threshold):
+    '''
+    (array, array) -> array
+    This function binarizes the edge weights (subjects x edges, or edges) at the threshold of each subject: an edge is kept when its
+    weight is at least the threshold and not zero, as Adjacency.threshold(upper=threshold, binarize=True)
+    '''
+    threshold = np.asarray(threshold)[..., np.newaxis]
+
+    return (edge_mat >= threshold) & (edge_mat != 0)
+
+def proportional_adjacency(edge_mat, density):
+    '''
+    (array, float) -> array
+    This function keeps the strongest edges of each subject (subjects x edges, or edges) so that every graph has the same density
+    (the proportion of edges kept). The top edges are selected with a partition instead of a sort
+    '''
+    n_edge = edge_mat.shape[-1]
+    n_keep = int(round(density * n_edge))
+    adjacency = np.zeros(edge_mat.shape, dtype=bool)
+    if n_keep > 0:
+        top = np.argpartition(edge_mat, n_edge - n_keep, axis=-1)[..., n_edge - n_keep:]
+        np.put_along_axis(adjacency, top, True, axis=-1)
+
+    return adjacency
+
+def edge_to_matrix(edges, n_roi):
+    '''
+    (array, int) -> array
+    This function converts the upper-triangle edge values (edges, in the order of np.triu_indices) into a symmetric n_roi x n_roi matrix
+    with an empty diagonal
+    '''
+    node_1, node_2 = np.triu_indices(n_roi, k=1)
+    matrix = np.zeros((n_roi, n_roi), dtype=edges.dtype)
+    matrix[node_1, node_2] = edges
+    matrix[node_2, node_1] = edges
+
+    return matrix
+
+def path_lengths(adjacency):
+    '''
+    (array) -> array
+    This function computes the shortest path length between every pair of nodes of a binary graph (n x n boolean adjacency)
+    with a breadth-first search from every node. Unreachable pairs are inf
+    '''
+    return csgraph.shortest_path(adjacency.astype(float), method='D', directed=False, unweighted=True)
+
+def inverse_length_sum(a):
+    '''
+    (array) -> float
+    This function returns the sum of the inverse path lengths between all ordered pairs of distinct nodes of a small binary graph
+    (float adjacency). The search frontier of every source node is advanced at once with a matrix product, and the pairs reached at
+    step k add 1/k, which avoids the per-call overhead of csgraph on the many small graphs of local_efficiency
+    '''
+    frontier = np.eye(len(a), dtype=a.dtype)
+    reached = np.eye(len(a), dtype=bool)
+    total = 0
+    step = 0
+    while True:
+        step += 1
+        new = ((frontier @ a) > 0) & ~reached
+        n_new = new.sum()
+        if n_new == 0:
+            return total
+        total += n_new / step
+        reached |= new
+        frontier = new.astype(a.dtype)
+
+def betweenness(adjacency, dist):
+    '''
+    (array, array) -> array
+    This function computes the betweenness centrality of each node with Brandes' algorithm, run for all source nodes at once:
+    the number of shortest paths is counted forward and the dependencies are accumulated backward one path length at a time,
+    each step being a matrix product with the adjacency. Normalized as nx.betweenness_centrality
+    '''
+    n = len(adjacency)
+    a = adjacency.astype(float)
+    level = np.where(np.isfinite(dist), dist, -1).astype(int)
+    max_level = level.max()
+
+    # count the shortest paths from each source (rows) to each node (columns)
+    sigma = np.eye(n)
+    for k in range(1, max_level + 1):
+        at_k = level == k
+        sigma[at_k] = ((sigma * (level == k - 1)) @ a)[at_k]
+
+    # accumulate the dependency of each source on each node, from the farthest nodes back
+    delta = np.zeros((n, n))
+    for k in range(max_level - 1, 0, -1):
+        at_k = level == k
+        coef = np.where(level == k + 1, (1 + delta) / np.where(level == k + 1, sigma, 1), 0)
+        delta[at_k] = (sigma * (coef @ a))[at_k]
+
+    scale = 1 / ((n - 1) * (n - 2)) if n > 2 else 1
+
+    return delta.sum(axis=0) * scale
+
+def closeness(dist):
+    '''
+    (array) -> array
+    This function computes the closeness centrality of each node from the path lengths, scaled by the reachable fraction of the graph
+    as nx.closeness_centrality (wf_improved)
+    '''
+    n = len(dist)
+    reach = np.isfinite(dist)
+    total = np.where(reach, dist, 0).sum(axis=1)
+    n_reach = reach.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = np.where(total > 0, (n_reach - 1) / total * (n_reach - 1) / max(n - 1, 1), 0)
+
+    return out
+
+def clustering(adjacency):
+    '''
+    (array) -> array
+    This function computes the clustering coefficient of each node of a binary graph from the triangles counted with a matrix product,
+    as nx.clustering
+    '''
+    a = adjacency.astype(float)
+    degree = a.sum(axis=1)
+    triangles = ((a @ a) * a).sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        out = np.where(degree > 1, triangles / (degree * (degree - 1)), 0)
+
+    return out
+
+def efficiency(dist):
+    '''
+    (array) -> float
+    This function computes the global efficiency (the average inverse path length between distinct nodes) from the path lengths,
+    as nx.global_efficiency
+    '''
+    n = len(dist)
+    if n < 2:
+        return 0
+    with np.errstate(divide='ignore'):
+        inverse = 1 / dist
+    np.fill_diagonal(inverse, 0)
+
+    return float(inverse.sum() / (n * (n - 1)))
+
+def local_efficiency(adjacency):
+    '''
+    (array) -> float
+    This function computes the local efficiency, the average global efficiency of the subgraph of the neighbors of each node,
+    as nx.local_efficiency
+    '''
+    a = adjacency.astype(np.float32)
+    out = np.zeros(len(adjacency))
+    for i, neighbors in enumerate(adjacency):
+        k = neighbors.sum()
+        if k > 1:
+            out[i] = inverse_length_sum(a[neighbors][:, neighbors]) / (k * (k - 1))
+
+    return float(out.mean()) if len(out) else 0
+
+def graph_metrics(adjacency):
+    '''
+    (array) -> dict
+    This function computes the node metrics (degree, betweenness & closeness centrality, clustering) and the graph metrics (global &
+    local efficiency, average clustering) of a binary graph (n x n boolean adjacency without self-loops) with array operations
+    '''
+    adjacency = np.asarray(adjacency, dtype=bool)
+    n = len(adjacency)
+    dist = path_lengths(adjacency)
+    cluster_coefficients = clustering(adjacency)
+
+    return {
+        'degree_centrality': adjacency.sum(axis=1) / (n - 1) if n > 1 else np.ones(n),
+        'betweenness_centrality': betweenness(adjacency, dist),
+        'closeness_centrality': closeness(dist),
+        'cluster_coefficients': cluster_coefficients,
+        'global_efficiency': efficiency(dist),
+        'local_efficiency': local_efficiency(adjacency),
+        'average_coefficients': float(cluster_coefficients.mean())
+    }
+
+def weighted_adjacency(corr):
+    '''
+    (array) -> array
+    This function converts a correlation matrix (n x n) into the weights of the full weighted graph: the negative correlations and
+    the diagonal are set to 0, as the weighted clustering & efficiency are only defined for non-negative weights
+    '''
+    weights = np.clip(np.asarray(corr, dtype=float), 0, None)
+    np.fill_diagonal(weights, 0)
+
+    return weights
+
+def weighted_clustering(weights):
+    '''
+    (array) -> array
+    This function computes the weighted clustering coefficient of each node (geometric mean of the triangle weights, normalized by
+    the largest weight), as nx.clustering(G, weight='weight')
+    '''
+    degree = (weights > 0).sum(axis=1)
+    max_weight = weights.max() if weights.size else 0
+    if max_weight == 0:
+        return np.zeros(len(weights))
+    cube_root = np.cbrt(weights / max_weight)
+    triangles = np.einsum('ij,jk,ki->i', cube_root, cube_root, cube_root)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(degree > 1, triangles / (degree * (degree - 1)), 0)
+
+def weighted_path_lengths(weights):
+    '''
+    (array) -> array
+    This function computes the shortest path length between every pair of nodes of a weighted graph, the length of an edge being
+    the inverse of its weight (Dijkstra from every node). Unreachable pairs are inf
+    '''
+    with np.errstate(divide='ignore'):
+        lengths = np.where(weights > 0, 1 / weights, 0)
+
+    return csgraph.shortest_path(lengths, method='D', directed=False)
+
+def weighted_metrics(weights):
+    '''
+    (array) -> dict
+    This function computes the node metrics (strength, strength normalized by the number of other nodes, weighted clustering &
+    nodal efficiency) and the graph metrics (weighted global efficiency, average weighted clustering) of a weighted graph
+    (n x n non-negative weights, see weighted_adjacency) with array operations
+    '''
+    n = len(weights)
+    strength = weights.sum(axis=1)
+    dist = weighted_path_lengths(weights)
+    with np.errstate(divide='ignore'):
+        inverse = 1 / dist
+    np.fill_diagonal(inverse, 0)
+    cluster_coefficients = weighted_clustering(weights)
+
+    return {
+        'strength': strength,
+        'normalized_strength': strength / (n - 1) if n > 1 else strength,
+        'weighted_clustering': cluster_coefficients,
+        'nodal_efficiency': inverse.sum(axis=1) / (n - 1) if n > 1 else np.zeros(n),
+        'weighted_efficiency': efficiency(dist),
+        'average_weighted_clustering': float(cluster_coefficients.mean()) if n else 0
+    }
+
+def density_levels(edges, densities):
+    '''
+    (array, list) -> array
+    This function ranks the edges of a subject once by descending weight and returns the nested proportional thresholds of each density
+    (densities x edges boolean), each level keeping the strongest edges up to its density
+    '''
+    rank = np.empty(len(edges), dtype=int)
+    rank[np.argsort(-edges, kind='stable')] = np.arange(len(edges))
+    n_keep = np.round(np.asarray(densities) * len(edges)).astype(int)
+
+    return rank[np.newaxis] < n_keep[:, np.newaxis]
+
+def density_sweep(levels, n_roi):
+    '''
+    (array, int) -> dict
+    This function computes the graph metrics of every level of nested binary graphs (levels x upper-triangle edges boolean, e.g. the
+    percentile thresholds of a subject). The levels are visited from the sparsest to the densest and only the edges added since the
+    previous level are processed: the degree and the two-step path counts (A @ A, which give the triangles of the clustering) are
+    updated with the sparse matrix of the new edges, and the path-based metrics are computed on the current graph.
+    Returns a dictionary of the metrics of graph_metrics, each with a first axis of levels (in the order of the input)
+    '''
+    node_1, node_2 = np.triu_indices(n_roi, k=1)
+    n_level = len(levels)
+    sweep = {key: np.zeros((n_level, n_roi)) for key in node_metrics}
+    sweep.update({key: np.zeros(n_level) for key in graph_level_metrics})
+
+    a = np.zeros((n_roi, n_roi))
+    a2 = np.zeros((n_roi, n_roi))
+    degree = np.zeros(n_roi)
+    kept = np.zeros(levels.shape[1], dtype=bool)
+    for j in np.argsort(levels.sum(axis=1), kind='stable'):
+        if (kept & ~levels[j]).any():
+            raise ValueError('the levels of the density sweep are not nested')
+        new = levels[j] & ~kept
+        kept |= new
+
+        # add the new edges: (A + B) @ (A + B) = A @ A + B @ A + (B @ A).T + B @ B for the symmetric adjacency A & new edges B
+        b = sparse.coo_matrix((np.ones(new.sum()), (node_1[new], node_2[new])), shape=(n_roi, n_roi)).tocsr()
+        b = b + b.T
+        ba = b @ a
+        a2 += ba + ba.T + (b @ b).toarray()
+        a[node_1[new], node_2[new]] = 1
+        a[node_2[new], node_1[new]] = 1
+        degree += np.asarray(b.sum(axis=1)).ravel()
+
+        # degree & clustering from the updated counts
+        sweep['degree_centrality'][j] = degree / (n_roi - 1) if n_roi > 1 else 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            sweep['cluster_coefficients'][j] = np.where(degree > 1, (a2 * a).sum(axis=1) / (degree * (degree - 1)), 0)
+        sweep['average_coefficients'][j] = sweep['cluster_coefficients'][j].mean()
+
+        # path-based metrics of the current graph
+        adjacency = a > 0
+        dist = path_lengths(adjacency)
+        sweep['betweenness_centrality'][j] = betweenness(adjacency, dist)
+        sweep['closeness_centrality'][j] = closeness(dist)
+        sweep['global_efficiency'][j] = efficiency(dist)
+        sweep['local_efficiency'][j] = local_efficiency(adjacency)
+
+    return sweep
+
+def sweep_table(sweep, sub_id, percentiles, densities):
+    '''
+    (dict, str, list, list) -> DataFrame
+    This function converts the density sweep of a subject into a tidy table with one row per density, metric & ROI
+    (columns sub_id, percentile, density, metric, roi & value). The roi of the graph-level metrics is empty
+    '''
+    sweep_dfList = []
+    for metric, value in sweep.items():
+        n_node = value.shape[1] if value.ndim == 2 else 1
+        sweep_dfList.append(pd.DataFrame(
+            {
+                'sub_id': sub_id,
+                'percentile': np.repeat(percentiles, n_node),
+                'density': np.repeat(densities, n_node),
+                'metric': metric,
+                'roi': np.tile(np.arange(n_node), len(percentiles)) if value.ndim == 2 else np.nan,
+                'value': value.ravel()
+            }
+        ))
+
+    return pd.concat(sweep_dfList, ignore_index=True)
+
+def sweep_auc(sweep_df):
+    '''
+    (DataFrame) -> DataFrame
+    This function summarizes each metric of each subject & ROI of a tidy density sweep table by its area under the curve over density
+    (trapezoidal rule)
+    '''
+    sweep_df = sweep_df.sort_values('density', kind='stable')
+    auc = sweep_df.groupby(['sub_id', 'metric', 'roi'], dropna=False, sort=False).apply(lambda df: trapezoid(df['value'], df['density']))
+
+    return auc.rename('auc').reset_index()
+
+def metric_store_path(output_dir, output_suffix):
+    '''
+    (str, str) -> str
+    This function returns the path of the checkpoint store, the HDF5 file that holds the graph metrics of every completed subject
+    '''
+    return os.path.join(output_dir, f'graph_metric_{output_suffix}.h5')
+
+def checkpoint_records(store_file):
+    '''
+    (str) -> dict
+    This function returns the checkpoint record of each completed subject in the store: the key of its inputs & parameters
+    and whether its density sweep & weighted metrics are stored. An empty dictionary when there is no store
+    '''
+    records = {}
+    if not os.path.exists(store_file):
+        return records
+    with pd.HDFStore(store_file, mode='r') as store:
+        for node in store.keys():
+            if node.endswith('/done'):
+                done = store[node]
+                records[node.split('/')[1]] = {'key': getattr(store.get_storer(node).attrs, 'key', None),
+                                               'sweep': bool(done.get('sweep', False)), 'weighted': bool(done.get('weighted', False))}
+
+    return records
+
+def write_checkpoint(store_file, sub_id, key, metrics, sweep=None, weighted=None):
+    '''
+    (str, str, str, dict, dict, dict) -> None
+    This function stores the graph metrics (and the density sweep & weighted metrics) of a subject in its own group of the checkpoint store, replacing
+    an earlier checkpoint of the subject. Each metric is a numeric column (node metrics: one row per ROI, or per level & ROI of the sweep).
+    The record that marks the subject as completed is written last, so a subject interrupted halfway is computed again
+    '''
+    frames = {'node': pd.DataFrame({key_: metrics[key_] for key_ in node_metrics}),
+              'graph': pd.DataFrame({key_: [metrics[key_]] for key_ in graph_level_metrics})}
+    if sweep is not None:
+        frames['sweep_node'] = pd.DataFrame({key_: sweep[key_].ravel() for key_ in node_metrics})
+        frames['sweep_graph'] = pd.DataFrame({key_: sweep[key_] for key_ in graph_level_metrics})
+    if weighted is not None:
+        frames['weighted_node'] = pd.DataFrame({key_: weighted[key_] for key_ in weighted_node_metrics})
+        frames['weighted_graph'] = pd.DataFrame({key_: [weighted[key_]] for key_ in weighted_graph_metrics})
+
+    with warnings.catch_warnings():
+        # subject IDs starting with a digit are valid group names, they just cannot be used as python attributes
+        warnings.simplefilter('ignore', tables.NaturalNameWarning)
+        with pd.HDFStore(store_file, mode='a', complevel=5, complib='zlib') as store:
+            if f'/{sub_id}' in store:
+                store.remove(sub_id)
+            for name, frame in frames.items():
+                store.put(f'{sub_id}/{name}', frame)
+            store.put(f'{sub_id}/done', pd.Series({'sweep': sweep is not None, 'weighted': weighted is not None}))
+            store.get_storer(f'{sub_id}/done').attrs.key = key
+
+def read_checkpoint(store_file, sub_id):
+    '''
+    (str, str) -> dict, dict, dict
+    This function reads the graph metrics, the density sweep and the weighted metrics (None when they are not stored) of a subject
+    from the checkpoint store, in the format of graph_metrics, density_sweep & weighted_metrics
+    '''
+    with pd.HDFStore(store_file, mode='r') as store:
+        node_df = store[f'{sub_id}/node']
+        graph_df = store[f'{sub_id}/graph']
+        metrics = {key: node_df[key].to_numpy() for key in node_metrics}
+        metrics.update({key: graph_df[key].iloc[0] for key in graph_level_metrics})
+
+        sweep = None
+        if f'/{sub_id}/sweep_node' in store:
+            sweep_graph = store[f'{sub_id}/sweep_graph']
+            sweep_node = store[f'{sub_id}/sweep_node']
+            sweep = {key: sweep_node[key].to_numpy().reshape(len(sweep_graph), -1) for key in node_metrics}
+            sweep.update({key: sweep_graph[key].to_numpy() for key in graph_level_metrics})
+
+        weighted = None
+        if f'/{sub_id}/weighted_node' in store:
+            weighted_node = store[f'{sub_id}/weighted_node']
+            weighted_graph = store[f'{sub_id}/weighted_graph']
+            weighted = {key: weighted_node[key].to_numpy() for key in weighted_node_metrics}
+            weighted.update({key: weighted_graph[key].iloc[0] for key in weighted_graph_metrics})
+
+    return metrics, sweep, weighted
+
+def networkx_metrics(G):
+    '''
+    (Graph) -> dict
+    This function computes the same metrics as graph_metrics with networkx, for the parity check
+    '''
+    return {
+        'degree_centrality': np.array(list(nx.degree_centrality(G).values())),
+        'betweenness_centrality': np.array(list(nx.betweenness_centrality(G).values())),
+        'closeness_centrality': np.array(list(nx.closeness_centrality(G).values())),
+        'cluster_coefficients': np.array(list(nx.clustering(G, nodes=None, weight=None).values())),
+        'global_efficiency': nx.global_efficiency(G),
+        'local_efficiency': nx.local_efficiency(G),
+        'average_coefficients': nx.average_clustering(G, nodes=None, weight=None)
+    }
+
+def networkx_weighted_metrics(G):
+    '''
+    (Graph) -> dict
+    This function computes the same metrics as weighted_metrics with networkx (edge lengths 1 / weight), for the parity check
+    '''
+    n = G.number_of_nodes()
+    nx.set_edge_attributes(G, {edge: 1 / weight for edge, weight in nx.get_edge_attributes(G, 'weight').items()}, 'length')
+    nodal_efficiency = np.array([sum(1 / length for target, length in nx.single_source_dijkstra_path_length(G, node, weight='length').items()
+                                     if target != node) / (n - 1) for node in G.nodes])
+    strength = np.array([value for _, value in G.degree(weight='weight')])
+
+    return {
+        'strength': strength,
+        'normalized_strength': strength / (n - 1),
+        'weighted_clustering': np.array(list(nx.clustering(G, weight='weight').values())),
+        'nodal_efficiency': nodal_efficiency,
+        'weighted_efficiency': float(nodal_efficiency.mean()),
+        'average_weighted_clustering': nx.average_clustering(G, weight='weight')
+    }
+
+def compare_metrics(metrics, reference, tol=1e-8):
+    '''
+    (dict, dict, float) -> dict
+    This function returns the largest absolute difference of each metric between two sets of metrics, and raises an error when
+    any of them exceeds tol
+    '''
+    diff = {key: float(np.max(np.abs(np.asarray(metrics[key]) - np.asarray(reference[key])))) for key in reference}
+    mismatch = {key: value for key, value in diff.items() if not value <= tol}
+    if mismatch:
+        raise ValueError(f'the graph metrics do not match networkx: {mismatch}')
+
+    return diff
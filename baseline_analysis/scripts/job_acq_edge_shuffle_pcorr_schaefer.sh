@@ -0,0 +1,15 @@
+#!/bin/bash
+
+# an array task reads its idx_min,idx_max from the line of the shard list, which is not replaced while the array runs
+if [ -n "$SLURM_ARRAY_TASK_ID" ]; then
+    idx=`sed -n "$((SLURM_ARRAY_TASK_ID + 1))p" $shard_file`
+    idx_min=`echo $idx | awk -F ',' '{print $1}'`
+    idx_max=`echo $idx | awk -F ',' '{print $2}'`
+    if [ -z "$idx_min" ] || [ -z "$idx_max" ]; then
+        echo "no shard $SLURM_ARRAY_TASK_ID in $shard_file"
+        exit 1
+    fi
+fi
+
+# the shuffled coefficients are written to the null store tile by tile, so a requeued or relaunched job resumes from its completed tiles
+python /home/kcheung3/sanlab/DEV_RS/baseline_analysis/scripts/acq_edge_shuffle_pcorr_schaefer.py --acq $acq_id --dv $dv --idx_type edge --idx_min $idx_min --idx_max $idx_max --shuffle_time ${shuffle_time:-1000} --output_format both --workers ${SLURM_CPUS_PER_TASK:-1}
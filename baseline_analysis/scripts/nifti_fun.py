@@ -0,0 +1,44 @@
+import numpy as np
+import nibabel as nib
+
+def mask_voxels(mask_img):
+    '''
+    (Nifti1Image) -> array
+    This function returns the boolean 3D array of the voxels in a brain mask image
+    '''
+    return np.asanyarray(mask_img.dataobj) != 0
+
+def same_grid(file, mask_img):
+    '''
+    (str, Nifti1Image) -> bool
+    This function checks from the header whether a 4D NIfTI file is on the voxel grid of the mask (same shape & affine),
+    so its volumes can be masked without resampling
+    '''
+    img = nib.load(file)
+
+    return img.shape[:3] == mask_img.shape[:3] and np.allclose(img.affine, mask_img.affine)
+
+def load_masked_data(files, mask_img, chunk_size=16):
+    '''
+    (list, Nifti1Image, int) -> array, list
+    This function reads the 4D NIfTI files one block of chunk_size volumes at a time and writes the brain voxels of each volume
+    directly into one preallocated (time x voxels) array, with the files concatenated in time. An uncompressed file is memory-mapped,
+    a compressed file is decompressed once from start to end, and only one block of full volumes is held in memory at a time.
+    The voxels are in the order of the mask (as NiftiMasker), and the array keeps the data type of the scaled file data.
+    Returns the array and the number of volumes of each file
+    '''
+    mask = mask_voxels(mask_img)
+    # keep the files open, so a compressed file is read forward instead of from the start for each block
+    imgs = [nib.load(file, mmap=True, keep_file_open=True) for file in files]
+    n_vol = [img.shape[3] for img in imgs]
+    dtype = np.result_type(*[np.asanyarray(img.dataobj[..., :1]).dtype for img in imgs])
+
+    data = np.empty((sum(n_vol), int(mask.sum())), dtype=dtype)
+    start = 0
+    for img, n in zip(imgs, n_vol):
+        for t in range(0, n, chunk_size):
+            block = np.asanyarray(img.dataobj[..., t:min(t + chunk_size, n)])
+            data[start + t:start + t + block.shape[3]] = block[mask].T
+        start += n
+
+    return data, n_vol
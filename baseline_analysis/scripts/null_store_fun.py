@@ -0,0 +1,154 @@
+import os
+import json
+import zlib
+import numpy as np
+import pandas as pd
+
+# the null store starts with a magic string and the length of a json header, followed by one record per completed tile
+null_magic = b'DEVRSNUL'
+# each record starts with the feature & shuffle range of the tile and the crc32 of its values
+record_dtype = np.dtype([('feature_start', '<i8'), ('feature_stop', '<i8'), ('shuffle_start', '<i8'), ('shuffle_stop', '<i8'),
+                         ('crc', '<u4')])
+
+def null_store_path(output_file):
+    '''
+    (str) -> str
+    This function returns the path of the null store that goes with a csv output file (the same name with .null)
+    '''
+    return os.path.splitext(output_file)[0] + '.null'
+
+def create_null_store(null_file, features, n_shuffle, params=None, dtype=np.float32):
+    '''
+    (str, list, int, dict, dtype) -> None
+    This function writes the header of an empty null store for the shuffles x features coefficients of a permutation job.
+    params holds the job parameters, so a store can be matched with the job that wrote it
+    '''
+    header = json.dumps({
+        'version': 1,
+        'dtype': np.dtype(dtype).str,
+        'shape': [n_shuffle, len(features)],
+        'features': [str(feature) for feature in features],
+        'params': params
+    }).encode()
+    with open(null_file, 'wb') as f:
+        f.write(null_magic)
+        f.write(np.uint32(len(header)).tobytes())
+        f.write(header)
+
+def resume_null_store(null_file, features, n_shuffle, params=None, dtype=np.float32):
+    '''
+    (str, list, int, dict, dtype) -> set
+    This function opens the null store of a relaunched job. When null_file was written by a job with the same features, shape, dtype
+    and params, the record cut off by the crash is removed and the completed tiles are returned as
+    (feature start, feature stop, shuffle start, shuffle stop). Otherwise a new empty store is created and no tile is complete
+    '''
+    if os.path.exists(null_file):
+        try:
+            header, records, offset = null_records(null_file)
+        except ValueError:
+            header = None
+        # compare through json, as the header was written
+        if header is not None and header['dtype'] == np.dtype(dtype).str and header['shape'] == [n_shuffle, len(features)] \
+                and header['features'] == [str(feature) for feature in features] and header['params'] == json.loads(json.dumps(params)):
+            os.truncate(null_file, offset)
+            return {(features.start, features.stop, shuffles.start, shuffles.stop) for features, shuffles, _ in records}
+
+    create_null_store(null_file, features, n_shuffle, params, dtype)
+
+    return set()
+
+def append_null_tile(f, features, shuffles, r, dtype):
+    '''
+    (file, slice, slice, array, dtype) -> None
+    This function appends the coefficients of a completed tile (shuffles x features) to a null store opened with open(null_file, 'ab'),
+    and flushes the record to disk so it survives a crash of the job
+    '''
+    values = np.ascontiguousarray(r, dtype=dtype).tobytes()
+    record = np.array([(features.start, features.stop, shuffles.start, shuffles.stop, zlib.crc32(values))], dtype=record_dtype)
+    f.write(record.tobytes())
+    f.write(values)
+    f.flush()
+    os.fsync(f.fileno())
+
+def read_null_header(null_file):
+    '''
+    (str) -> dict, int
+    This function reads the header of a null store. Returns the header and the byte offset of the first record
+    '''
+    with open(null_file, 'rb') as f:
+        if f.read(len(null_magic)) != null_magic:
+            raise ValueError(f'{null_file} is not a null store')
+        # a job killed while creating the store leaves a short preamble or header
+        raw = f.read(4)
+        if len(raw) < 4:
+            raise ValueError(f'{null_file} has an incomplete header')
+        header_len = int(np.frombuffer(raw, dtype=np.uint32)[0])
+        raw = f.read(header_len)
+        if len(raw) < header_len:
+            raise ValueError(f'{null_file} has an incomplete header')
+        header = json.loads(raw.decode())
+
+    return header, len(null_magic) + 4 + header_len
+
+def null_records(null_file):
+    '''
+    (str) -> dict, list, int
+    This function lists the complete records of a null store. A record cut off by a crash, or whose values do not match their crc32,
+    ends the list. Returns the header, the (features slice, shuffles slice, offset of the values) of each record and the byte offset
+    after the last complete record
+    '''
+    header, offset = read_null_header(null_file)
+    itemsize = np.dtype(header['dtype']).itemsize
+    records = []
+    with open(null_file, 'rb') as f:
+        f.seek(offset)
+        while True:
+            raw = f.read(record_dtype.itemsize)
+            if len(raw) < record_dtype.itemsize:
+                break
+            record = np.frombuffer(raw, dtype=record_dtype)[0]
+            n_value = (int(record['feature_stop']) - int(record['feature_start'])) * (int(record['shuffle_stop']) - int(record['shuffle_start']))
+            values = f.read(n_value * itemsize)
+            if len(values) < n_value * itemsize or zlib.crc32(values) != int(record['crc']):
+                break
+            records.append((slice(int(record['feature_start']), int(record['feature_stop'])),
+                            slice(int(record['shuffle_start']), int(record['shuffle_stop'])), offset + record_dtype.itemsize))
+            offset = f.tell()
+
+    return header, records, offset
+
+def read_null_store(null_file, shuffles=None):
+    '''
+    (str, slice) -> array, list
+    This function reads the coefficients of the shuffles slice (all shuffles when None) from a null store, reading only the records
+    that overlap it. The coefficients of tiles that are not stored are nan. Returns the shuffles x features array and the feature IDs
+    '''
+    header, records, _ = null_records(null_file)
+    n_shuffle, n_feature = header['shape']
+    dtype = np.dtype(header['dtype'])
+    shuffles = (slice(None) if shuffles is None else shuffles).indices(n_shuffle)[:2]
+    out = np.full((shuffles[1] - shuffles[0], n_feature), np.nan, dtype=dtype)
+    with open(null_file, 'rb') as f:
+        for features, tile_shuffles, offset in records:
+            start, stop = max(tile_shuffles.start, shuffles[0]), min(tile_shuffles.stop, shuffles[1])
+            if start >= stop:
+                continue
+            n_tile_feature = features.stop - features.start
+            # seek to the first overlapping shuffle of the tile, the values are stored shuffle by shuffle
+            f.seek(offset + (start - tile_shuffles.start) * n_tile_feature * dtype.itemsize)
+            values = np.frombuffer(f.read((stop - start) * n_tile_feature * dtype.itemsize), dtype=dtype)
+            out[start - shuffles[0]:stop - shuffles[0], features] = values.reshape(stop - start, n_tile_feature)
+
+    return out, header['features']
+
+def export_null_csv(null_file, csv_file, block_size=1000):
+    '''
+    (str, str, int) -> None
+    This function exports a null store into the csv layout of the shuffle scripts (one row per shuffle, one column per feature),
+    block_size shuffles at a time so the whole null matrix is never held in memory
+    '''
+    header, _ = read_null_header(null_file)
+    n_shuffle = header['shape'][0]
+    for start in range(0, n_shuffle, block_size):
+        values, features = read_null_store(null_file, slice(start, min(start + block_size, n_shuffle)))
+        pd.DataFrame(values, columns=features).to_csv(csv_file, mode='w' if start == 0 else 'a', index=False, header=start == 0)
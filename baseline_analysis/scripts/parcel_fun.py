@@ -0,0 +1,99 @@
+import os
+import numpy as np
+from scipy import sparse
+from cache_fun import file_hash
+
+def parcel_index_path(mask_file):
+    '''
+    (str) -> str
+    This function returns the path of the parcel index of a parcellation mask, next to the mask
+    '''
+    return os.path.join(os.path.dirname(mask_file), os.path.basename(mask_file).split('.')[0] + '_parcel_index.npz')
+
+def build_parcel_index(mask_data):
+    '''
+    (array) -> dict
+    This function builds the parcel index from the masked parcellation (mask.data of the parcellation Brain_Data, one label per brain voxel).
+    The index holds the parcel label of each voxel ('label', 0 outside the parcels), the parcel labels in the order of expand_mask ('roi')
+    and the number of voxels of each parcel ('count')
+    '''
+    # round the labels as extract_roi does
+    label = np.round(np.asarray(mask_data)).astype(int)
+    roi, count = np.unique(label[label != 0], return_counts=True)
+
+    return {'label': label.astype(np.int16), 'roi': roi.astype(np.int16), 'count': count.astype(np.int32)}
+
+def save_parcel_index(index_file, parcel_index, mask_hash):
+    '''
+    (str, dict, str) -> None
+    This function saves the parcel index with the hash of the mask file it was built from
+    '''
+    np.savez_compressed(index_file, mask_hash=np.array(mask_hash), **parcel_index)
+
+def load_parcel_index(index_file, mask_hash=None):
+    '''
+    (str, str) -> dict
+    This function loads a saved parcel index. Returns None when there is no index, or when it was built from a different mask (mask_hash)
+    '''
+    if not os.path.exists(index_file):
+        return None
+    with np.load(index_file) as f:
+        if mask_hash is not None and str(f['mask_hash']) != mask_hash:
+            return None
+        return {key: f[key] for key in ['label', 'roi', 'count']}
+
+def parcel_index(mask_file, load_mask):
+    '''
+    (str, function) -> dict
+    This function returns the parcel index of a parcellation mask file. The index is built once and saved next to the mask,
+    later calls load it as long as the mask file is unchanged. load_mask is only called to build the index, e.g.
+    lambda: Brain_Data(mask_file)
+    '''
+    index_file = parcel_index_path(mask_file)
+    mask_hash = file_hash(mask_file)
+    index = load_parcel_index(index_file, mask_hash)
+    if index is None:
+        index = build_parcel_index(load_mask().data)
+        save_parcel_index(index_file, index, mask_hash)
+
+    return index
+
+def parcel_matrix(parcel_index):
+    '''
+    (dict) -> csr_matrix
+    This function returns the sparse (parcels x voxels) averaging matrix of a parcel index, each row holds 1/count on the voxels of a parcel
+    '''
+    label = parcel_index['label']
+    voxel = np.flatnonzero(label)
+    row = np.searchsorted(parcel_index['roi'], label[voxel])
+
+    return sparse.csr_matrix((1 / parcel_index['count'][row], (row, voxel)), shape=(len(parcel_index['roi']), len(label)))
+
+def extract_parcels(data, parcel_index):
+    '''
+    (array, dict) -> array
+    This function averages the data (time x voxels, e.g. Brain_Data.data) within each parcel with one sparse matrix product.
+    Returns the time series of each parcel (parcels x time), as extract_roi
+    '''
+    data = np.asarray(data)
+    if data.shape[-1] != len(parcel_index['label']):
+        raise ValueError(f'the data has {data.shape[-1]} voxels, the parcel index has {len(parcel_index["label"])}')
+
+    return np.asarray(parcel_matrix(parcel_index) @ np.atleast_2d(data).T)
+
+def parcel_to_brain(values, parcel_index, template):
+    '''
+    (list, dict, Brain_Data) -> Brain_Data
+    This function writes one value per parcel (in the order of parcel_index['roi']) onto the voxels of each parcel, as roi_to_brain.
+    template is a Brain_Data with the voxels of the parcel index (e.g. the parcellation mask), its data are not copied
+    '''
+    values = np.asarray(values, dtype=float)
+    label = parcel_index['label']
+    voxel_values = np.zeros(len(label))
+    inside = label != 0
+    voxel_values[inside] = values[np.searchsorted(parcel_index['roi'], label[inside])]
+
+    brain = template.empty()
+    brain.data = voxel_values
+
+    return brain
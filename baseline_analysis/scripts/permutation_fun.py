@@ -0,0 +1,519 @@
+import multiprocessing as mp
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+import numpy as np
+from scipy import stats
+from scipy import sparse
+from scipy.sparse import csgraph
+from scipy.stats import rankdata
+
+def prepare_covariates(dv_df, dv_name, gender_level='Female'):
+    '''
+    (DataFrame, str, str) -> array, array, array
+    This function converts the dv, age and gender columns into numeric arrays for the permutation engine.
+    Gender is dummy coded the same way as pd.get_dummies (1 for gender_level, 0 otherwise)
+    '''
+    dv = dv_df[dv_name].to_numpy(dtype=float)
+    age = dv_df['age'].to_numpy(dtype=float)
+    gender = (dv_df['gender'] == gender_level).to_numpy(dtype=float)
+
+    return dv, age, gender
+
+def rank_data(data):
+    '''
+    (array) -> array
+    This function ranks the data along the first axis (subjects), with ties receiving the average rank as pandas' rank()
+    '''
+    return rankdata(data, method='average', axis=0)
+
+def orthonormal_covariates(cov):
+    '''
+    (list) -> list
+    This function takes the covariates as a list of arrays (..., subjects), centers each covariate and orthonormalizes
+    them with Gram-Schmidt. Constant (or redundant) covariates are set to zero, which matches the pseudo-inverse used by pingouin.
+    '''
+    q = []
+    for z in cov:
+        z = z - z.mean(axis=-1, keepdims=True)
+        norm_raw = np.sqrt(np.sum(z ** 2, axis=-1, keepdims=True))
+        # remove the projection on the previous covariates
+        for q_j in q:
+            z -= np.sum(q_j * z, axis=-1, keepdims=True) * q_j
+        norm = np.sqrt(np.sum(z ** 2, axis=-1, keepdims=True))
+        keep = norm > 1e-10 * norm_raw
+        z *= np.where(keep, 1 / np.where(keep, norm, 1), 0)
+        q.append(z)
+
+    return q
+
+def partial_spearman(x, y, covar):
+    '''
+    (array, array, array) -> float
+    This function calculates the spearman partial correlation between x and y controlling for the covariates (subjects x covariates)
+    for a single set of observations. Rows with missing values in x, y or the covariates are dropped before ranking,
+    as in pg.partial_corr(method='spearman').
+    '''
+    covar = covar.reshape(len(x), -1)
+    keep = np.isfinite(x) & np.isfinite(y) & np.isfinite(covar).all(axis=1)
+    rx = rank_data(x[keep])
+    ry = rank_data(y[keep])
+    rz = rank_data(covar[keep])
+
+    # residualize the ranks against the covariates
+    q = orthonormal_covariates(list(rz.T))
+    rx = rx - rx.mean()
+    ry = ry - ry.mean()
+    rx_res = rx - sum(np.sum(q_k * rx) * q_k for q_k in q)
+    ry_res = ry - sum(np.sum(q_k * ry) * q_k for q_k in q)
+    r = np.sum(rx_res * ry_res) / np.sqrt(np.sum(rx_res ** 2) * np.sum(ry_res ** 2))
+
+    return float(np.clip(r, -1, 1))
+
+def shuffle_block_size(n_sub, n_feature, per_feature):
+    '''
+    (int, int, bool) -> int
+    This function chooses how many shuffles are computed at once, so that the shuffled dv & covariates of a block
+    stay around 16 million values (~128MB per array), with at most 100 shuffles per block
+    '''
+    block_values = n_sub * (n_feature if per_feature else 1)
+    return min(100, max(1, (1 << 24) // block_values))
+
+def shuffle_tiles(n_sub, n_feature, n_shuffle, per_feature, block_size=None, feature_block=500):
+    '''
+    (int, int, int, bool, int, int) -> list
+    This function splits the features x shuffles result into tiles of at most feature_block features and block_size shuffles.
+    The tiles only depend on the data size, so a serial run and a parallel run compute exactly the same products.
+    Returns a list of (feature slice, shuffle slice)
+    '''
+    if block_size is None:
+        block_size = shuffle_block_size(n_sub, min(n_feature, feature_block), per_feature)
+
+    return [(slice(f, min(f + feature_block, n_feature)), slice(start, min(start + block_size, n_shuffle)))
+            for f in range(0, n_feature, feature_block) for start in range(0, n_shuffle, block_size)]
+
+def index_block(idx, features, shuffles):
+    '''
+    (array, slice, slice) -> array
+    This function returns the shuffles of a tile (features is a slice or an array of feature positions) from a shuffle index, which is
+    either an array (or memmap) or generated on the fly (ShuffleGenerator in shuffle_index_fun). A shared index (shuffles x subjects)
+    is the same for all features
+    '''
+    if hasattr(idx, 'block'):
+        return idx.block(shuffles.start, shuffles.stop, features)
+    if idx.ndim == 3:
+        return np.asarray(idx[features, shuffles], dtype=np.intp)
+
+    return np.asarray(idx[shuffles], dtype=np.intp)
+
+def pcorr_block(rx, ry, q):
+    '''
+    (array, array, list) -> array
+    This function calculates the partial correlations of one block of shuffles. rx is the centered connectivity ranks (subjects x features),
+    ry the centered shuffled dv ranks and q the list of orthonormal shuffled covariates. ry & q either have a shuffle axis
+    (shuffles x subjects) that is shared by all features, or feature & shuffle axes (features x shuffles x subjects)
+    when every feature has its own shuffles.
+    Returns an array of shuffles x features
+    '''
+    # residualize the shuffled dv against the shuffled covariates
+    ry_res = ry - sum(np.sum(q_k * ry, axis=-1, keepdims=True) * q_k for q_k in q)
+    # the residual of dv is orthogonal to the covariates, so it can be multiplied with the raw connectivity ranks
+    if ry.ndim == 2:
+        num = ry_res @ rx
+        ss_x = np.sum(rx ** 2, axis=0) - sum((q_k @ rx) ** 2 for q_k in q)
+        ss_y = np.sum(ry_res ** 2, axis=-1)[:, None]
+    else:
+        num = np.einsum('fpn,nf->pf', ry_res, rx)
+        ss_x = np.sum(rx ** 2, axis=0) - sum(np.einsum('fpn,nf->pf', q_k, rx) ** 2 for q_k in q)
+        ss_y = np.sum(ry_res ** 2, axis=-1).T
+
+    return np.clip(num / np.sqrt(ss_x * ss_y), -1, 1)
+
+def pcorr_tile(data, idx, features, shuffles):
+    '''
+    (dict, array, slice, slice) -> array
+    This function calculates the partial correlations of one tile (shuffles x features). data holds either the ranked inputs
+    (rx, rank_dv, rank_age, gender) or, when there are missing values, the raw inputs (x, dv, age, gender)
+    '''
+    block_idx = index_block(idx, features, shuffles)
+
+    # missing values change the ranks for each shuffle, fall back to one correlation per shuffle
+    if 'x' in data:
+        x = data['x'][:, features]
+        r = np.empty((block_idx.shape[-2], x.shape[1]))
+        for f in range(x.shape[1]):
+            for i, shuffle in enumerate(block_idx[f] if block_idx.ndim == 3 else block_idx):
+                covar = np.column_stack([data['age'][shuffle], data['gender'][shuffle]])
+                r[i, f] = partial_spearman(x[:, f], data['dv'][shuffle], covar)
+        return r
+
+    q = orthonormal_covariates([data['rank_age'][block_idx], data['gender'][block_idx]])
+    # copy the connectivity ranks of the tile, so the products do not depend on where the inputs are stored (serial or shared memory)
+    return pcorr_block(np.ascontiguousarray(data['rx'][:, features]), data['rank_dv'][block_idx], q)
+
+def rank_inputs(x, dv, age, gender):
+    '''
+    (array, array, array, array) -> dict
+    This function ranks and centers the inputs once, the ranks of a shuffled variable are the shuffled ranks.
+    With missing values the ranks depend on the shuffle, so the raw inputs are kept instead
+    '''
+    if not (np.isfinite(x).all() and np.isfinite(dv).all() and np.isfinite(age).all()):
+        return {'x': x, 'dv': dv, 'age': age, 'gender': gender}
+
+    rx = rank_data(x)
+    rx -= rx.mean(axis=0)
+    rank_dv = rank_data(dv)
+    rank_dv -= rank_dv.mean()
+
+    return {'rx': rx, 'rank_dv': rank_dv, 'rank_age': rank_data(age), 'gender': gender}
+
+def share_array(array):
+    '''
+    (array) -> SharedMemory, tuple
+    This function copies an array into a new shared memory block. Returns the block and the (name, shape, dtype) to attach to it
+    '''
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    try:
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    except BaseException:
+        shm.close()
+        shm.unlink()
+        raise
+
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+def attach_array(spec):
+    '''
+    (tuple) -> SharedMemory, array
+    This function attaches to a shared memory block created by share_array
+    '''
+    shm = shared_memory.SharedMemory(name=spec[0])
+
+    return shm, np.ndarray(spec[1], dtype=np.dtype(spec[2]), buffer=shm.buf)
+
+# the shared arrays attached by each worker of the process pool
+worker_state = {}
+
+def init_worker(data_specs, idx_spec):
+    '''
+    (dict, tuple) -> None
+    This function attaches a pool worker to the shared inputs and shuffle index
+    '''
+    worker_state['shm'] = []
+    worker_state['data'] = {}
+    for key, spec in data_specs.items():
+        shm, worker_state['data'][key] = attach_array(spec)
+        worker_state['shm'].append(shm)
+    if isinstance(idx_spec, tuple):
+        shm, worker_state['idx'] = attach_array(idx_spec)
+        worker_state['shm'].append(shm)
+    else:
+        # shuffles generated on the fly are small to send
+        worker_state['idx'] = idx_spec
+
+@contextmanager
+def tile_pool(data, idx, workers):
+    '''
+    (dict, array, int) -> generator
+    This function is a context manager that copies the ranked data and the shuffle index (unless it is generated on the fly) into
+    shared memory, and yields a pool of workers attached to them. The shared memory blocks are released when the context exits,
+    also when sharing an array, starting the pool or a tile fails
+    '''
+    shared = []
+    try:
+        data_specs = {}
+        for key, value in data.items():
+            shm, data_specs[key] = share_array(np.asarray(value))
+            shared.append(shm)
+        if hasattr(idx, 'block'):
+            idx_spec = idx
+        else:
+            shm, idx_spec = share_array(idx)
+            shared.append(shm)
+        # fork the workers, the analysis scripts run at import and cannot be re-imported by spawned workers
+        with mp.get_context('fork').Pool(workers, initializer=init_worker, initargs=(data_specs, idx_spec)) as pool:
+            yield pool
+    finally:
+        for shm in shared:
+            shm.close()
+            shm.unlink()
+
+def tile_summary(data, idx, features, shuffles, tol=1e-12):
+    '''
+    (dict, array, slice, slice, float) -> int, array
+    This function calculates one tile and reduces it to the number of shuffled |r| of each feature that reach its observed |r|
+    (data['r_obs']) and the largest |r| of each shuffle across the features of the tile
+    '''
+    r = np.abs(pcorr_tile(data, idx, features, shuffles))
+
+    return (r >= np.abs(data['r_obs'][features]) - tol).sum(axis=0), r.max(axis=1)
+
+def run_tile_summary(tile):
+    '''
+    (tuple) -> slice, slice, array, array
+    This function computes the summary of one tile in a pool worker, and returns it with the tile
+    '''
+    features, shuffles = tile
+
+    return (features, shuffles) + tile_summary(worker_state['data'], worker_state['idx'], features, shuffles)
+
+def run_tile_result(tile):
+    '''
+    (tuple) -> slice, slice, array
+    This function computes one tile in a pool worker and returns it to the main process with the tile
+    '''
+    features, shuffles = tile
+
+    return features, shuffles, pcorr_tile(worker_state['data'], worker_state['idx'], features, shuffles)
+
+def pcorr_shuffle(conn, dv, age, gender, idx, block_size=None, workers=1):
+    '''
+    (array, array, array, array, array, int, int) -> array
+    This function calculates the spearman partial correlation between the connectivity (conn) and the shuffled dv controlling for
+    the shuffled age and gender, for every shuffle in idx. conn can be a single feature (subjects) or the whole connectome
+    (subjects x features, e.g. all ROIs or edges). idx is either one set of shuffles shared by all features (shuffles x subjects),
+    or one set per feature (features x shuffles x subjects), either stored or generated on the fly.
+    The data are ranked and centered once, and the result is computed in tiles of features x block_size shuffles with matrix products,
+    which gives the same coefficients as calling pg.partial_corr(method='spearman') on each feature and shuffle.
+    With workers > 1 the tiles are distributed over a process pool; the ranked data and shuffle index are shared through
+    shared memory (see tile_pool), and the result is identical to the serial run.
+    Returns an array of shuffles (x features)
+    '''
+    conn = np.asarray(conn, dtype=float)
+    if not hasattr(idx, 'block'):
+        idx = np.asarray(idx)
+    x = conn.reshape(len(conn), -1)
+    n_shuffle = idx.shape[-2]
+    data = rank_inputs(x, dv, age, gender)
+    tiles = shuffle_tiles(len(x), x.shape[1], n_shuffle, idx.ndim == 3, block_size)
+
+    if workers <= 1 or len(tiles) == 1:
+        r = np.empty((n_shuffle, x.shape[1]))
+        for features, shuffles in tiles:
+            r[shuffles, features] = pcorr_tile(data, idx, features, shuffles)
+        return r.reshape((n_shuffle,) + conn.shape[1:])
+
+    # share the large arrays with the workers instead of pickling them to each worker
+    r = np.empty((n_shuffle, x.shape[1]))
+    with tile_pool(data, idx, workers) as pool:
+        for features, shuffles, tile_r in pool.imap_unordered(run_tile_result, tiles):
+            r[shuffles, features] = tile_r
+
+    return r.reshape((n_shuffle,) + conn.shape[1:])
+
+def iter_pcorr_tiles(conn, dv, age, gender, idx, block_size=None, workers=1, skip=()):
+    '''
+    (array, array, array, array, array, int, int, set) -> generator
+    This function calculates the same tiles as pcorr_shuffle, but yields each tile as (features slice, shuffles slice,
+    shuffles x features array) as soon as it is computed, so the caller can write it out instead of holding the whole null matrix.
+    The tiles in skip (feature start, feature stop, shuffle start, shuffle stop) are already complete and are not computed again.
+    With workers > 1 the tiles are computed in a process pool and yielded in the order they complete
+    '''
+    conn = np.asarray(conn, dtype=float)
+    if not hasattr(idx, 'block'):
+        idx = np.asarray(idx)
+    x = conn.reshape(len(conn), -1)
+    data = rank_inputs(x, dv, age, gender)
+    tiles = shuffle_tiles(len(x), x.shape[1], idx.shape[-2], idx.ndim == 3, block_size)
+    tiles = [(features, shuffles) for features, shuffles in tiles if (features.start, features.stop, shuffles.start, shuffles.stop) not in skip]
+    if not tiles:
+        return
+
+    if workers <= 1 or len(tiles) == 1:
+        for features, shuffles in tiles:
+            yield features, shuffles, pcorr_tile(data, idx, features, shuffles)
+        return
+
+    with tile_pool(data, idx, workers) as pool:
+        yield from pool.imap_unordered(run_tile_result, tiles)
+
+def analytic_pvalue(r, n_sub, n_covar=2):
+    '''
+    (array, int, int) -> array
+    This function returns the two-sided parametric p-value of partial correlations from the t distribution with n_sub - 2 - n_covar
+    degrees of freedom, as pg.partial_corr. It is the fast approximation of the permutation p-value
+    '''
+    dof = n_sub - 2 - n_covar
+    r = np.asarray(r, dtype=float)
+    with np.errstate(divide='ignore'):
+        t = r * np.sqrt(dof / (1 - r ** 2))
+
+    return 2 * stats.t.sf(np.abs(t), dof)
+
+def adaptive_pcorr_shuffle(conn, dv, age, gender, idx, n_exceed=10, tol=1e-12):
+    '''
+    (array, array, array, array, array, int, float) -> array, array, array, array
+    This function tests the spearman partial correlation of every feature with sequential Monte Carlo stopping (Besag & Clifford, 1991).
+    The shuffles of idx are computed in order, block by block, and a feature stops at the shuffle where n_exceed shuffled |r| have
+    reached its observed |r|, so clearly null features only use a few shuffles and the full budget is spent on the small p-values.
+    The p-value is n_exceed / L for a feature that stopped after L shuffles, and (exceedances + 1) / (shuffles + 1) for a feature that
+    used every shuffle. The stopping point does not depend on the block size. The blocks are computed in the main process.
+    Returns the observed partial correlations, the p-values, the number of shuffles used and the number of exceedances of each feature
+    '''
+    conn = np.asarray(conn, dtype=float)
+    if not hasattr(idx, 'block'):
+        idx = np.asarray(idx)
+    x = conn.reshape(len(conn), -1)
+    n_feature = x.shape[1]
+    n_shuffle = idx.shape[-2]
+    data = rank_inputs(x, dv, age, gender)
+    # the observed correlation is the identity shuffle
+    r_obs = pcorr_tile(data, np.arange(len(x))[np.newaxis], slice(0, n_feature), slice(0, 1))[0]
+
+    exceed = np.zeros(n_feature, dtype=int)
+    n_used = np.zeros(n_feature, dtype=int)
+    active = np.arange(n_feature)
+    start = 0
+    while len(active) and start < n_shuffle:
+        # the blocks grow as the features stop
+        stop = min(start + shuffle_block_size(len(x), len(active), idx.ndim == 3), n_shuffle)
+        r = pcorr_tile(data, idx, active, slice(start, stop))
+        cum_exceed = exceed[active] + np.cumsum(np.abs(r) >= np.abs(r_obs[active]) - tol, axis=0)
+        done = cum_exceed[-1] >= n_exceed
+        # the shuffle at which each stopped feature reached n_exceed
+        n_used[active] = np.where(done, start + np.argmax(cum_exceed >= n_exceed, axis=0) + 1, stop)
+        exceed[active] = np.minimum(cum_exceed[-1], n_exceed)
+        active = active[~done]
+        start = stop
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        p = np.where(exceed >= n_exceed, n_exceed / n_used, (exceed + 1) / (n_used + 1))
+
+    return r_obs, p, n_used, exceed
+
+def fdr_bh(p_value):
+    '''
+    (array) -> array
+    This function adjusts p-values for the false discovery rate with the Benjamini-Hochberg step-up procedure, as pg.multicomp(method='fdr_bh')
+    '''
+    p_value = np.asarray(p_value, dtype=float)
+    order = np.argsort(p_value)
+    n = len(p_value)
+    # the running minimum from the largest p-value down keeps the adjusted p-values monotone
+    adjusted = np.minimum.accumulate((p_value[order] * n / np.arange(1, n + 1))[::-1])[::-1]
+    p_fdr = np.empty(n)
+    p_fdr[order] = np.minimum(adjusted, 1)
+
+    return p_fdr
+
+def pcorr_max_stat(conn, dv, age, gender, idx, block_size=None, workers=1, tol=1e-12):
+    '''
+    (array, array, array, array, array, int, int, float) -> array, array, array, array, array
+    This function tests the spearman partial correlation of every feature against the shuffles of idx in a single streaming pass:
+    each tile of shuffles is reduced to the exceedance count of each feature and the maximum |r| of each shuffle across all features,
+    so the shuffles x features null matrix is never held in memory. The maximum statistic gives family-wise error corrected p-values
+    (Westfall & Young), which needs the joint null of the features: idx must be one set of shuffles shared by all features
+    (shuffles x subjects). The tiles are distributed over a process pool with workers > 1, as pcorr_shuffle.
+    Returns the observed partial correlations, the uncorrected, FDR (Benjamini-Hochberg) and FWE corrected p-values of each feature,
+    and the maximum |r| of each shuffle
+    '''
+    if idx.ndim != 2:
+        raise ValueError('the maximum statistic needs the same shuffles for every feature (a shared index)')
+    conn = np.asarray(conn, dtype=float)
+    idx = np.asarray(idx)
+    x = conn.reshape(len(conn), -1)
+    n_shuffle = idx.shape[-2]
+    data = rank_inputs(x, dv, age, gender)
+    # the observed correlation is the identity shuffle
+    data['r_obs'] = pcorr_tile(data, np.arange(len(x))[np.newaxis], slice(0, x.shape[1]), slice(0, 1))[0]
+    tiles = shuffle_tiles(len(x), x.shape[1], n_shuffle, idx.ndim == 3, block_size)
+
+    exceed = np.zeros(x.shape[1], dtype=int)
+    max_null = np.zeros(n_shuffle)
+    if workers <= 1 or len(tiles) == 1:
+        summaries = ((features, shuffles) + tile_summary(data, idx, features, shuffles, tol) for features, shuffles in tiles)
+        for features, shuffles, tile_exceed, tile_max in summaries:
+            exceed[features] += tile_exceed
+            max_null[shuffles] = np.maximum(max_null[shuffles], tile_max)
+    else:
+        # share the large arrays with the workers, only the summaries of the tiles are sent back
+        with tile_pool(data, idx, workers) as pool:
+            for features, shuffles, tile_exceed, tile_max in pool.imap_unordered(run_tile_summary, tiles):
+                exceed[features] += tile_exceed
+                max_null[shuffles] = np.maximum(max_null[shuffles], tile_max)
+
+    r_obs = data['r_obs']
+    p_uncorrected = (exceed + 1) / (n_shuffle + 1)
+    # the number of shuffles whose maximum |r| reaches the observed |r| of each feature
+    fwe_exceed = n_shuffle - np.searchsorted(np.sort(max_null), np.abs(r_obs) - tol, side='left')
+    p_fwe = (fwe_exceed + 1) / (n_shuffle + 1)
+
+    return r_obs, p_uncorrected, fdr_bh(p_uncorrected), p_fwe, max_null
+
+def edge_components(supra, n_roi):
+    '''
+    (array, int) -> array, array
+    This function finds the connected components formed by the suprathreshold edges of many graphs at once (graphs x upper-triangle edges
+    boolean, in the order of np.triu_indices). The graphs are stacked into one block-diagonal graph that is labeled with a single
+    connected_components call. Returns the component of each edge (graphs x edges, -1 below threshold) and the number of edges of each component
+    '''
+    supra = np.atleast_2d(supra)
+    node_1, node_2 = np.triu_indices(n_roi, k=1)
+    graph, edge = np.nonzero(supra)
+    row = graph * n_roi + node_1[edge]
+    col = graph * n_roi + node_2[edge]
+    n_node = len(supra) * n_roi
+    _, labels = csgraph.connected_components(sparse.coo_matrix((np.ones(len(edge)), (row, col)), shape=(n_node, n_node)), directed=False)
+
+    edge_label = np.full(supra.shape, -1)
+    edge_label[graph, edge] = labels[row]
+
+    return edge_label, np.bincount(labels[row], minlength=n_node)
+
+def suprathreshold(r, threshold, tail='both'):
+    '''
+    (array, float, str) -> array
+    This function returns the edges whose partial correlation is beyond the primary threshold: |r| >= threshold (both),
+    r >= threshold (pos) or r <= -threshold (neg)
+    '''
+    if tail == 'pos':
+        return r >= threshold
+    if tail == 'neg':
+        return r <= -threshold
+
+    return np.abs(r) >= threshold
+
+def pcorr_nbs(conn, dv, age, gender, idx, n_roi, threshold, tail='both', block_size=None):
+    '''
+    (array, array, array, array, array, int, float, str, int) -> array, array, array, array, array
+    This function runs the network-based statistic (Zalesky et al., 2010) on the spearman partial correlation of every edge (conn is
+    subjects x all upper-triangle edges): the edges beyond the primary threshold form connected components, whose size (number of edges)
+    is tested against the maximum component size of each shuffle. The components of each block of shuffles are found right after
+    its correlations are computed, so only the maximum size of each shuffle is kept.
+    idx must be one set of shuffles shared by all edges (shuffles x subjects), as the components need the same shuffle for every edge.
+    Returns the observed partial correlations, the component of each edge (-1 below threshold), the size and FWE corrected p-value of
+    each observed component, and the maximum component size of each shuffle
+    '''
+    if idx.ndim != 2:
+        raise ValueError('the network-based statistic needs the same shuffles for every edge (a shared index)')
+    idx = np.asarray(idx)
+    x = np.asarray(conn, dtype=float)
+    if x.shape[1] != n_roi * (n_roi - 1) // 2:
+        raise ValueError(f'the network-based statistic needs all {n_roi * (n_roi - 1) // 2} edges, got {x.shape[1]}')
+    # the rows of conn, dv & the covariates and the columns of idx are the same subjects
+    if not len(x) == len(dv) == len(age) == len(gender) == idx.shape[1]:
+        raise ValueError(f'{len(x)} connectivity rows, {len(dv)} dv values and shuffles of {idx.shape[1]} subjects do not match')
+    n_shuffle = idx.shape[0]
+    data = rank_inputs(x, dv, age, gender)
+    edges = slice(0, x.shape[1])
+    if block_size is None:
+        block_size = shuffle_block_size(len(x), x.shape[1], False)
+
+    # the observed correlation is the identity shuffle
+    r_obs = pcorr_tile(data, np.arange(len(x))[np.newaxis], edges, slice(0, 1))[0]
+    edge_label, sizes = edge_components(suprathreshold(r_obs, threshold, tail), n_roi)
+    edge_label = edge_label[0]
+
+    max_size = np.zeros(n_shuffle, dtype=int)
+    for start in range(0, n_shuffle, block_size):
+        shuffles = slice(start, min(start + block_size, n_shuffle))
+        block_label, block_sizes = edge_components(suprathreshold(pcorr_tile(data, idx, edges, shuffles), threshold, tail), n_roi)
+        max_size[shuffles] = np.where(block_label >= 0, block_sizes[np.maximum(block_label, 0)], 0).max(axis=1)
+
+    # number the observed components from 0 and test their size against the maximum size of the shuffles
+    components, edge_component = np.unique(edge_label[edge_label >= 0], return_inverse=True)
+    component = np.full(len(edge_label), -1)
+    component[edge_label >= 0] = edge_component
+    component_size = sizes[components]
+    p_value = ((max_size[np.newaxis] >= component_size[:, np.newaxis]).sum(axis=1) + 1) / (n_shuffle + 1)
+
+    return r_obs, component, component_size, p_value, max_size
@@ -0,0 +1,161 @@
+import os
+import sys
+import argparse
+import subprocess
+import multiprocessing as mp
+import pandas as pd
+from shuffle_index_fun import feature_ids, index_dtype
+from shard_fun import measure_unit_cost, feature_memory, tile_memory, plan_shards, write_shards, read_shards
+
+# set input parameters
+parser = argparse.ArgumentParser(description='split the edges into balanced shards for acq_edge_shuffle_pcorr_schaefer.py')
+parser.add_argument(
+    '--shuffle_time',
+    action='store',
+    type=int,
+    default=1000,
+    help='the number of shuffles')
+parser.add_argument(
+    '--unit_cost',
+    action='store',
+    type=float,
+    help='the measured seconds per edge per shuffle of one process, measured on random data of the same size when not given')
+parser.add_argument(
+    '--target_time',
+    action='store',
+    type=float,
+    default=20,
+    help='the wall time of a shard in hours, below the time limit of the jobs')
+parser.add_argument(
+    '--overhead',
+    action='store',
+    type=float,
+    default=600,
+    help='the seconds a job spends loading the data & shuffle index')
+parser.add_argument(
+    '--workers',
+    action='store',
+    type=int,
+    default=2,
+    help='the number of processes of each shard (--cpus-per-task of the jobs)')
+parser.add_argument(
+    '--slots',
+    action='store',
+    type=int,
+    default=1,
+    help='the number of shards that run at once, the number of shards is a multiple of it')
+parser.add_argument(
+    '--max_shards',
+    action='store',
+    type=int,
+    help='the largest number of shards (e.g. the array size limit of SLURM)')
+parser.add_argument(
+    '--mem',
+    action='store',
+    type=float,
+    default=2,
+    help='the memory of a shard in GB (--mem of the jobs), the shards are small enough for their shuffle index to fit in it')
+parser.add_argument(
+    '--base_mem',
+    action='store',
+    type=float,
+    default=0.5,
+    help='the GB a job uses besides its edges & tiles (python, the packages & the dv data)')
+parser.add_argument(
+    '--shared_index',
+    action='store_true',
+    help='every edge uses the shuffles of edge 0')
+parser.add_argument(
+    '--shard_file',
+    action='store',
+    help='the shard list (one idx_min,idx_max line per shard), idx_list_schaefer.txt by default. An existing list is kept unless --force')
+parser.add_argument(
+    '--force',
+    action='store_true',
+    help='replace an existing shard list, the tasks of an array that is still pending or requeued read their range from it')
+parser.add_argument(
+    '--run_local',
+    action='store',
+    type=int,
+    help='run the shards of the shard list in a local pool of this many processes instead of planning')
+parser.add_argument(
+    '--acq',
+    action='store',
+    help='acquisition id of the local run')
+parser.add_argument(
+    '--dv',
+    action='store',
+    help='dv name of the local run')
+args = parser.parse_args()
+
+# set study parameter
+base_dir = '/home/kcheung3/sanlab/DEV_RS'
+# the shards run the edge script next to this one
+script_dir = os.path.dirname(os.path.abspath(__file__))
+shard_file = args.shard_file or os.path.join(base_dir, 'baseline_analysis', 'idx_list_schaefer.txt')
+shuffle_time = args.shuffle_time
+workers = args.workers
+shared_index = args.shared_index
+if args.run_local is not None and (args.acq is None or args.dv is None):
+    parser.error('--run_local needs --acq and --dv')
+
+def run_shard(shard):
+    '''
+    (tuple) -> tuple, int
+    This function runs the edge shuffles of one shard (idx_min, idx_max) in a subprocess, as a SLURM array task does.
+    The null store of the shard is resumed when the shard is rerun
+    '''
+    idx_min, idx_max = shard
+    command = [sys.executable, os.path.join(script_dir, 'acq_edge_shuffle_pcorr_schaefer.py'), '--acq', args.acq, '--dv', args.dv,
+               '--idx_type', 'edge', '--idx_min', str(idx_min), '--idx_max', str(idx_max), '--shuffle_time', str(shuffle_time),
+               '--output_format', 'both', '--workers', str(workers)]
+    if shared_index:
+        command.append('--shared_index')
+
+    return shard, subprocess.run(command).returncode
+
+if args.run_local is not None:
+    # run the shards planned for SLURM in a local process pool
+    shards = read_shards(shard_file)
+    pool = mp.get_context('fork').Pool(args.run_local)
+    failed = [shard for shard, returncode in pool.imap_unordered(run_shard, shards) if returncode != 0]
+    pool.close()
+    pool.join()
+    if failed:
+        print(len(failed), 'of', len(shards), 'shards failed:', ' '.join(f'{idx_min},{idx_max}' for idx_min, idx_max in failed))
+        sys.exit(1)
+    print('all', len(shards), 'shards completed')
+    sys.exit(0)
+
+# keep the shards of a previous plan, the null stores of their tasks are resumed by range
+if os.path.exists(shard_file) and not args.force:
+    print('keep the', len(read_shards(shard_file)), 'shards of', shard_file, '(use --force to plan again)')
+    sys.exit(0)
+
+# the shards are ranges of the sorted edge IDs, the order of the binary shuffle index and of load_index
+n_edge = len(feature_ids('edge'))
+# all the subjects of the dv data, the subjects with connectivity are a subset so the memory of a shard is not underestimated
+n_sub = len(pd.read_csv(os.path.join(base_dir, 'dv_data', 'outputs', 'sub_data_baseline_w_clean.csv')))
+unit_cost = args.unit_cost
+if unit_cost is None:
+    unit_cost = measure_unit_cost(n_sub, per_feature=not shared_index)
+    print(f'measured {unit_cost:.3g} seconds per edge per shuffle with {n_sub} subjects')
+
+# the stacked shuffle index of the edges of a shard has to fit in the memory of its job, next to the tile of each process
+edge_mem = feature_memory(n_sub, shuffle_time, not shared_index, workers, index_dtype(n_sub).itemsize)
+job_mem = args.base_mem * 1024 ** 3 + workers * tile_memory(n_sub, not shared_index)
+if job_mem >= args.mem * 1024 ** 3:
+    print(f'the tiles of {workers} processes need {job_mem / 1024 ** 3:.2f} GB with the base memory, raise --mem or use fewer --workers')
+    sys.exit(1)
+mem_limit = int(args.mem * 1024 ** 3 - job_mem)
+shards, shard_time = plan_shards(n_edge, shuffle_time, unit_cost, args.target_time * 3600, args.overhead, workers, args.slots, args.max_shards,
+                                 edge_mem, mem_limit)
+write_shards(shard_file, shards)
+
+shard_edge = max(idx_max - idx_min for idx_min, idx_max in shards)
+shard_mem = (job_mem + shard_edge * edge_mem) / 1024 ** 3
+print(f'{len(shards)} shards of {shard_edge} edges or fewer, about {shard_time / 3600:.2f} hours and {shard_mem:.2f} GB each, saved to', shard_file)
+if shard_time > args.target_time * 3600:
+    print('warning: the shards exceed the target time, allow more shards with --max_shards')
+if shard_mem > args.mem:
+    print('warning: the shards exceed the memory of a job, allow more shards with --max_shards or raise --mem')
@@ -0,0 +1,96 @@
+import math
+import time
+import numpy as np
+from permutation_fun import pcorr_shuffle, shuffle_block_size
+
+def measure_unit_cost(n_sub, per_feature=True, n_feature=500, n_shuffle=None, seed=0):
+    '''
+    (int, bool, int, int, int) -> float
+    This function times the permutation engine (one process) on random data of n_sub subjects, and returns the seconds per
+    feature per shuffle. The cost only depends on the data size, so random data gives the cost of the real data.
+    per_feature is True when every feature has its own shuffles, False for a shared shuffle index
+    '''
+    rng = np.random.default_rng(seed)
+    if n_shuffle is None:
+        # one full tile of shuffles
+        n_shuffle = shuffle_block_size(n_sub, n_feature, per_feature)
+    conn = rng.standard_normal((n_sub, n_feature))
+    dv, age = rng.standard_normal(n_sub), rng.standard_normal(n_sub)
+    gender = rng.integers(0, 2, n_sub).astype(float)
+    shape = (n_feature, n_shuffle) if per_feature else (n_shuffle,)
+    idx = np.argsort(rng.random(shape + (n_sub,)), axis=-1)
+
+    start = time.perf_counter()
+    pcorr_shuffle(conn, dv, age, gender, idx)
+
+    return (time.perf_counter() - start) / (n_feature * n_shuffle)
+
+def feature_memory(n_sub, n_shuffle, per_feature=True, workers=1, itemsize=2):
+    '''
+    (int, int, bool, int, int) -> int
+    This function returns the bytes a shard job holds per feature: the stacked shuffle index of the feature (shuffles x subjects of
+    itemsize bytes, see index_dtype) and its copy in shared memory when workers > 1, plus the connectivity, its ranks and their
+    shared copy (float64). per_feature is False for a shared shuffle index, which does not grow with the features
+    '''
+    index_copies = 2 if workers > 1 else 1
+    index_bytes = n_shuffle * n_sub * itemsize * index_copies if per_feature else 0
+
+    return index_bytes + 3 * n_sub * 8
+
+def tile_memory(n_sub, per_feature=True, feature_block=500):
+    '''
+    (int, bool, int) -> int
+    This function returns the bytes one process of a shard job uses to compute a tile: the tile index and the shuffled dv, covariates
+    & residuals, about 6 float64 arrays of the tile size (measured ~45 bytes per value). It does not depend on the number of features
+    of the shard, every process of the job holds one tile at a time
+    '''
+    block_size = shuffle_block_size(n_sub, feature_block, per_feature)
+
+    return 6 * 8 * block_size * n_sub * (feature_block if per_feature else 1)
+
+def plan_shards(n_feature, n_shuffle, unit_cost, target_time, overhead=0, workers=1, slots=1, max_shards=None, feature_mem=0,
+                mem_limit=None):
+    '''
+    (int, int, float, float, float, int, int, int, int, int) -> list, float
+    This function splits the sorted features into contiguous shards that each finish within target_time seconds.
+    The cost of a shard is its features x n_shuffle x unit_cost (seconds per feature per shuffle) over its workers, plus the fixed
+    overhead of a job (loading the data & index). When mem_limit is given, there are also enough shards for the features of a shard
+    to fit in mem_limit bytes at feature_mem bytes each (see feature_memory). The number of shards is rounded up to a multiple
+    of slots (the jobs that run at once), and the features are split into shards whose sizes differ by at most one, so the shards
+    finish together. The plan only depends on the arguments. Returns the (idx_min, idx_max) of each shard and the expected time of a shard
+    '''
+    if target_time <= overhead:
+        raise ValueError(f'the target time ({target_time}s) does not cover the overhead of a job ({overhead}s)')
+    total_cost = n_feature * n_shuffle * unit_cost / workers
+    n_shard = max(1, math.ceil(total_cost / (target_time - overhead)))
+    if mem_limit is not None and feature_mem > 0:
+        max_features = mem_limit // feature_mem
+        if max_features < 1:
+            raise ValueError(f'one feature needs {feature_mem} bytes, more than the memory of a job ({mem_limit} bytes)')
+        n_shard = max(n_shard, math.ceil(n_feature / max_features))
+    n_shard = math.ceil(n_shard / slots) * slots
+    if max_shards is not None:
+        n_shard = min(n_shard, max_shards)
+    n_shard = min(n_shard, n_feature)
+
+    bounds = [n_feature * i // n_shard for i in range(n_shard + 1)]
+    shard_time = math.ceil(n_feature / n_shard) * n_shuffle * unit_cost / workers + overhead
+
+    return list(zip(bounds[:-1], bounds[1:])), shard_time
+
+def write_shards(shard_file, shards):
+    '''
+    (str, list) -> None
+    This function writes one idx_min,idx_max line per shard, the layout of idx_list_schaefer.txt
+    '''
+    with open(shard_file, 'w') as f:
+        for idx_min, idx_max in shards:
+            f.write(f'{idx_min},{idx_max}\n')
+
+def read_shards(shard_file):
+    '''
+    (str) -> list
+    This function reads the (idx_min, idx_max) of each shard written by write_shards
+    '''
+    with open(shard_file) as f:
+        return [tuple(int(idx) for idx in line.split(',')) for line in f if line.strip()]
@@ -0,0 +1,69 @@
+import os
+import argparse
+import pandas as pd
+from shuffle_index_fun import index_store_path, convert_csv_index, feature_ids, export_generated_index
+from connectivity_fun import acq_sub_ids
+
+# set input parameters
+parser = argparse.ArgumentParser(description='shuffle index')
+parser.add_argument(
+    '--idx_type',
+    required=True,
+    action='store',
+    help='roi or edge')
+parser.add_argument(
+    '--mode',
+    required=True,
+    action='store',
+    choices=['convert', 'export'],
+    help='convert: convert the shuffle index csv files into one binary shuffle index; '
+         'export: write the shuffles generated from --seed as csv files and a binary shuffle index')
+parser.add_argument(
+    '--seed',
+    action='store',
+    type=int,
+    help='the seed of the generated shuffles (export)')
+parser.add_argument(
+    '--shuffle_time',
+    action='store',
+    type=int,
+    default=1000,
+    help='the number of shuffles (export)')
+parser.add_argument(
+    '--acq',
+    action='store',
+    help='acquisition id (export): the shuffles permute the included subjects with connectivity of this acq, as the pcorr scripts '
+         'with --seed do. Without it they permute every row of the physio data set, as the graph shuffle scripts do')
+args = parser.parse_args()
+
+# set study parameter
+base_dir = '/home/kcheung3/sanlab/DEV_RS'
+idx_root = os.path.join(base_dir, 'baseline_analysis', 'shuffle_index')
+idx_type = args.idx_type
+
+if args.mode == 'convert':
+    # convert the per ROI/edge csv files into a single memory-mapped file
+    idx_dir = os.path.join(idx_root, f'{idx_type}_shuffle_schaefer')
+    store_file = index_store_path(idx_root, idx_type)
+    features = convert_csv_index(idx_dir, store_file)
+    print('conversion completed.', len(features), f'{idx_type} shuffle indices are saved to', store_file)
+
+elif args.mode == 'export':
+    if args.seed is None:
+        parser.error('--seed is required to export the generated shuffles')
+    # the shuffles permute the rows of the physio data set
+    base_dv = pd.read_csv(os.path.join(base_dir, 'dv_data', 'outputs', 'sub_data_baseline_w_clean.csv'))
+    include_sid = list(base_dv['SID'])
+    suffix = f'_seed{args.seed}'
+    if args.acq is not None:
+        # the pcorr scripts keep the included subjects with connectivity of the acq
+        conn_sid = set(acq_sub_ids(base_dir, idx_type, args.acq))
+        include_sid = [sub_id for sub_id in include_sid if sub_id in conn_sid]
+        if not include_sid:
+            raise ValueError(f'none of the included subjects has {idx_type} connectivity of acq {args.acq}')
+        suffix = f'_acq{args.acq}' + suffix
+    # write next to the existing index so that it is not overwritten
+    idx_dir = os.path.join(idx_root, f'{idx_type}_shuffle_schaefer{suffix}')
+    store_file = os.path.join(idx_root, f'{idx_type}_shuffle_schaefer{suffix}.idx')
+    export_generated_index(args.seed, feature_ids(idx_type), args.shuffle_time, len(include_sid), idx_type, idx_dir=idx_dir, store_file=store_file)
+    print('export completed. The shuffles of', len(include_sid), 'subjects are saved to', idx_dir, 'and', store_file)
@@ -0,0 +1,211 @@
+import os
+import glob
+import re
+import json
+import numpy as np
+import pandas as pd
+
+# the binary shuffle index starts with a magic string and the length of a json header, the index array starts at a page boundary
+store_magic = b'DEVRSIDX'
+store_align = 4096
+
+def index_store_path(idx_root, index_type):
+    '''
+    (str, str) -> str
+    This function returns the path of the binary shuffle index of the ROIs/edges (index_type), next to the csv directory
+    '''
+    return os.path.join(idx_root, f'{index_type}_shuffle_schaefer.idx')
+
+def store_offset(header_len):
+    '''
+    (int) -> int
+    This function returns the byte offset of the index array, the first page boundary after the header
+    '''
+    return -(-(len(store_magic) + 4 + header_len) // store_align) * store_align
+
+def index_dtype(n_sub):
+    '''
+    (int) -> dtype
+    This function chooses the smallest integer type that can index n_sub subjects
+    '''
+    return np.dtype(np.int16) if n_sub <= np.iinfo(np.int16).max else np.dtype(np.int32)
+
+def create_index_store(store_file, features, shuffle_time, n_sub):
+    '''
+    (str, list, int, int) -> memmap
+    This function writes the header of a binary shuffle index and returns the (features x shuffles x subjects) array as a writable memmap
+    '''
+    dtype = index_dtype(n_sub)
+    header = json.dumps({
+        'version': 1,
+        'dtype': dtype.str,
+        'shape': [len(features), shuffle_time, n_sub],
+        'features': [str(feature) for feature in features]
+    }).encode()
+    # pad the header so that the array starts at a page boundary
+    offset = store_offset(len(header))
+    with open(store_file, 'wb') as f:
+        f.write(store_magic)
+        f.write(np.uint32(len(header)).tobytes())
+        f.write(header)
+        f.write(b'\0' * (offset - f.tell()))
+
+    return np.memmap(store_file, dtype=dtype, mode='r+', offset=offset, shape=(len(features), shuffle_time, n_sub))
+
+def open_index_store(store_file):
+    '''
+    (str) -> memmap, list
+    This function opens a binary shuffle index read-only. It returns the (features x shuffles x subjects) memmap and the feature IDs.
+    Nothing is read until a feature is sliced, and concurrent jobs share the file through the page cache
+    '''
+    with open(store_file, 'rb') as f:
+        if f.read(len(store_magic)) != store_magic:
+            raise ValueError(f'{store_file} is not a shuffle index file')
+        header_len = int(np.frombuffer(f.read(4), dtype=np.uint32)[0])
+        header = json.loads(f.read(header_len).decode())
+    idx = np.memmap(store_file, dtype=np.dtype(header['dtype']), mode='r', offset=store_offset(header_len), shape=tuple(header['shape']))
+
+    return idx, header['features']
+
+def load_index_store(store_file, features=None):
+    '''
+    (str, list) -> dict
+    This function returns a dictionary of the (shuffles x subjects) index of each ROI/edge in features (all when None).
+    The values are views of the memmap, so only the shuffles that are used are read from disk
+    '''
+    idx, store_features = open_index_store(store_file)
+    if features is None:
+        features = store_features
+    row = {feature: i for i, feature in enumerate(store_features)}
+
+    return {feature: idx[row[feature]] for feature in features}
+
+def csv_index_files(idx_dir):
+    '''
+    (str) -> dict
+    This function lists the shuffle index csv files of a directory, keyed by the ROI/edge ID in the file name
+    '''
+    idx_files = {}
+    for file in glob.glob(os.path.join(idx_dir, '*.csv')):
+        shuffle_key = re.split('[/_.]', file)[len(re.split('[/_.]', file))-2]
+        idx_files[shuffle_key] = file
+
+    return idx_files
+
+def convert_csv_index(idx_dir, store_file):
+    '''
+    (str, str) -> list
+    This function converts a directory of shuffle index csv files (one shuffles x subjects file per ROI/edge) into a binary shuffle index.
+    The features are sorted by their numeric ID, and the csv files are read one at a time. Returns the feature IDs
+    '''
+    idx_files = csv_index_files(idx_dir)
+    features = sorted(idx_files, key=int)
+    first_df = pd.read_csv(idx_files[features[0]], sep=',', header=None)
+
+    idx = create_index_store(store_file, features, first_df.shape[0], first_df.shape[1])
+    for i, feature in enumerate(features):
+        inx_df = first_df if i == 0 else pd.read_csv(idx_files[feature], sep=',', header=None)
+        if inx_df.shape != idx.shape[1:]:
+            raise ValueError(f'the shuffle index of {feature} has shape {inx_df.shape}, expected {idx.shape[1:]}')
+        idx[i] = inx_df.to_numpy()
+    idx.flush()
+
+    return features
+
+def feature_ids(index_type, n_roi=100):
+    '''
+    (str, int) -> list
+    This function returns the IDs of the ROIs or of the upper-triangle edges between n_roi ROIs
+    '''
+    n_feature = n_roi if index_type == 'roi' else n_roi * (n_roi - 1) // 2
+
+    return [str(feature) for feature in range(n_feature)]
+
+def shuffle_permutations(seed, feature, n_sub, start, stop):
+    '''
+    (int, int, int, int, int) -> array
+    This function reproduces the shuffles start:stop of a ROI/edge (feature) without touching disk.
+    Each shuffle is the argsort of n_sub random 64-bit words from a Philox counter-based generator, keyed by the seed and
+    with the feature & shuffle number in the counter, so a given (seed, feature, shuffle) always gives the same permutation
+    regardless of which block it is generated in. Returns an array of shuffles x subjects
+    '''
+    # Philox returns 4 words per counter step, each shuffle starts at a new counter step
+    words = -(-n_sub // 4) * 4
+    bit_generator = np.random.Philox(key=int(seed), counter=[start * words // 4, 0, int(feature), 0])
+    raw = bit_generator.random_raw((stop - start) * words).reshape(stop - start, words)[:, :n_sub]
+
+    return np.argsort(raw, axis=1, kind='stable')
+
+class ShuffleGenerator:
+    '''
+    A (features x shuffles x subjects) shuffle index that is generated on the fly with shuffle_permutations,
+    so the permutation engine can request one block of shuffles at a time instead of loading an index file
+    '''
+    def __init__(self, seed, features, shuffle_time, n_sub):
+        self.seed = seed
+        self.features = [str(feature) for feature in features]
+        self.shape = (len(self.features), shuffle_time, n_sub)
+        self.ndim = 3
+
+    def __getitem__(self, feature):
+        '''
+        (str) -> array
+        This function returns all shuffles (shuffles x subjects) of a ROI/edge
+        '''
+        return shuffle_permutations(self.seed, feature, self.shape[2], 0, self.shape[1])
+
+    def block(self, start, stop, features=slice(None)):
+        '''
+        (int, int, slice) -> array
+        This function returns the shuffles start:stop of the ROIs/edges in the features slice or positions (features x shuffles x subjects)
+        '''
+        stop = min(stop, self.shape[1])
+        # features is a slice or an array of feature positions
+        features = np.arange(len(self.features))[features]
+        return np.stack([shuffle_permutations(self.seed, self.features[f], self.shape[2], start, stop) for f in features])
+
+def stack_index(idx_dic, features, shuffle_time):
+    '''
+    (dict, list, int) -> array
+    This function stacks the first shuffle_time shuffles of the features in idx_dic into a (features x shuffles x subjects) index,
+    or returns the (shuffles x subjects) index under the key 'shared' that is used for every feature.
+    Generated shuffles (ShuffleGenerator) are returned as they are, the permutation engine requests them block by block
+    '''
+    if isinstance(idx_dic, ShuffleGenerator):
+        return idx_dic
+    if 'shared' in idx_dic:
+        return np.asarray(idx_dic['shared'][:shuffle_time])
+
+    return np.stack([np.asarray(idx_dic[feature][:shuffle_time]) for feature in features])
+
+def index_subjects(idx_dic):
+    '''
+    (dict) -> int
+    This function returns the number of subjects that the shuffles of idx_dic permute
+    '''
+    if isinstance(idx_dic, ShuffleGenerator):
+        return idx_dic.shape[2]
+
+    return np.shape(next(iter(idx_dic.values())))[-1]
+
+def export_generated_index(seed, features, shuffle_time, n_sub, index_type, idx_dir=None, store_file=None):
+    '''
+    (int, list, int, int, str, str, str) -> None
+    This function writes the generated shuffles of each ROI/edge in the legacy csv layout (one {index_type}_shuffle_{feature}.csv file
+    of shuffles x subjects per ROI/edge, no header) to idx_dir, and/or into a binary shuffle index (store_file)
+    '''
+    generator = ShuffleGenerator(seed, features, shuffle_time, n_sub)
+    if store_file is not None:
+        idx = create_index_store(store_file, generator.features, shuffle_time, n_sub)
+    if idx_dir is not None:
+        os.makedirs(idx_dir, exist_ok=True)
+
+    for i, feature in enumerate(generator.features):
+        shuffles = generator[feature]
+        if store_file is not None:
+            idx[i] = shuffles
+        if idx_dir is not None:
+            pd.DataFrame(shuffles).to_csv(os.path.join(idx_dir, f'{index_type}_shuffle_{feature}.csv'), index=False, header=False)
+
+    if store_file is not None:
+        idx.flush()
@@ -1,5 +1,10 @@
 import os
+import sys
 import argparse
+import traceback
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import glob
 import numpy as np
 import pandas as pd
@@ -20,19 +25,57 @@ import networkx as nx
 from nilearn.plotting import plot_stat_map, view_img_on_surf
 from bids import BIDSLayout, BIDSValidator
 import nibabel as nib
+from connectivity_fun import corr_cube_path, write_corr_cube, cube_sub_ids
+from cache_fun import cache_key, load_cache, save_cache
+from denoise_fun import parcel_residual, compare_corr, motion_columns, motion_24, signal_series, acq_series, nuisance_design
+from nifti_fun import same_grid, load_masked_data
+from parcel_fun import parcel_index, extract_parcels
 
-def extractData(base_dir, sub_id):
+def data_files(base_dir, sub_id):
     '''
     (str, str) -> list
-    This function is used to extract data from a specifc baseline acq (acq_id) of subject (sub_id) and concatenate them together. 
+    This function returns the preprocessed NIfTI file of each baseline acq of subject (sub_id)
     '''
-    # set directory & file names
     data_dir = os.path.join(base_dir, 'bids_data','rs_postfmriprep', f'sub-{sub_id}')
     acq1_filename = f'sub-{sub_id}_ses-wave1_task-rest_acq-1_bold_space-MNI152NLin2009cAsym_preproc.nii.gz'
     acq2_filename = f'sub-{sub_id}_ses-wave1_task-rest_acq-2_bold_space-MNI152NLin2009cAsym_preproc.nii.gz'
+
+    return [os.path.join(data_dir, acq1_filename), os.path.join(data_dir, acq2_filename)]
+
+def covariate_files(base_dir, sub_id):
+    '''
+    (str, str) -> list
+    This function returns the confounds tsv file of each baseline acq of subject (sub_id)
+    '''
+    cov_dir = os.path.join(base_dir, 'bids_data', 'rs_derivatives','fmriprep', f'sub-{sub_id}', 'ses-wave1', 'func')
+    cov_fileName_1 = f'sub-{sub_id}_ses-wave1_task-rest_acq-1_bold_confounds.tsv'
+    cov_fileName_2 = f'sub-{sub_id}_ses-wave1_task-rest_acq-2_bold_confounds.tsv'
+
+    return [os.path.join(cov_dir, cov_fileName_1), os.path.join(cov_dir, cov_fileName_2)]
+
+def extractData(base_dir, sub_id, stream=False):
+    '''
+    (str, str, bool) -> list
+    This function is used to extract data from a specifc baseline acq (acq_id) of subject (sub_id) and concatenate them together. 
+    With stream, the brain voxels of both acqs are read block by block into one preallocated array (see load_masked_data), and the
+    acq data are views of the concatenated data instead of copies. Files that are not on the grid of the brain mask are resampled by
+    Brain_Data as before
+    '''
+    # set file names
+    acq1_file, acq2_file = data_files(base_dir, sub_id)
+    # an empty Brain_Data holds the default brain mask
+    data_concate = Brain_Data()
+    if stream and same_grid(acq1_file, data_concate.mask) and same_grid(acq2_file, data_concate.mask):
+        data_concate.data, (n_acq1, _) = load_masked_data([acq1_file, acq2_file], data_concate.mask)
+        acq1_data = Brain_Data()
+        acq1_data.data = data_concate.data[:n_acq1]
+        acq2_data = Brain_Data()
+        acq2_data.data = data_concate.data[n_acq1:]
+        return [data_concate, acq1_data, acq2_data]
+
     # extract data from each acq
-    acq1_data = Brain_Data(load_img(os.path.join(data_dir, acq1_filename)))
-    acq2_data = Brain_Data(load_img(os.path.join(data_dir, acq2_filename)))
+    acq1_data = Brain_Data(load_img(acq1_file))
+    acq2_data = Brain_Data(load_img(acq2_file))
     # concatenate both acq
     data_concate = acq1_data.append(acq2_data)
 
@@ -43,12 +86,10 @@ def load_covariates(base_dir, sub_id):
     (str, str) -> list
     This function load the covariates tsv files of the given acq(acq_id). 
     '''
-    cov_dir = os.path.join(base_dir, 'bids_data', 'rs_derivatives','fmriprep', f'sub-{sub_id}', 'ses-wave1', 'func')
-    cov_fileName_1 = f'sub-{sub_id}_ses-wave1_task-rest_acq-1_bold_confounds.tsv'
-    cov_fileName_2 = f'sub-{sub_id}_ses-wave1_task-rest_acq-2_bold_confounds.tsv'
+    cov_file_1, cov_file_2 = covariate_files(base_dir, sub_id)
 
-    covariates_1 = pd.read_csv(os.path.join(cov_dir, cov_fileName_1), sep = '\t')
-    covariates_2 = pd.read_csv(os.path.join(cov_dir, cov_fileName_2), sep = '\t')
+    covariates_1 = pd.read_csv(cov_file_1, sep = '\t')
+    covariates_2 = pd.read_csv(cov_file_2, sep = '\t')
 
     cov_concate = pd.concat([covariates_1, covariates_2]).reset_index()
 
@@ -58,41 +99,135 @@ def make_motion_covariates(covariates, tr):
     '''
     (DataFrame) -> DataFrame
 
-    This function extract and process motion regressors. This function will be called by make_design_matrix
+    This function extract and process motion regressors (the 24-parameter model, see motion_24)
     '''
-    mc = covariates[['X','Y','Z','RotX', 'RotY', 'RotZ']]
-    z_mc = zscore(mc)
-    all_mc = pd.concat([z_mc, z_mc**2, z_mc.diff(), z_mc.diff()**2], axis=1)
-    all_mc.fillna(value=0, inplace=True)
-    return Design_Matrix(all_mc, sampling_freq=1/tr)
+    all_mc = motion_24(covariates[motion_columns].to_numpy(dtype=float))
+    columns = motion_columns + [f'{col}^2' for col in motion_columns] + [f'{col}_diff' for col in motion_columns] + [f'{col}_diff^2' for col in motion_columns]
+    return Design_Matrix(pd.DataFrame(all_mc, columns=columns), sampling_freq=1/tr)
 
-def make_design_matrix(data, covariates, tr):
+def make_design_matrix(data, covariates, tr, series=None, wm=True):
     '''
-    (Brain_Data, Data_Frame, float) -> 
-    This function will make a design matrix with the seed regressor and nusiance regressor including, motion, CSF, whitematter & spikes
+    (Brain_Data, Data_Frame, float, tuple, bool) -> Design_Matrix
+    This function will make a design matrix with the nusiance regressors including, motion, CSF, whitematter (unless wm is False), spikes
+    & polynomial drifts. series is the cached global signal & frame difference of the data used for the spikes (see signal_series),
+    they are computed from the data when not given
     '''
+    if series is None:
+        series = signal_series(data.data)
+    dm, columns = nuisance_design(covariates, series[0], series[1], wm=wm, spike_cutoff=3, poly_order=2)
 
-    other_cov = covariates[['CSF', 'WhiteMatter']].apply(zscore)
-    mc = make_motion_covariates(covariates, tr)
-    spikes = data.find_spikes(global_spike_cutoff=3, diff_spike_cutoff=3)
-    dm = Design_Matrix(pd.concat([other_cov, mc, spikes.drop(labels='TR', axis=1)], axis=1), sampling_freq=1/tr)
-    dm = dm.add_poly(order=2, include_lower=True)
+    return Design_Matrix(pd.DataFrame(dm, columns=columns), sampling_freq=1/tr)
 
-    return dm
+def make_design_matrix_noWM(data, covariates, tr, series=None):
+    '''
+    (Brain_Data, Data_Frame, float, tuple) -> Design_Matrix
+    This function will make a design matrix with the nusiance regressors including, motion, CSF, spikes & polynomial drifts
+    '''
+    return make_design_matrix(data, covariates, tr, series, wm=False)
 
-def make_design_matrix_noWM(data, covariates, tr):
+def denoise_roi(data, dm, roi_index, denoise='voxel', roi_data=None):
     '''
-    (Brain_Data, Data_Frame, float) -> 
-    This function will make a design matrix with the seed regressor and nusiance regressor including, motion, CSF, whitematter & spikes
+    (Brain_Data, Design_Matrix, dict, str, array) -> array
+    This function removes the nuisance regressors (dm) and returns the time series of each roi of the parcel index (ROIs x time).
+    The regressors are removed from every voxel before the ROI time series are extracted (denoise='voxel'),
+    or from the ROI time series (denoise='parcel'), which gives the same residuals for a fraction of the cost.
+    roi_data are the ROI time series of the data when they have been extracted already
     '''
+    if denoise == 'parcel':
+        # extract time series of each roi and denoise them
+        if roi_data is None:
+            roi_data = extract_parcels(data.data, roi_index)
+        return parcel_residual(roi_data, dm)
 
-    other_cov = covariates[['CSF']].apply(zscore)
-    mc = make_motion_covariates(covariates, tr)
-    spikes = data.find_spikes(global_spike_cutoff=3, diff_spike_cutoff=3)
-    dm = Design_Matrix(pd.concat([other_cov, mc, spikes.drop(labels='TR', axis=1)], axis=1), sampling_freq=1/tr)
-    dm = dm.add_poly(order=2, include_lower=True)
+    data.X = dm
+    # denoise the data
+    stats = data.regress()
+    data_denoised = stats['residual']
+    # extract time series of each roi
+    return extract_parcels(data_denoised.data, roi_index)
 
-    return dm
+def subject_corr(base_dir, sub_id, roi_index, tr, denoise='voxel', validate=False, stream=False, design='full', acqs=['concat']):
+    '''
+    (str, str, dict, float, str, bool, bool, str, list) -> dict
+    This function denoises the data of a subject (sub_id) in voxel or parcel space (see denoise_roi) and computes the correlation matrix
+    between the ROIs of the parcel index, for each acq in acqs ('1', '2' and/or 'concat'). The acqs are loaded once, the global signal &
+    frame difference are computed once over the concatenated data, and in parcel space the ROI time series are extracted once.
+    With validate, the other denoising space is computed as well and an error is raised when the two correlation matrices differ.
+    Returns a dictionary of the correlation matrix of each acq
+    '''
+    data_list = extractData(base_dir, sub_id, stream)
+    covariates_list = load_covariates(base_dir, sub_id)
+
+    # the position of each acq in the data & covariates lists, and its volumes in the concatenated data
+    acq_pos = {'concat': 0, '1': 1, '2': 2}
+    n_acq1 = data_list[1].data.shape[0]
+    n_vol = data_list[0].data.shape[0]
+    acq_volumes = {'concat': slice(0, n_vol), '1': slice(0, n_acq1), '2': slice(n_acq1, n_vol)}
+    # compute the global signal & frame difference once for the spike regressors
+    series = signal_series(data_list[0].data)
+    # extract time series of each roi once for the parcel-space denoising
+    roi_data = extract_parcels(data_list[0].data, roi_index) if denoise == 'parcel' or validate else None
+
+    roi_corr = {}
+    for acq in acqs:
+        # load the data & the present covariates of the acq
+        data = data_list[acq_pos[acq]]
+        covariates = covariates_list[acq_pos[acq]]
+        acq_roi_data = None if roi_data is None else roi_data[:, acq_volumes[acq]]
+        # make a design matrix
+        dm = make_design_matrix(data, covariates, tr, acq_series(*series, acq_volumes[acq]), wm=design == 'full')
+        # denoise the data & extract time series of each roi
+        rois_data = denoise_roi(data, dm, roi_index, denoise, acq_roi_data)
+        # compute pair-wise correlation
+        roi_corr[acq] = 1 - pairwise_distances(rois_data, metric='correlation')
+
+        # compare the parcel-space denoising with the voxelwise denoising
+        if validate:
+            check_denoise = 'voxel' if denoise == 'parcel' else 'parcel'
+            check_corr = 1 - pairwise_distances(denoise_roi(data, dm, roi_index, check_denoise, acq_roi_data), metric='correlation')
+            max_diff, match = compare_corr(roi_corr[acq], check_corr)
+            print(f'{sub_id} acq {acq} parcel vs voxel denoising: max abs difference {max_diff:.3g}', flush=True)
+            if not match:
+                raise ValueError(f'the parcel-space denoising of {sub_id} acq {acq} does not match the voxelwise denoising ({max_diff:.3g})')
+
+    return roi_corr
+
+def run_subject(sub_id):
+    '''
+    (str) -> str, dict, str
+    This function runs subject_corr for a subject with the dataset parameters of this script, in the main process or in a pool worker.
+    An error is caught so that it only fails this subject. Returns the subject ID, the correlation matrix of each acq (None on failure)
+    and the error
+    '''
+    print('start with subject', sub_id, flush=True)
+    try:
+        return sub_id, subject_corr(bids_base_dir, sub_id, roi_index, tr, denoise, validate, stream, design, acqs), None
+    except Exception:
+        return sub_id, None, traceback.format_exc()
+
+def pool_results(futures):
+    '''
+    (dict) -> generator
+    This function yields the result of each subject of a process pool (futures maps each future to its subject) as it completes.
+    A worker killed by the system (e.g. out of memory) breaks the pool without returning, the subjects that did not complete
+    are then returned as failed instead of waiting forever
+    '''
+    for future in as_completed(futures):
+        try:
+            yield future.result()
+        except BrokenProcessPool:
+            yield futures[future], None, 'a pool worker was killed (e.g. out of memory) before the subject completed\n' + traceback.format_exc()
+
+def subject_memory(files, stream=False):
+    '''
+    (list, bool) -> int
+    This function estimates the peak memory (bytes) of processing a subject from the NIfTI headers of its acqs: the concatenated data,
+    the acqs it was appended from and the residuals are held in double precision at the same time. With stream, the acqs are views of
+    the concatenated data, which leaves the concatenated data and the residuals
+    '''
+    n_values = sum(int(np.prod(nib.load(file).shape)) for file in files)
+
+    return (2 if stream else 4) * 8 * n_values
 
 # set subject ID from the imput 
 #parser = argparse.ArgumentParser(description='subject level rs connectivity analysis')
@@ -103,43 +238,159 @@ def make_design_matrix_noWM(data, covariates, tr):
 #    help='subject id')
 #args = parser.parse_args()
 
+# set the output format
+parser = argparse.ArgumentParser(description='subject level rs connectivity analysis')
+parser.add_argument(
+    '--output_format',
+    action='store',
+    choices=['csv', 'hdf5', 'both'],
+    default='csv',
+    help='write one csv file per subject, append each subject to the connectome cube (hdf5), or both')
+parser.add_argument(
+    '--force',
+    action='store_true',
+    help='process every subject, even if its inputs and parameters are unchanged since the last run')
+parser.add_argument(
+    '--acqs',
+    action='store',
+    nargs='+',
+    choices=['1', '2', 'concat'],
+    default=['concat'],
+    help='the acqs to compute the correlation matrices of, all from the same loaded data')
+parser.add_argument(
+    '--design',
+    action='store',
+    choices=['full', 'noWM'],
+    default='full',
+    help='the nuisance regressors with or without the white matter signal')
+parser.add_argument(
+    '--denoise',
+    action='store',
+    choices=['voxel', 'parcel'],
+    default='voxel',
+    help='regress the nuisance signals out of every voxel, or out of the ROI time series')
+parser.add_argument(
+    '--validate',
+    action='store_true',
+    help='denoise in both voxel and parcel space and check that the correlation matrices match, for every subject including unchanged ones')
+parser.add_argument(
+    '--stream',
+    action='store_true',
+    help='read the brain voxels of both acqs block by block into one array, instead of loading and appending each acq')
+parser.add_argument(
+    '--jobs',
+    action='store',
+    type=int,
+    default=1,
+    help='the number of subjects processed at the same time')
+parser.add_argument(
+    '--mem_gb',
+    action='store',
+    type=float,
+    help='the memory budget (GB) of the subjects processed at the same time, limits the number of jobs')
+args = parser.parse_args()
+output_format = args.output_format
+force = args.force
+jobs = args.jobs
+denoise = args.denoise
+design = args.design
+acqs = args.acqs
+validate = args.validate
+stream = args.stream
+mem_gb = args.mem_gb
+
 # set dataset parameter
 base_dir = '/home/kcheung3/sanlab/DEV_RS/'
 bids_base_dir = '/projects/sanlab/shared/DEV/'
 sub_list_dir = os.path.join(base_dir, 'baseline_analysis', 'baseline_include_subjectList.txt')
 sub_list_file = open(sub_list_dir, "r")
-sub_list = sub_list_file.read().split("\n")
+# skip the empty line at the end of the file
+sub_list = [sub_id for sub_id in sub_list_file.read().split("\n") if sub_id]
 sub_list_file.close()
 tr = 0.78
+corr_root = os.path.join(base_dir, 'baseline_analysis', 'subject_correlation')
+cube_file = corr_cube_path(corr_root)
+cache_file = os.path.join(corr_root, 'baseline_acq_schaefer_cache.json')
+# the denoising parameters are part of the cache key, a subject is processed again when any of them changes
+denoise_params = {
+    'acq': sorted(acqs),
+    'tr': tr,
+    'design': ['CSF', 'WhiteMatter', 'motion_24', 'spikes', 'poly_2'] if design == 'full' else ['CSF', 'motion_24', 'spikes', 'poly_2'],
+    'spike_cutoff': {'global': 3, 'diff': 3},
+    # a frame difference spike marks the first volume of the pair, as find_spikes (the subjects cached with the second are redone)
+    'diff_spike': 'first',
+    'denoise': denoise,
+    'corr': 'pearson'
+}
 
 # load the parcellation mask
 mask_dir = os.path.join(base_dir, 'baseline_analysis')
-mask = Brain_Data(os.path.join(mask_dir, 'Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.nii.gz'))
-mask_x = expand_mask(mask)
+mask_file = os.path.join(mask_dir, 'Schaefer2018_100Parcels_7Networks_order_FSLMNI152_2mm.nii.gz')
+# the voxel to parcel index is built from the mask once and loaded in later runs
+roi_index = parcel_index(mask_file, lambda: Brain_Data(mask_file))
 
+# load the cache of the previous runs
+cache = load_cache(cache_file)
+cube_sid = {acq: cube_sub_ids(cube_file, acq) for acq in acqs}
+
+# find the subjects whose inputs, mask or parameters changed since the last run, or whose outputs are missing
+sub_keys = {}
+failed = {}
 for sub_id in sub_list: 
-    
-    print('start with subject', sub_id)
-    
-    data_list = extractData(bids_base_dir, sub_id)
-    covariates_list = load_covariates(bids_base_dir, sub_id)
-
-    # load the concatenated data
-    data = data_list[0]
-    # load the present covariates
-    covariates = covariates_list[0]
-    # make a design matrix
-    dm = make_design_matrix(data, covariates, tr)
-    data.X = dm
-    # denoise the data
-    stats = data.regress()
-    data_denoised = stats['residual']
-    # extract time series of each roi
-    rois_data = data_denoised.extract_roi(mask=mask)
-    # compute pair-wise correlation
-    roi_corr = 1 - pairwise_distances(rois_data, metric='correlation')
-    # write the correlation to file
-    fileName = sub_id + '_concat_corr.csv'
-    output_dir = os.path.join(base_dir, 'baseline_analysis', 'subject_correlation', 'baseline_acq_schaefer', fileName)
-    corr_df = pd.DataFrame(roi_corr)
-    corr_df.to_csv(output_dir, index=False, header=False)
+    try:
+        sub_key = cache_key(data_files(bids_base_dir, sub_id) + covariate_files(bids_base_dir, sub_id) + [mask_file], denoise_params, cache['files'])
+    except OSError:
+        failed[sub_id] = traceback.format_exc()
+        continue
+    csv_done = output_format == 'hdf5' or all(os.path.exists(os.path.join(corr_root, 'baseline_acq_schaefer', f'{sub_id}_{acq}_corr.csv')) for acq in acqs)
+    cube_done = output_format == 'csv' or all(sub_id in cube_sid[acq] for acq in acqs)
+    # a validation run checks every subject, the cached ones are processed again
+    if not force and not validate and cache['subjects'].get(sub_id) == sub_key and csv_done and cube_done:
+        print('skip unchanged subject', sub_id)
+        continue
+    sub_keys[sub_id] = sub_key
+
+# limit the number of jobs so that the subjects processed at the same time stay within the memory budget
+if mem_gb is not None and sub_keys:
+    sub_memory = max(subject_memory(data_files(bids_base_dir, sub_id), stream) for sub_id in sub_keys)
+    jobs = max(1, min(jobs, int(mem_gb * (1 << 30) // sub_memory)))
+    print('process', jobs, 'subjects at the same time')
+
+if jobs <= 1:
+    sub_results = map(run_subject, sub_keys)
+else:
+    # fork the workers, this script runs at import and cannot be re-imported by spawned workers.
+    # the workers are forked once before the connectome cube is opened, so they never inherit its file lock
+    # (all workers are forked at the first submit with the fork context)
+    pool = ProcessPoolExecutor(jobs, mp_context=mp.get_context('fork'))
+    sub_results = pool_results({pool.submit(run_subject, sub_id): sub_id for sub_id in sub_keys})
+
+# the outputs & the cache are written by the main process only
+for sub_id, roi_corr, error in sub_results:
+    if error is not None:
+        print('failed subject', sub_id, flush=True)
+        failed[sub_id] = error
+        continue
+    for acq in acqs:
+        # write the correlation to file
+        if output_format in ['csv', 'both']:
+            fileName = f'{sub_id}_{acq}_corr.csv'
+            output_dir = os.path.join(corr_root, 'baseline_acq_schaefer', fileName)
+            corr_df = pd.DataFrame(roi_corr[acq])
+            corr_df.to_csv(output_dir, index=False, header=False)
+        # append the correlation to the connectome cube
+        if output_format in ['hdf5', 'both']:
+            write_corr_cube(cube_file, acq, sub_id, roi_corr[acq])
+    # record the subject in the cache once its outputs are written
+    cache['subjects'][sub_id] = sub_keys[sub_id]
+    save_cache(cache_file, cache)
+
+if jobs > 1:
+    pool.shutdown()
+
+# summarize the failed subjects
+if failed:
+    for sub_id, error in failed.items():
+        print(f'subject {sub_id} failed:\n{error}')
+    print(len(failed), 'of', len(sub_list), 'subjects failed:', ' '.join(failed))
+    sys.exit(1)
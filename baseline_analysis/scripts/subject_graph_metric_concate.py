@@ -1,33 +1,30 @@
 import os
+import sys
+import argparse
+import traceback
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import numpy as np
 import pandas as pd
 import networkx as nx
 from nltools.data import Brain_Data, Design_Matrix, Adjacency
 from nltools.mask import expand_mask, roi_to_brain
+from connectivity_fun import corr_cube_path, cube_sub_ids, read_corr_cube
+from graph_fun import threshold_table, percentile_adjacency, proportional_adjacency, edge_to_matrix, graph_metrics, networkx_metrics, compare_metrics
+from graph_fun import density_levels, density_sweep, sweep_table, sweep_auc
+from graph_fun import weighted_adjacency, weighted_metrics, networkx_weighted_metrics
+from graph_fun import metric_store_path, checkpoint_records, write_checkpoint, read_checkpoint
+from cache_fun import array_key
 
-def coeff_threshold (edge_df, min_percentile, max_percentile, sub_id):
+def coeff_threshold (edge_mat, min_percentile, max_percentile, sub_ids):
     ''' 
-    (DataFrame, int, int)
-    This function generate the corresponding edge correlation coefiicents to a range of (min_percentile, max_percentile) with an increment of 1. 
+    (array, int, int, list) -> DataFrame
+    This function generate the corresponding edge correlation coefiicents to a range of (min_percentile, max_percentile) with an increment of 1,
+    for every subject of the cohort (subjects x edges) at once. Each row is a percentile of a subject
     '''
-
-    # extract the upper triangle of the edge weights, and sort it 
-    mask = np.triu(np.ones(edge_df.shape), k = 1).astype(bool).reshape(edge_df.size) # create a mask for the upper triangle
-    edge_df_stack = edge_df.stack()[mask].reset_index()
-    edge_stack = edge_df_stack.iloc[:,2]
-    edge_stack = np.array(sorted(edge_stack, reverse=True))
-
-    # calculate the coefficients corresponding to each percentile
-    coeff_threshold = [np.percentile(edge_stack, percentile) for percentile in range(min_percentile,max_percentile,1)]
-
-    # create a dataframe
-    coeff_threshold_df = pd.DataFrame(
-        {
-            "edge_coefficient": coeff_threshold,
-            "percentile" : list(range(min_percentile,max_percentile,1)),
-            "sub_id" : sub_id
-        }
-    )
+    # calculate the coefficients corresponding to each percentile of each subject in one call
+    coeff_threshold_df = threshold_table(edge_mat, list(range(min_percentile,max_percentile,1)), sub_ids)
 
     return coeff_threshold_df
 
@@ -43,10 +40,132 @@ def binary_network (edge_df, coeff_threshold, number_roi):
     G = a_thresholded.to_graph()
 
     return G
-    
+
+def run_subject(i):
+    '''
+    (int) -> int, dict, dict, dict, str
+    This function computes the graph metrics (and the density sweep & weighted metrics) of the i-th subject of the cohort, in the main
+    process or in a pool worker. An error is caught so that it only fails this subject. Returns the row of the subject, its metrics,
+    its sweep & weighted metrics (None when they are not requested) and the error
+    '''
+    sub = sub_ids[i]
+    print('start with subject', sub, flush=True)
+    try:
+        # generate network metric from the binary adjacency matrix
+        metrics = graph_metrics(edge_to_matrix(adjacency_mat[i], number_roi))
+
+        # compare with the networkx metrics of the graph
+        if validate:
+            if threshold_type == 'proportional':
+                G = nx.from_numpy_array(edge_to_matrix(adjacency_mat[i], number_roi).astype(int))
+            else:
+                G = binary_network(pd.DataFrame(corr_cube[i]), sub_threshold[i], number_roi)
+            metric_diff = compare_metrics(metrics, networkx_metrics(G))
+            print(sub, 'max abs difference to networkx', max(metric_diff.values()), flush=True)
+
+        # sweep the metrics over the densities of the 70th-90th percentiles, adding the edges from the strongest down
+        sub_sweep = None
+        if sweep:
+            if threshold_type == 'proportional':
+                levels = density_levels(edge_mat[i], sweep_densities)
+            else:
+                levels = percentile_adjacency(edge_mat[i], sub_thresholds[i])
+            sub_sweep = density_sweep(levels, number_roi)
+
+        # the weighted metrics of the full (unthresholded) graph of the positive correlations
+        sub_weighted = None
+        if weighted:
+            weights = weighted_adjacency(corr_cube[i])
+            sub_weighted = weighted_metrics(weights)
+            if validate:
+                metric_diff = compare_metrics(sub_weighted, networkx_weighted_metrics(nx.from_numpy_array(weights)))
+                print(sub, 'max abs difference of the weighted metrics to networkx', max(metric_diff.values()), flush=True)
+
+        return i, metrics, sub_sweep, sub_weighted, None
+    except Exception:
+        return i, None, None, None, traceback.format_exc()
+
+
+def pool_results(futures):
+    '''
+    (dict) -> generator
+    This function yields the result of each subject of a process pool (futures maps each future to the row of its subject) as it
+    completes. A worker killed by the system (e.g. out of memory) breaks the pool without returning, the subjects that did not complete
+    are then returned as failed instead of waiting forever
+    '''
+    for future in as_completed(futures):
+        try:
+            yield future.result()
+        except BrokenProcessPool:
+            yield futures[future], None, None, None, 'a pool worker was killed (e.g. out of memory) before the subject completed\n' + traceback.format_exc()
+
+# set the thresholding method
+parser = argparse.ArgumentParser(description='subject level graph metrics')
+parser.add_argument(
+    '--acq',
+    action='store',
+    choices=['1', '2', 'concat'],
+    default='concat',
+    help='the acq of the correlation matrices')
+parser.add_argument(
+    '--threshold_type',
+    action='store',
+    choices=['percentile', 'proportional'],
+    default='percentile',
+    help='binarize each graph at the coefficient of the 70th percentile, or keep the strongest edges up to the density')
+parser.add_argument(
+    '--density',
+    action='store',
+    type=float,
+    default=0.3,
+    help='the proportion of edges kept with proportional thresholding')
+parser.add_argument(
+    '--validate',
+    action='store_true',
+    help='also compute the metrics with networkx and check that they match, for every subject including checkpointed ones')
+parser.add_argument(
+    '--sweep',
+    action='store_true',
+    help='also compute the metrics at every density of the 70th-90th percentile range and their area under the curve')
+parser.add_argument(
+    '--weighted',
+    action='store_true',
+    help='also compute the weighted metrics of the full graph (strength, normalized strength, weighted clustering & efficiency)')
+parser.add_argument(
+    '--force',
+    action='store_true',
+    help='compute every subject, even if its checkpoint is complete and its edge weights & parameters are unchanged')
+parser.add_argument(
+    '--jobs',
+    action='store',
+    type=int,
+    default=1,
+    help='the number of subjects processed at the same time')
+args = parser.parse_args()
+threshold_type = args.threshold_type
+density = args.density
+validate = args.validate
+sweep = args.sweep
+weighted = args.weighted
+acq_id = args.acq
+force = args.force
+jobs = args.jobs
 
 # set study parameter
 base_dir = '/home/kcheung3/sanlab/DEV_RS'
+number_roi = 100
+sweep_percentiles = list(range(70, 91, 1))
+sweep_densities = [round(1 - percentile / 100, 2) for percentile in sweep_percentiles]
+output_dir = os.path.join(base_dir, 'baseline_analysis', 'graph_outputs')
+# the outputs of proportional thresholding are labeled with the density
+output_suffix = acq_id if threshold_type == 'percentile' else f'{acq_id}_density{round(density * 100)}'
+store_file = metric_store_path(output_dir, output_suffix)
+# the thresholding parameters are part of the checkpoint key, a subject is computed again when any of them changes
+graph_params = {
+    'threshold_type': threshold_type,
+    'density': density if threshold_type == 'proportional' else None,
+    'number_roi': number_roi
+}
 
 # load the physio and self report data set
 base_dv = pd.read_csv(os.path.join(base_dir, 'dv_data', 'outputs', 'sub_data_baseline_w_clean.csv'))
@@ -54,48 +173,95 @@ base_dv = pd.read_csv(os.path.join(base_dir, 'dv_data', 'outputs', 'sub_data_bas
 # extract the subject ID
 sub_ids = list(base_dv['SID'])
 
-# initiate dataframes for metric outcomes
-coeff_threshold_list = []
+# load the edge weights of all subjects, from the connectome cube if the subject correlations were written to it
+corr_root = os.path.join(base_dir, 'baseline_analysis', 'subject_correlation')
+cube_file = corr_cube_path(corr_root)
+if set(sub_ids) <= set(cube_sub_ids(cube_file, acq_id)):
+    corr_cube, _ = read_corr_cube(cube_file, acq_id, sub_ids)
+else:
+    edge_dir = os.path.join(corr_root, 'baseline_acq_schaefer')
+    corr_cube = np.stack([pd.read_csv(os.path.join(edge_dir, f'{sub}_{acq_id}_corr.csv'), sep=',', header=None).to_numpy() for sub in sub_ids])
+# extract the upper triangle of every subject (subjects x edges)
+triu = np.triu_indices(number_roi, k=1)
+edge_mat = corr_cube[:, triu[0], triu[1]]
+
+# generate coefficient threshold dataframe for the whole cohort
+coeff_threshold_df = coeff_threshold (edge_mat, 70, 91, sub_ids)
+# the coefficient of the 70th percentile (a spacity level of 30%) of each subject
+sub_thresholds = coeff_threshold_df['edge_coefficient'].to_numpy().reshape(len(sub_ids), -1)
+sub_threshold = sub_thresholds[:, 0]
+if threshold_type == 'proportional':
+    # keep the strongest edges of each subject up to the density
+    adjacency_mat = proportional_adjacency(edge_mat, density)
+else:
+    # binarize each subject at a spacity level of 30%
+    adjacency_mat = percentile_adjacency(edge_mat, sub_threshold)
+
+# find the subjects whose checkpoint is missing or incomplete, or whose edge weights or parameters changed since the last run
+records = checkpoint_records(store_file)
+sub_keys = {}
+for i, sub in enumerate(sub_ids):
+    sub_key = array_key(edge_mat[i], graph_params)
+    record = records.get(sub)
+    # a validation run checks every subject, the checkpointed ones are computed again
+    if (not force and not validate and record is not None and record['key'] == sub_key and (record['sweep'] or not sweep)
+            and (record['weighted'] or not weighted)):
+        print('skip completed subject', sub)
+        continue
+    sub_keys[i] = sub_key
+
+if jobs <= 1:
+    sub_results = map(run_subject, sub_keys)
+else:
+    # fork the workers, this script runs at import and cannot be re-imported by spawned workers.
+    # the workers are forked once before the checkpoint store is opened for writing, so they never inherit its file lock
+    # (all workers are forked at the first submit with the fork context)
+    pool = ProcessPoolExecutor(jobs, mp_context=mp.get_context('fork'))
+    sub_results = pool_results({pool.submit(run_subject, i): i for i in sub_keys})
+
+# the checkpoints are written by the main process only, as soon as each subject is done
+failed = {}
+for i, metrics, sub_sweep, sub_weighted, error in sub_results:
+    if error is not None:
+        print('failed subject', sub_ids[i], flush=True)
+        failed[sub_ids[i]] = error
+        continue
+    write_checkpoint(store_file, sub_ids[i], sub_keys[i], metrics, sub_sweep, sub_weighted)
+
+if jobs > 1:
+    pool.shutdown()
+
+# summarize the failed subjects, the completed subjects keep their checkpoint for the next run
+if failed:
+    for sub, error in failed.items():
+        print(f'subject {sub} failed:\n{error}')
+    print(len(failed), 'of', len(sub_ids), 'subjects failed:', ' '.join(failed))
+    sys.exit(1)
+
+# consolidate the checkpoints of the cohort into the output tables
 degree_centrality_list = []
 betweenness_centrality_list = []
 closeness_centrality_list = []
 cluster_coefficients_list = []
 other_metric_list = []
-
-
+sweep_dfList = []
+weighted_dfList = {key: [] for key in ['strength', 'normalized_strength', 'weighted_clustering', 'nodal_efficiency']}
+weighted_other_list = []
+conn_dir = os.path.join(base_dir, 'baseline_analysis', 'subject_connectivity_acq_Schaefer')
 for sub in sub_ids:
-    # load edge weights
-    edge_dir = os.path.join(base_dir, 'baseline_analysis', 'subject_correlation', 'baseline_acq_schaefer')
-    edge_file = os.path.join(edge_dir, f'{sub}_concat_corr.csv')
-    edge_df = pd.read_csv(edge_file, sep=',', header=None)
-
-    # generate coefficient threshold dataframe
-    coeff_threshold_df = coeff_threshold (edge_df, 70, 91, sub)
-    coeff_threshold_list.append(coeff_threshold_df)
-
-    # generate a binary network based on a spacity level of 30%
-    G = binary_network(edge_df, coeff_threshold_df['edge_coefficient'][0], 100)
-
-    # generate network metric
-    degree_centrality = list(nx.degree_centrality(G).values())
-    betweenness_centrality = list(nx.betweenness_centrality(G).values())
-    closeness_centrality = list(nx.closeness_centrality(G).values())
-    global_efficiency = nx.global_efficiency(G)
-    local_efficiency = nx.local_efficiency(G)
-    cluster_coefficients = list(nx.clustering(G, nodes=None, weight=None).values())
-    average_coefficients = nx.average_clustering(G, nodes=None, weight=None)
-
-    # convert the lists to dataframes
-    degree_centrality_df = pd.DataFrame(degree_centrality, columns = [sub])
-    betweenness_centrality_df = pd.DataFrame(betweenness_centrality, columns = [sub])
-    closeness_centrality_df = pd.DataFrame(closeness_centrality, columns = [sub])
-    cluster_coefficients_df = pd.DataFrame(cluster_coefficients, columns = [sub])
+    metrics, sub_sweep, sub_weighted = read_checkpoint(store_file, sub)
+
+    # convert the metrics to dataframes
+    degree_centrality_df = pd.DataFrame(metrics['degree_centrality'], columns = [sub])
+    betweenness_centrality_df = pd.DataFrame(metrics['betweenness_centrality'], columns = [sub])
+    closeness_centrality_df = pd.DataFrame(metrics['closeness_centrality'], columns = [sub])
+    cluster_coefficients_df = pd.DataFrame(metrics['cluster_coefficients'], columns = [sub])
     other_metric_df = pd.DataFrame(
         {
             'sub_id' : sub,
-            'global_efficiency' : global_efficiency, 
-            'local_efficiency' : local_efficiency,
-            'average_coefficients' : average_coefficients,
+            'global_efficiency' : metrics['global_efficiency'], 
+            'local_efficiency' : metrics['local_efficiency'],
+            'average_coefficients' : metrics['average_coefficients'],
         },
         index = [sub]
     
@@ -107,6 +273,22 @@ for sub in sub_ids:
     closeness_centrality_list.append(closeness_centrality_df)
     cluster_coefficients_list.append(cluster_coefficients_df)
     other_metric_list.append(other_metric_df)
+    if sweep:
+        sweep_dfList.append(sweep_table(sub_sweep, sub, sweep_percentiles, sweep_densities))
+    if weighted:
+        for key in weighted_dfList:
+            weighted_dfList[key].append(pd.DataFrame(sub_weighted[key], columns = [sub]))
+        weighted_other_list.append(pd.DataFrame(
+            {
+                'sub_id' : sub,
+                'weighted_efficiency' : sub_weighted['weighted_efficiency'],
+                'average_weighted_clustering' : sub_weighted['average_weighted_clustering'],
+            },
+            index = [sub]
+        ))
+        # the normalized strength of each ROI, the input of acq_roi_shuffle_pcorr_schaefer.py
+        normstrength_df = pd.DataFrame(sub_weighted['normalized_strength'], columns = ['normstrength'])
+        normstrength_df.to_csv(os.path.join(conn_dir, f'{sub}_{acq_id}_normstrength_full.csv'), index=False, header=True)
 
 # concatenate outputs
 degree_centrality_df = pd.concat(degree_centrality_list, axis=1)
@@ -114,15 +296,28 @@ betweenness_centrality_df = pd.concat(betweenness_centrality_list, axis=1)
 closeness_centrality_df = pd.concat(closeness_centrality_list, axis=1)
 cluster_coefficients_df = pd.concat(cluster_coefficients_list, axis=1)
 
-coeff_threshold_df = pd.concat(coeff_threshold_list, ignore_index = True)
 other_metric_df = pd.concat(other_metric_list)
 
 # write the outputs
-output_dir = os.path.join(base_dir, 'baseline_analysis', 'graph_outputs')
+degree_centrality_df.to_csv(os.path.join(output_dir, f"degree_centrality_df_{output_suffix}.csv"), index=False, header=True)
+betweenness_centrality_df.to_csv(os.path.join(output_dir, f"betweenness_centrality_df_{output_suffix}.csv"), index=False, header=True)
+closeness_centrality_df.to_csv(os.path.join(output_dir, f"closeness_centrality_df_{output_suffix}.csv"), index=False, header=True)
+cluster_coefficients_df.to_csv(os.path.join(output_dir, f"cluster_coefficients_df_{output_suffix}.csv"), index=False, header=True)
+coeff_threshold_df.to_csv(os.path.join(output_dir, f"coeff_threshold_df_{output_suffix}.csv"), index=False, header=True)
+other_metric_df.to_csv(os.path.join(output_dir, f"other_metric_df_{output_suffix}.csv"), index=False, header=True)
+
+# write the density sweep and its area under the curve
+if sweep:
+    sweep_df = pd.concat(sweep_dfList, ignore_index=True)
+    sweep_auc_df = sweep_auc(sweep_df)
+
+    # the sweep does not depend on --density
+    sweep_suffix = acq_id if threshold_type == 'percentile' else f'{acq_id}_proportional'
+    sweep_df.to_csv(os.path.join(output_dir, f"graph_sweep_df_{sweep_suffix}.csv"), index=False, header=True)
+    sweep_auc_df.to_csv(os.path.join(output_dir, f"graph_sweep_auc_df_{sweep_suffix}.csv"), index=False, header=True)
 
-degree_centrality_df.to_csv(os.path.join(output_dir, "degree_centrality_df_concat.csv"), index=False, header=True)
-betweenness_centrality_df.to_csv(os.path.join(output_dir, "betweenness_centrality_df_concat.csv"), index=False, header=True)
-closeness_centrality_df.to_csv(os.path.join(output_dir, "closeness_centrality_df_concat.csv"), index=False, header=True)
-cluster_coefficients_df.to_csv(os.path.join(output_dir, "cluster_coefficients_df_concat.csv"), index=False, header=True)
-coeff_threshold_df.to_csv(os.path.join(output_dir, "coeff_threshold_df_concat.csv"), index=False, header=True)
-other_metric_df.to_csv(os.path.join(output_dir, "other_metric_df_concat.csv"), index=False, header=True)
+# write the weighted metrics, they do not depend on the thresholding
+if weighted:
+    for key, dfList in weighted_dfList.items():
+        pd.concat(dfList, axis=1).to_csv(os.path.join(output_dir, f"{key}_df_{acq_id}.csv"), index=False, header=True)
+    pd.concat(weighted_other_list).to_csv(os.path.join(output_dir, f"weighted_other_metric_df_{acq_id}.csv"), index=False, header=True)